@@ -2,18 +2,21 @@
 
 
 from mesh import create_mesh_extents, get_extents_from_sets, extents_to_shp, get_anchors_gdf_from_db
+from fetch import create_session, RateLimiter, getmap, fetch_tiles
+from cache import TileCache
+from mosaic import tile_name, mosaic_tiles
 #from params import *
 
 import json
 
 import os
+import re
+
+from functools import partial
 
 import pandas as pd
 import geopandas as gpd
 
-# connexion to wms server
-from owslib.wms import WebMapService
-
 
 
 ### PARAMETERS
@@ -42,6 +45,14 @@ BASEMAP = 'pign'
 WMS_URL = 'https://wxs.ign.fr/essentiels/geoportail/r/wms'
 WMS_LAYER = 'GEOGRAPHICALGRIDSYSTEMS.PLANIGNV2'
 TIMEOUT = 300
+MAX_IN_FLIGHT = 8 # number of concurrent GetMap requests
+RATE_LIMIT = 10 # max requests per second to the server (None = no limit)
+RETRIES = 3 # retries of a failed request, with exponential backoff
+BACKOFF = 1 # seconds before the first retry
+
+# Cache of the server responses, shared between projects (None = no cache)
+CACHE_PATH = 'cache/'
+CACHE_MAX_SIZE = 20 * 1024**3 # bytes, least recently used images are removed
 
 # Mesh parameters (tiles creation)
 TILE_SIZE = (256, 256)
@@ -66,58 +77,65 @@ def main():
     # get extent
     map_extent = get_map_extent(JSON_PATH)
     
-    # create tile extents
-    tile_extents = create_mesh_extents(map_extent, OVERLAPSE, SAFETY, TILE_SIZE, SRS, ZOOM_LEVEL, verbose=False)
+    # create tile extents (aligned on whole pixels, so that maps can be recomposed)
+    tile_extents = create_mesh_extents(map_extent, OVERLAPSE, SAFETY, TILE_SIZE, SRS, ZOOM_LEVEL, verbose=False, align=True)
 
     # Create and save tile images in tiles folder
-    # 1er chiffre = num_ligne, 2e chiffre = num_colonne
+    # tile names: '{num_ligne}_{num_colonne}', see mosaic.tile_name
     
     
     ### IMAGES AND MASKS CREATION
     
      
-    # Connexion to WMS server (image creation)
+    # Connexion pool to WMS server (image creation)
     print("Connexion to wms server...")
-    wms = WebMapService(WMS_URL, timeout=TIMEOUT)
-    if not wms: return print("Connexion failed, process aborted.")
-    else: print("Connected to " + WMS_URL) 
-    
+    session = create_session(pool_size=MAX_IN_FLIGHT)
+    cache = TileCache(CACHE_PATH, CACHE_MAX_SIZE) if CACHE_PATH else None
+    fetch_one = partial(getmap, session, WMS_URL, WMS_LAYER, 
+                        size=TILE_SIZE, 
+                        srs='EPSG:3857', # Pseudo Mercator
+                        format='image/png', 
+                        timeout=TIMEOUT, 
+                        retries=RETRIES, 
+                        backoff=BACKOFF, 
+                        rate_limiter=RateLimiter(RATE_LIMIT),
+                        cache=cache)
     
-    # Loop
-    i = 0 # numéro de l'image
-    l = 1 # ligne de la tuile dans la map
-    c = 1 # colonne de la tuile dans la map
-    w1 = 0 # coord west de la dernière tuile créée
     
-    for tile_extent in tile_extents:
-        i += 1
-        w, s, e, n = tile_extent
-        
-        # si la nouvelle coord west est inférieure ca veut dire qu'on arrive au bout de la ligne et qu'on passe a la ligne du dessous
-        if (i > 1 and w <= w1):
-            l += 1 
-            c = 1
-        
-        tile_name = str(l) + str(c)
-        # On incremente la colonne
-        c += 1
-        # On met en mémoire la coord west pour la prochaine itération
-        w1 = w
-        
+    def image_jobs():
+        i = 0 # numéro de l'image
+        l = 1 # ligne de la tuile dans la map
+        c = 1 # colonne de la tuile dans la map
+        w1 = 0 # coord west de la dernière tuile créée
         
-        print("Creation of image and mask number ", i, " out of ", len(tile_extents))
-        
-        img = wms.getmap(   layers = [WMS_LAYER],
-                            srs = 'EPSG:3857', # Pseudo Mercator
-                            bbox = tile_extent, # Enveloppe West South East North # Attention il faut respecter les proportions de size
-                            size = TILE_SIZE, 
-                            format='image/png',
-                            timeout=TIMEOUT
-                            )
-        path = OUTPUT_IMG_PATH + '/' + tile_name + '.png'
+        for tile_extent in tile_extents:
+            i += 1
+            w, s, e, n = tile_extent
+            
+            # si la nouvelle coord west est inférieure ca veut dire qu'on arrive au bout de la ligne et qu'on passe a la ligne du dessous
+            if (i > 1 and w <= w1):
+                l += 1 
+                c = 1
+            
+            name = tile_name(l, c)
+            # On incremente la colonne
+            c += 1
+            # On met en mémoire la coord west pour la prochaine itération
+            w1 = w
+            
+            print("Creation of image number ", i, " out of ", len(tile_extents))
+            
+            yield name, tile_extent
+    
+    
+    # Loop
+    for name, img in fetch_tiles(image_jobs(), fetch_one, max_in_flight=MAX_IN_FLIGHT):
+        path = OUTPUT_IMG_PATH + '/' + name + '.png'
         out = open(path, 'wb')
-        out.write(img.read())
+        out.write(img)
         out.close()
+    
+    if cache is not None: print("Cache:", cache.stats())
 
     
 
@@ -139,8 +157,23 @@ def get_zoom_level(json_path):
         return dic["features"][0]["zoom"]
     
 
-def recompose_maps():
-    # parse a folder with tiles in it, and create corresponding images with concatenation
-    pass
+def recompose_maps(benchmark_path=BENCHMARK_PATH, tiles_folder='tiles', suffix='', out_suffix='_mosaic', blend=True):
+    '''
+    Rebuild the full map of every map folder of the benchmark from its tiles
+    ({map}/{tiles_folder}/{row}_{col}{suffix}.png), saved as {map}{out_suffix}.png
+    in benchmark_path. Tiles are streamed (see mosaic.mosaic_tiles), so maps 
+    bigger than the memory can be rebuilt.
+    
+    e.g. predicted masks: recompose_maps(tiles_folder='predictions', suffix='_mask', out_suffix='_mask')
+    '''
+    maps = {}
+    for map_name in sorted(os.listdir(benchmark_path)):
+        folder = os.path.join(benchmark_path, map_name, tiles_folder)
+        if not os.path.isdir(folder) or not any(re.search(re.escape(suffix) + r'\.png$', name) for name in os.listdir(folder)): continue
+        
+        path = os.path.join(benchmark_path, map_name + out_suffix + '.png')
+        print("Recompose map", map_name)
+        maps[map_name] = mosaic_tiles(folder, path, TILE_SIZE, OVERLAPSE, suffix=suffix, blend=blend)
+    return maps
 
 
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+### TILE CACHE
+
+class TileCache:
+    '''
+    On-disk cache of server responses, keyed by the request parameters.
+    Files are written atomically, and the least recently used ones are
+    removed when the cache grows over max_size.
+    Can be shared between threads.
+    '''
+
+    def __init__(self, folder, max_size=20 * 1024**3):
+        # folder: cache folder, created if it does not exist
+        # max_size: max size of the cache in bytes
+        self.folder = folder
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+        # Existing entries, from least to most recently used (mtime = last use)
+        entries = []
+        for root, dirs, files in os.walk(folder):
+            for name in files:
+                if name.endswith('.tmp'): continue
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, name, stat.st_size))
+        entries.sort()
+        self._entries = OrderedDict((name, size) for mtime, name, size in entries)
+        self.size = sum(self._entries.values())
+
+    @staticmethod
+    def key(*parts):
+        '''
+        Key of a request, from its parameters (url, layer, srs, bbox, size, format...)
+        '''
+        text = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key[:2], key)
+
+    def get(self, key):
+        '''
+        Return the cached content of key, or None if it is not in the cache
+        '''
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f: content = f.read()
+            os.utime(path) # last use
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+                # removed by another process
+                if key in self._entries: self.size -= self._entries.pop(key)
+            return None
+
+        with self._lock:
+            self.hits += 1
+            if key in self._entries: self._entries.move_to_end(key)
+        return content
+
+    def put(self, key, content):
+        '''
+        Add content to the cache (atomic write), and evict the least recently
+        used entries if the cache is too big
+        '''
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f: f.write(content)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            if key in self._entries: self.size -= self._entries.pop(key)
+            self._entries[key] = len(content)
+            self.size += len(content)
+            evicted = []
+            while self.size > self.max_size and len(self._entries) > 1:
+                old_key, old_size = self._entries.popitem(last=False)
+                self.size -= old_size
+                evicted.append(old_key)
+
+        for old_key in evicted:
+            try: os.remove(self._path(old_key))
+            except FileNotFoundError: pass
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'size': self.size}
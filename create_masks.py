@@ -1,13 +1,231 @@
 # -*- coding: utf-8 -*-
 
-from shapely import box, intersection, affinity
+import os
+from io import BytesIO
+from multiprocessing import Pool
+from itertools import islice, groupby
+from collections import deque
+
+from shapely import box, intersection, get_coordinates, STRtree, to_wkb, from_wkb
+import numpy as np
 import geopandas as gpd
 from PIL import Image, ImageDraw
 
+from metrics import Metrics, timer
+
 
 ### DEF
 
-def create_mask(extent, polygons, zoom, img_size, img_path, verbose=False, empty=True):
+def build_polygons_index(polygons):
+    '''
+    Build a spatial index (STRtree) over the polygons to draw on the masks.
+    It has to be built only once per run and can then be given to every
+    create_mask call.
+
+    Parameters
+    ----------
+    polygons : list of polygons
+        Exploded anchor polygons (no multipolygons), in EPSG:3857
+
+    Returns
+    -------
+    index : shapely.STRtree
+        Spatial index over the polygons
+
+    '''
+    return STRtree(list(polygons))
+
+
+def plan_tiles(tile_extents, index):
+    '''
+    Find, with one vectorized query on the spatial index, the tiles that 
+    intersect at least one polygon (the masks that are not empty) and the
+    candidate polygons of each tile (see create_mask).
+
+    Parameters
+    ----------
+    tile_extents : array of shape (N, 4)
+        (west, south, east, north) of each tile
+        
+    index : shapely.STRtree
+        Spatial index built with build_polygons_index
+
+    Returns
+    -------
+    nonempty : numpy array of bool with shape (N,)
+        True if the mask of the tile is not empty
+        
+    offsets : numpy array of int with shape (N + 1,)
+        
+    candidates : numpy array of int
+        Polygons (positions in the index) intersecting tile k are
+        candidates[offsets[k]:offsets[k + 1]]
+
+    '''
+    tile_extents = np.asarray(tile_extents, dtype=np.float64).reshape(-1, 4)
+    boxes = box(tile_extents[:, 0], tile_extents[:, 1], tile_extents[:, 2], tile_extents[:, 3])
+    
+    # pairs (tile, polygon) that intersect, sorted by tile
+    tiles, candidates = index.query(boxes, predicate='intersects')
+    order = np.lexsort((candidates, tiles))
+    tiles, candidates = tiles[order], candidates[order]
+    
+    counts = np.bincount(tiles, minlength=len(tile_extents))
+    offsets = np.zeros(len(tile_extents) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return counts > 0, offsets, candidates
+
+
+def rasterize_polygons(polygons, extent, zoom, img_size, out=None):
+    '''
+    Rasterize polygons (exteriors and holes) in a single uint8 buffer.
+    The result is the same as drawing one image per polygon and fusing them:
+    the hole of a polygon never erases another polygon overlapping it.
+    Rows are not flipped (row 0 is the south of the extent).
+
+    Parameters
+    ----------
+    polygons : list of polygons
+        Polygons to draw (no multipolygons), in the extent coordinates
+        
+    extent : tuple (west, south, east, north)
+        
+    zoom : float
+        Number of real life meters per pixel
+        
+    img_size : tuple of int (x, y) in pixel
+        
+    out : numpy array of uint8 with shape (y, x), optional
+        Preallocated buffer to fill, reset before drawing. The default is None.
+
+    Returns
+    -------
+    out : numpy array of uint8 with shape (y, x)
+        255 where a polygon is drawn, 0 elsewhere
+
+    '''
+    width, height = img_size
+    if out is None: out = np.zeros((height, width), dtype=np.uint8)
+    else: out.fill(0)
+    
+    w, s = extent[0], extent[1]
+    factor = 1/zoom
+    
+    canvas = Image.new(mode='L', size=img_size, color=0)
+    draw = ImageDraw.Draw(canvas)
+    
+    # Polygons without holes are all drawn together: their union is the result
+    holed = []
+    for polygon in polygons:
+        if len(polygon.interiors): 
+            holed.append(polygon)
+            continue
+        draw.polygon(_ring_to_pixels(polygon.exterior, w, s, factor), fill=255)
+    out |= np.asarray(canvas)
+    
+    # Polygons with holes are drawn one by one, only in their own window, and 
+    # or-ed in the buffer so that their holes do not erase other polygons
+    for polygon in holed:
+        minx, miny, maxx, maxy = polygon.bounds
+        x0 = max(int(np.floor((minx - w) * factor)) - 1, 0)
+        y0 = max(int(np.floor((miny - s) * factor)) - 1, 0)
+        x1 = min(int(np.ceil((maxx - w) * factor)) + 2, width)
+        y1 = min(int(np.ceil((maxy - s) * factor)) + 2, height)
+        if x0 >= x1 or y0 >= y1: continue
+        
+        canvas.paste(0, (x0, y0, x1, y1))
+        draw.polygon(_ring_to_pixels(polygon.exterior, w, s, factor), fill=255)
+        for ring in polygon.interiors:
+            draw.polygon(_ring_to_pixels(ring, w, s, factor), fill=0)
+        out[y0:y1, x0:x1] |= np.asarray(canvas.crop((x0, y0, x1, y1)))
+    
+    return out
+
+
+def flip_vertical(array):
+    '''
+    Flip an image array upside down, in place (PIL 'y' are inverted).
+    '''
+    height = array.shape[0]
+    half = height // 2
+    top = array[:half]
+    bottom = array[height - half:][::-1]
+    tmp = top.copy()
+    top[...] = bottom
+    bottom[...] = tmp
+    return array
+
+
+def coverage_to_image(coverage):
+    '''
+    Convert a coverage buffer from rasterize_polygons into the 'LA' mask:
+    polygons in black, background in white, fully opaque.
+    '''
+    la = np.empty(coverage.shape + (2,), dtype=np.uint8)
+    np.bitwise_not(coverage, out=la[..., 0])
+    la[..., 1] = 255
+    return Image.fromarray(la)
+
+
+def encode_mask(coverage, mode='LA'):
+    '''
+    Encode a coverage buffer from rasterize_polygons as a mask
+
+    Parameters
+    ----------
+    coverage : numpy array of uint8 with shape (y, x)
+        255 where a polygon is drawn, 0 elsewhere
+        
+    mode : string, optional
+        'LA' : black polygons on white, with an opaque alpha channel (legacy)
+        'L' : black polygons on white, single channel
+        '1' : black polygons on white, 1 bit per pixel
+        'npy' : bit-packed numpy array (bit = 1 on polygons), rows packed 
+        with np.packbits(axis=1), see unpack_mask
+        The default is 'LA'.
+
+    Returns
+    -------
+    mask : PIL image, or numpy array of uint8 if mode is 'npy'
+
+    '''
+    if mode == 'LA': return coverage_to_image(coverage)
+    if mode == 'L': return Image.fromarray(np.bitwise_not(coverage))
+    if mode == '1': return Image.fromarray(coverage == 0)
+    if mode == 'npy': return np.packbits(coverage > 0, axis=1)
+    raise ValueError("Unknown mask mode: " + str(mode))
+
+
+def unpack_mask(packed, width):
+    '''
+    Decode a bit-packed mask ('npy' mode) into a boolean array (True on polygons)
+    '''
+    return np.unpackbits(packed, axis=1, count=width).astype(bool)
+
+
+def save_mask(mask, path, compress_level=None):
+    '''
+    Save a mask from encode_mask: png for images, .npy for bit-packed arrays.
+    path can also be a file object.
+    compress_level (0-9) is the zlib level of png files, None for the default.
+    '''
+    if isinstance(mask, np.ndarray): 
+        np.save(path, mask)
+        return
+    params = {} if compress_level is None else {'compress_level': compress_level}
+    mask.save(path, format=None if isinstance(path, str) else 'PNG', **params)
+
+
+def _ring_to_pixels(ring, w, s, factor):
+    # Conversion of the ring points from the extent coordinates to pixel coordinates
+    coords = get_coordinates(ring)
+    coords[:, 0] -= w
+    coords[:, 1] -= s
+    coords *= factor
+    return coords.ravel().tolist()
+
+
+def create_mask(extent, polygons, zoom, img_size, img_path, verbose=False, empty=True, index=None, buffer=None, mode='LA', compress_level=None, metrics=None, candidates=None):
     '''
     Create an image from an extent and draw black polygons on it 
 
@@ -23,7 +241,7 @@ def create_mask(extent, polygons, zoom, img_size, img_path, verbose=False, empty
         
     img_size : tuple of int (x, y) in pixel
         
-    img_path : string, optional
+    img_path : string or file object, optional
         If specified, create a file to save the mask. The default is False.
         
     verbose : bool, optional
@@ -31,10 +249,32 @@ def create_mask(extent, polygons, zoom, img_size, img_path, verbose=False, empty
         
     empty : bool, optional
         create masks even if it is empty. The default is True.
+        
+    index : shapely.STRtree, optional
+        Spatial index built with build_polygons_index. If specified, only the
+        polygons whose bounding box hits the extent are intersected, and
+        polygons is ignored. The default is None.
+        
+    buffer : numpy array of uint8 with shape (y, x), optional
+        Preallocated buffer reused to rasterize the polygons. The default is None.
+        
+    mode : string, optional
+        Encoding of the mask: 'LA', 'L', '1' or 'npy' (see encode_mask). The default is 'LA'.
+        
+    compress_level : int, optional
+        zlib level (0-9) of png masks. The default is None (PIL default).
+        
+    metrics : metrics.Metrics, optional
+        Records the latency of the intersection, rasterization and encoding
+        (with the saving) of the mask. The default is None.
+        
+    candidates : numpy array of int, optional
+        Positions in index of the polygons that may intersect the extent 
+        (see plan_tiles): index is not queried. The default is None.
 
     Returns
     -------
-    mask : PIL image
+    mask : PIL image (numpy array in 'npy' mode)
         Return the created mask
         Return False if the empty mask is not created.
 
@@ -48,10 +288,16 @@ def create_mask(extent, polygons, zoom, img_size, img_path, verbose=False, empty
     # Intersection between the extent polygon and the polygons we want to draw
     if verbose: print("Intersection between extent and polygons...")
     
-    intersections = []
-    for polygon in polygons:
-      intersect = intersection(tilebox, polygon)
-      if not intersect.is_empty: intersections.append(intersect)
+    with timer(metrics, 'intersection'):
+        if index is not None:
+            # only keep candidates whose bounding box hits the tile (planned, or queried)
+            if candidates is None: candidates = np.sort(index.query(tilebox))
+            intersections = [g for g in intersection(tilebox, index.geometries.take(candidates)) if not g.is_empty]
+        else:
+            intersections = []
+            for polygon in polygons:
+              intersect = intersection(tilebox, polygon)
+              if not intersect.is_empty: intersections.append(intersect)
     
     if verbose: print("Number of polygons created through intersection: ", len(intersections))
     
@@ -63,9 +309,6 @@ def create_mask(extent, polygons, zoom, img_size, img_path, verbose=False, empty
     
     # if there are polygons to draw
     
-    # Creation of an empty mask (blank image)
-    mask = Image.new(mode='LA', size=img_size, color='white')
-        
     # simplify multipolygons
     p = []
     for geometry in intersections:
@@ -75,48 +318,308 @@ def create_mask(extent, polygons, zoom, img_size, img_path, verbose=False, empty
     
     intersections = p
     
-    # Create one image per polygon and fuse them later (mandatory to take into account overlapping polygons with at least one hole)
-    if verbose: print("Drawing polygon images...")
-    images = []
-    for polygon in intersections:
-        
-        # creation of an image with PIL
-        img = Image.new(mode='LA', size=img_size, color=(0, 0)) # LA --> color = (black/white, alpha (transparency))
-        draw = ImageDraw.Draw(img)
-        
-        # Conversion des points du polygone depuis son échelle et son emprise. à une nouvelle échelle et coordonnées d'origine 256*256
-        poly_to_draw = affinity.translate(polygon, xoff=-w, yoff=-s)
-        poly_to_draw = affinity.scale(poly_to_draw,
-                                             xfact=1/zoom,
-                                             yfact=1/zoom,
-                                             origin=(0, 0))
-        
-        # Draw exterior polygon in black
-        coords_list = poly_to_draw.exterior.coords
-        draw.polygon(coords_list, fill="black") # black = (0, 255)
-        
-        # Draw interior polygons (holes) in transparent
-        int_polys = poly_to_draw.interiors
-        for poly in int_polys:
-            coords_list = poly.coords
-            draw.polygon(coords_list, fill=(0, 0))
-            
-        images.append(img)
-            
-    if verbose: print("Fusing polygon images")
+    # Draw every polygon in a single uint8 buffer (255 = polygon, 0 = background)
+    if verbose: print("Rasterizing polygons...")
+    with timer(metrics, 'rasterization'):
+        coverage = rasterize_polygons(intersections, extent, zoom, img_size, out=buffer)
     
-    # Fuse images with mask
-    for img in images:
-        mask.paste(img, mask=img)
+        # flip mask because PIL 'y' are inverted
+        flip_vertical(coverage)
     
-    # flip mask because PIL 'y' are inverted
-    mask = mask.transpose(Image.FLIP_TOP_BOTTOM)
+    with timer(metrics, 'mask_encoding'):
+        # Creation of the mask: black polygons on a white background
+        mask = encode_mask(coverage, mode)
 
-    # Save image                 
-    mask.save(img_path)
+        # Save image (img_path can also be a file object)
+        save_mask(mask, img_path, compress_level)
     if verbose: print("Mask saved as " + img_path)
     
     return mask
+
+
+### PARALLEL
+
+# Worker state, set once per process by _init_worker
+_worker = {}
+
+def _init_worker(polygons_wkb, zoom, img_size, path_format, empty, mode, compress_level, metrics=False, planned=False):
+    # Anchors are received once per process as WKB, and indexed in the process
+    polygons = from_wkb(polygons_wkb)
+    _worker['index'] = build_polygons_index(polygons)
+    _worker['zoom'] = zoom
+    _worker['img_size'] = img_size
+    _worker['path_format'] = path_format
+    _worker['empty'] = empty
+    _worker['mode'] = mode
+    _worker['compress_level'] = compress_level
+    _worker['metrics'] = metrics
+    _worker['planned'] = planned
+    _worker['buffer'] = np.empty((img_size[1], img_size[0]), dtype=np.uint8)
+
+
+def _render_chunk(tile_jobs):
+    # metrics of the chunk are sent back with its results
+    metrics = Metrics() if _worker['metrics'] else None
+    results = []
+    for job in tile_jobs:
+        i, extent = job[0], job[1]
+        # polygons of the tile given with the job (clipped in the database), or global index
+        # (with the candidates of the tile given with the job if they are planned)
+        planned = _worker['planned']
+        polygons, index = (from_wkb(job[2]), None) if len(job) > 2 and not planned else (None, _worker['index'])
+        candidates = job[2] if planned else None
+        
+        # mask file, or png content sent back if there is no path
+        path = _worker['path_format'].format(i) if _worker['path_format'] else BytesIO()
+        mask = create_mask(extent, polygons, _worker['zoom'], _worker['img_size'], img_path=path, 
+                           empty=_worker['empty'], index=index, buffer=_worker['buffer'], 
+                           mode=_worker['mode'], compress_level=_worker['compress_level'], metrics=metrics, 
+                           candidates=candidates)
+        if metrics is not None: metrics.count('empty_masks' if mask is False else 'masks')
+        if mask is False: results.append((i, False))
+        elif _worker['path_format']: results.append((i, True))
+        else: results.append((i, path.getvalue()))
+    return results, metrics
+
+
+def _merge_chunk(output, metrics):
+    # results of a chunk, its metrics added to the run metrics
+    results, chunk_metrics = output
+    if chunk_metrics is not None: metrics.merge(chunk_metrics)
+    return results
+
+
+def create_masks_parallel(tile_jobs, polygons, zoom, img_size, path_format, empty=True, workers=None, chunksize=32, 
+                          mode='LA', compress_level=None, metrics=None, planned=False):
+    '''
+    Create the masks of many tiles with a pool of processes.
+    Results are yielded lazily, in the order of tile_jobs.
+
+    Parameters
+    ----------
+    tile_jobs : iterable of (i, extent) or (i, extent, wkbs) or (i, extent, candidates)
+        Index of the tile (used in the file name) and its extent, and 
+        optionally the polygons of this tile only (WKB), used instead of polygons,
+        or the positions in polygons of its candidates if planned
+        
+    polygons : list of polygons
+        Exploded anchor polygons, sent once to each process. Can be None if 
+        every job has its own polygons
+        
+    zoom : float
+        Number of real life meters per pixel
+        
+    img_size : tuple of int (x, y) in pixel
+        
+    path_format : string
+        Path of a mask, formatted with the tile index, e.g. 'targets/{}_mask.png'.
+        If None, masks are not saved but their file content is yielded.
+        
+    empty : bool, optional
+        create masks even if it is empty. The default is True.
+        
+    workers : int, optional
+        Number of processes. None uses every core, 1 runs in this process. The default is None.
+        
+    chunksize : int, optional
+        Number of tiles sent to a process at once. The default is 32.
+        
+    mode, compress_level : 
+        Encoding of the masks, see create_mask.
+        
+    metrics : metrics.Metrics, optional
+        Metrics of the workers (see create_mask) are added to it as their 
+        chunks are done. The default is None.
+        
+    planned : bool, optional
+        Jobs are (i, extent, candidates), candidates of the tile from 
+        plan_tiles: the processes do not query their index. The default is False.
+
+    Yields
+    ------
+    (i, created) : (int, bool or bytes)
+        created is False if the empty mask is not created, and the mask file
+        content if path_format is None
+
+    '''
+    polygons_wkb = to_wkb(np.asarray(list(polygons or []), dtype=object))
+    initargs = (polygons_wkb, zoom, img_size, path_format, empty, mode, compress_level, metrics is not None, planned)
+    
+    tile_jobs = iter(tile_jobs)
+    chunks = iter(lambda: [(job[0], tuple(job[1])) + tuple(job[2:]) for job in islice(tile_jobs, chunksize)], [])
+    
+    for results in _map_chunks(_render_chunk, chunks, workers, initargs, metrics):
+        for result in results: yield result
+
+
+def _map_chunks(function, chunks, workers, initargs, metrics):
+    # Results of function on each chunk, in order, computed by a pool of processes
+    # (or in this process if workers is 1). Chunks are consumed lazily.
+    if workers == 1:
+        _init_worker(*initargs)
+        for chunk in chunks: yield _merge_chunk(function(chunk), metrics)
+        return
+    
+    # At most 2 chunks per process are in flight, so that the jobs are consumed lazily
+    max_in_flight = 2 * (workers or os.cpu_count() or 1)
+    with Pool(processes=workers, initializer=_init_worker, initargs=initargs) as pool:
+        in_flight = deque()
+        for chunk in chunks:
+            in_flight.append(pool.apply_async(function, (chunk,)))
+            if len(in_flight) >= max_in_flight: yield _merge_chunk(in_flight.popleft().get(), metrics)
+        while in_flight: yield _merge_chunk(in_flight.popleft().get(), metrics)
+    
+
+
+### SET CANVAS
+
+def render_canvas(index, extent, zoom, path=None, band_pixels=2**24):
+    '''
+    Rasterize every polygon of the index on one canvas covering extent (e.g.
+    the tiles of a set), band after band of rows so that at most band_pixels 
+    are drawn at once.
+
+    Parameters
+    ----------
+    index : shapely.STRtree
+        Spatial index built with build_polygons_index
+    extent : tuple (west, south, east, north)
+        A whole number of pixels wide and high
+    zoom : float
+        Number of real life meters per pixel
+    path : string, optional
+        .npy file of the canvas, written through a memory map so that the 
+        canvas does not have to fit in memory. The default is None (in memory).
+    band_pixels : int, optional
+        The default is 2**24.
+
+    Returns
+    -------
+    canvas : numpy array of uint8 with shape (y, x)
+        255 where a polygon is drawn, 0 elsewhere, row 0 is the north of the extent
+    '''
+    w, s, e, n = extent
+    width, height = round((e - w) / zoom), round((n - s) / zoom)
+    if path: canvas = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(height, width))
+    else: canvas = np.zeros((height, width), dtype=np.uint8)
+    
+    rows = max(band_pixels // max(width, 1), 1)
+    buffer = np.empty((min(rows, height), width), dtype=np.uint8)
+    for top in range(0, height, rows):
+        band_height = min(rows, height - top)
+        band_extent = (w, n - (top + band_height) * zoom, w + width * zoom, n - top * zoom)
+        candidates = index.geometries.take(np.sort(index.query(box(*band_extent))))
+        band = rasterize_polygons(candidates, band_extent, zoom, (width, band_height), out=buffer[:band_height])
+        canvas[top:top + band_height] = flip_vertical(band)
+    
+    if path: canvas.flush()
+    return canvas
+
+
+def _worker_canvas(path):
+    # memory-mapped canvas, the last 2 ones stay open in the process
+    canvases = _worker.setdefault('canvases', {})
+    if path not in canvases:
+        canvases[path] = np.load(path, mmap_mode='r')
+        if len(canvases) > 2: del canvases[next(iter(canvases))]
+    return canvases[path]
+
+
+def _crop_chunk(tile_jobs):
+    metrics = Metrics() if _worker['metrics'] else None
+    width, height = _worker['img_size']
+    results = []
+    for i, canvas_path, left, top in tile_jobs:
+        coverage = np.array(_worker_canvas(canvas_path)[top:top + height, left:left + width])
+        
+        # empty masks are found on the crop, without any geometry
+        if not _worker['empty'] and not coverage.any():
+            if metrics is not None: metrics.count('empty_masks')
+            results.append((i, False))
+            continue
+        
+        path = _worker['path_format'].format(i) if _worker['path_format'] else BytesIO()
+        with timer(metrics, 'mask_encoding'):
+            save_mask(encode_mask(coverage, _worker['mode']), path, _worker['compress_level'])
+        if metrics is not None: metrics.count('masks')
+        results.append((i, True) if _worker['path_format'] else (i, path.getvalue()))
+    return results, metrics
+
+
+def _remove_canvas(path, leftovers):
+    # a canvas still mapped by a process can not be removed on Windows
+    try: os.remove(path)
+    except OSError: leftovers.append(path)
+
+
+def create_masks_from_canvas(tile_jobs, polygons, zoom, img_size, path_format, canvas_folder, empty=True, workers=None, 
+                             chunksize=32, mode='LA', compress_level=None, metrics=None, tolerance=1e-3):
+    '''
+    Same as create_masks_parallel, but the polygons are rasterized only once
+    for each group of tiles (e.g. a set), on a canvas covering the group, 
+    and every mask of the group is cropped from the canvas. With overlapping
+    tiles, each polygon is then clipped and drawn once instead of once per tile.
+    Canvases are memory-mapped files in canvas_folder, removed once their
+    masks are created.
+    Tiles of a group must be a whole number of pixels apart (see 
+    create_mesh_extents with align=True).
+    Masks are close to the ones of create_masks_parallel but not identical:
+    polygons are drawn whole on the canvas instead of clipped by each tile,
+    so pixels within one pixel of a polygon edge can be drawn differently
+    (about 0.01 to 0.2% of the pixels of a tile, tested in test_create_masks.py).
+
+    Parameters
+    ----------
+    tile_jobs : iterable of (i, extent, group)
+        Tiles of a same group must be consecutive
+    canvas_folder : string
+    tolerance : float, optional
+        Max distance to a whole pixel, in pixel. The default is 1e-3.
+    Other parameters and yields: see create_masks_parallel
+
+    '''
+    index = build_polygons_index(polygons or [])
+    os.makedirs(canvas_folder, exist_ok=True)
+    initargs = (to_wkb(np.empty(0, dtype=object)), zoom, img_size, path_format, empty, mode, compress_level, metrics is not None)
+    
+    # canvases whose masks are being created: [path, number of chunks not done]
+    canvases = deque()
+    leftovers = []
+    
+    def chunks():
+        for k, (group, jobs) in enumerate(groupby(tile_jobs, key=lambda job: job[2])):
+            jobs = list(jobs)
+            extents = np.array([job[1] for job in jobs], dtype=np.float64).reshape(-1, 4)
+            ids = [job[0] for job in jobs]
+            w, n = extents[:, 0].min(), extents[:, 3].max()
+            canvas_extent = (w, extents[:, 1].min(), extents[:, 2].max(), n)
+            
+            # pixel offset of each tile in the canvas
+            lefts = (extents[:, 0] - w) / zoom
+            tops = (n - extents[:, 3]) / zoom
+            if np.any(np.abs(lefts - np.rint(lefts)) > tolerance) or np.any(np.abs(tops - np.rint(tops)) > tolerance):
+                raise ValueError("Tiles are not aligned on whole pixels, create the mesh with align=True")
+            
+            path = os.path.join(canvas_folder, 'canvas_{}.npy'.format(k))
+            with timer(metrics, 'canvas'):
+                render_canvas(index, canvas_extent, zoom, path)
+            crops = list(zip(ids, [path] * len(ids), np.rint(lefts).astype(int).tolist(), np.rint(tops).astype(int).tolist()))
+            group_chunks = [crops[start:start + chunksize] for start in range(0, len(crops), chunksize)]
+            canvases.append([path, len(group_chunks)])
+            for chunk in group_chunks: yield chunk
+    
+    try:
+        for results in _map_chunks(_crop_chunk, chunks(), workers, initargs, metrics):
+            for result in results: yield result
+            # the canvas is removed once all its chunks are done
+            canvases[0][1] -= 1
+            if canvases[0][1] == 0: _remove_canvas(canvases.popleft()[0], leftovers)
+    finally:
+        # processes are stopped: the remaining canvases can be removed
+        _worker.pop('canvases', None)
+        for path in [canvas[0] for canvas in canvases] + leftovers:
+            try: os.remove(path)
+            except OSError: pass
     
 
 
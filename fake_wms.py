@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+import io
+import time
+import random
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+from PIL import Image
+
+
+### LOCAL STAND-IN WMS SERVER (benchmarks)
+
+def make_png(size, payload_size=None, seed=0):
+    '''
+    Create a png image of size (width, height) in pixel.
+    With payload_size (bytes), the first rows are random noise (not
+    compressible) so that the file is about payload_size bytes.
+    '''
+    width, heigth = size
+    array = np.full((heigth, width, 3), 200, dtype=np.uint8)
+    if payload_size:
+        rows = min(payload_size // (width * 3) + 1, heigth)
+        array[:rows] = np.random.default_rng(seed).integers(0, 256, (rows, width, 3), dtype=np.uint8)
+    out = io.BytesIO()
+    Image.fromarray(array).save(out, format='PNG', compress_level=1)
+    return out.getvalue()
+
+
+class FakeWMSServer:
+    '''
+    HTTP server answering WMS GetMap (and WMTS GetTile) requests with a png
+    of the requested size, after a configurable latency.
+    Runs in a background thread, use it as a context manager:
+
+        with FakeWMSServer(latency=0.05) as server:
+            getmap(session, server.url, ...)
+    '''
+
+    def __init__(self, latency=0, jitter=0, payload_size=None, error_rate=0, port=0, seed=0):
+        # latency: seconds before each response, plus up to jitter seconds at random
+        # payload_size: approximate size of the images in bytes (None = small flat images)
+        # error_rate: fraction of requests answered with http 503 (to exercise retries)
+        self.latency = latency
+        self.jitter = jitter
+        self.payload_size = payload_size
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self._random = random.Random(seed)
+        self._images = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/wms'.format(self._server.server_port)
+
+    def _image(self, size):
+        # one image per size, encoded once
+        with self._lock:
+            if size not in self._images: self._images[size] = make_png(size, self.payload_size)
+            return self._images[size]
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                params = {key.lower(): values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+                with server._lock:
+                    server.requests += 1
+                    delay = server.latency + server._random.uniform(0, server.jitter)
+                    failed = server._random.random() < server.error_rate
+                if delay: time.sleep(delay)
+
+                if failed:
+                    with server._lock: server.errors += 1
+                    self.send_response(503)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                size = (int(params.get('width', 256)), int(params.get('height', 256)))
+                content = server._image(size)
+                with server._lock: server.bytes_sent += len(content)
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
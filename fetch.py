@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
+
+# http connexion pool (keep-alive)
+import requests
+from requests.adapters import HTTPAdapter
+
+from owslib.util import ServiceException
+
+from metrics import timer
+
+
+### HTTP SESSION
+
+def create_session(pool_size=8):
+    '''
+    Create an http session keeping its connexions alive between requests
+
+    Parameters
+    ----------
+    pool_size : int, optional
+        Number of connexions kept open per host. Should be at least the
+        number of requests in flight. The default is 8.
+
+    Returns
+    -------
+    session : requests.Session
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class RateLimiter:
+    '''
+    Limit the number of requests per second sent to each host.
+    Can be shared between threads.
+    '''
+
+    def __init__(self, rate=None):
+        # rate: max requests per second per host (None or 0 = no limit)
+        self.interval = 1 / rate if rate else 0
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        if not self.interval: return
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next.get(host, now))
+            self._next[host] = slot + self.interval
+        if slot > now: time.sleep(slot - now)
+
+
+### GETMAP
+
+def getmap_params(layer, bbox, size, srs='EPSG:3857', format='image/png', version='1.1.1'):
+    # Same request as owslib WebMapService.getmap
+    return {
+        'service': 'WMS',
+        'version': version,
+        'request': 'GetMap',
+        'layers': layer,
+        'styles': '',
+        'width': str(size[0]),
+        'height': str(size[1]),
+        'srs': srs,
+        'bbox': ','.join([str(x) for x in bbox]),
+        'format': format,
+        'transparent': 'FALSE',
+        'exceptions': 'application/vnd.ogc.se_xml',
+        'bgcolor': '0xFFFFFF',
+    }
+
+
+def getmap(session, wms_url, layer, bbox, size, srs='EPSG:3857', format='image/png',
+           timeout=300, retries=3, backoff=1, rate_limiter=None, cache=None, metrics=None):
+    '''
+    Request an image from a WMS server, retrying with an exponential backoff
+    on network errors, timeouts and server errors (5xx, 429)
+
+    Parameters
+    ----------
+    session : requests.Session
+        Session created with create_session
+    wms_url : string
+    layer : string
+    bbox : tuple (west, south, east, north)
+    size : tuple of int (x, y) in pixel
+    srs : string, optional. The default is 'EPSG:3857'.
+    format : string, optional. The default is 'image/png'.
+    timeout : float, optional
+        Timeout of one request in seconds. The default is 300.
+    retries : int, optional
+        Number of retries after the first attempt. The default is 3.
+    backoff : float, optional
+        Waiting time before the first retry in seconds, doubled at each retry. The default is 1.
+    rate_limiter : RateLimiter, optional
+        The default is None.
+    cache : cache.TileCache, optional
+        Responses are read from the cache before requesting the server, 
+        and added to it. The default is None.
+    metrics : metrics.Metrics, optional
+        Records the latency of each request ('request'), requests, retries,
+        failures, cache hits and bytes received. The default is None.
+
+    Returns
+    -------
+    content : bytes
+        The image file content
+    '''
+    params = getmap_params(layer, bbox, size, srs, format)
+    return get_image(session, wms_url, params, timeout, retries, backoff, rate_limiter, cache, metrics)
+
+
+def get_image(session, url, params, timeout=300, retries=3, backoff=1, rate_limiter=None, cache=None, metrics=None):
+    '''
+    Send an OGC request (GetMap, GetTile...) and return the image content,
+    with the retries, rate limit and cache described in getmap
+    '''
+    if cache is not None:
+        # key: url and request parameters (as sent to the server)
+        key = cache.key(url, params)
+        content = cache.get(key)
+        if content is not None: 
+            if metrics is not None: metrics.count('cache_hits')
+            return content
+
+    attempt = 0
+    while True:
+        try:
+            if rate_limiter: rate_limiter.wait(url)
+            if metrics is not None: metrics.count('requests')
+            with timer(metrics, 'request'):
+                response = session.get(url, params=params, timeout=timeout)
+            # client errors (except "too many requests") won't get better by retrying
+            if response.status_code >= 500 or response.status_code == 429: response.raise_for_status()
+            if response.status_code >= 400:
+                raise ServiceException(params.get('request', 'Request') + " failed with http status " + str(response.status_code))
+            break
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError):
+            if attempt >= retries: 
+                if metrics is not None: metrics.count('request_failures')
+                raise
+            if metrics is not None: metrics.count('retries')
+            time.sleep(backoff * 2 ** attempt * (1 + random.random() * 0.1))
+            attempt += 1
+
+    # check for service exceptions
+    if response.headers.get('Content-Type', '').split(';')[0] in ['application/vnd.ogc.se_xml', 'application/xml', 'text/xml']:
+        raise ServiceException(response.text.strip())
+
+    if metrics is not None: metrics.count('bytes_in', len(response.content))
+    if cache is not None: cache.put(key, response.content)
+
+    return response.content
+
+
+### CONCURRENT FETCHING
+
+def fetch_tiles(jobs, fetch_one, max_in_flight=8, ordered=False, return_exceptions=False):
+    '''
+    Run fetch_one on every job concurrently, with at most max_in_flight
+    requests at the same time. Jobs are consumed lazily, so they can be
+    produced (e.g. masks created) while previous requests are in flight.
+
+    Parameters
+    ----------
+    jobs : iterable of (key, request)
+        key identifies the result (tile index or name), request is usually a bbox
+    fetch_one : function
+        Called with a request, returns the image content
+    max_in_flight : int, optional
+        The default is 8.
+    ordered : bool, optional
+        Yield results in the order of the jobs instead of the order of
+        completion. The default is False.
+    return_exceptions : bool, optional
+        Yield the exception raised by a failed job as its content instead of
+        raising it. The default is False.
+
+    Yields
+    ------
+    (key, content)
+    '''
+    jobs = iter(jobs)
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        pending = {}
+        order = deque()
+        done_results = {}
+        exhausted = False
+
+        while True:
+            # fill the pool (results waiting for their turn count as in flight)
+            while not exhausted and len(pending) + len(done_results) < max_in_flight:
+                try: key, request = next(jobs)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[executor.submit(fetch_one, request)] = key
+                if ordered: order.append(key)
+
+            if not pending: break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = pending.pop(future)
+                if return_exceptions and future.exception() is not None: result = future.exception()
+                else: result = future.result()
+                if ordered: done_results[key] = result
+                else: yield key, result
+
+            # yield the consecutive results already available
+            if ordered:
+                while order and order[0] in done_results:
+                    key = order.popleft()
+                    yield key, done_results.pop(key)
@@ -3,24 +3,35 @@
 
 
 #import images_from_wms as my_lib
-from create_masks import create_mask
-from mesh import create_mesh_extents, get_extents_from_sets, extents_to_shp, get_anchors_gdf_from_db
+from create_masks import create_masks_parallel, create_masks_from_canvas, build_polygons_index, plan_tiles, create_mask, encode_mask, save_mask
+from mesh import create_meshes_array, create_grid_meshes, grid_keys_to_extents, get_extents_from_sets, extents_to_file, get_anchors_gdf_from_db, get_anchors_gdf_in_boxes, get_anchors_fingerprint, explode_polygons, save_anchors_cache, load_anchors_cache, save_extents, save_meshes, load_extents, extents_to_json, get_clipped_anchors_from_db, mesh_grid, GRID_ORIGIN, partition_tiles, group_bounds
+from fetch import create_session, RateLimiter, fetch_tiles
+from sources import WMSSource, WMTSSource
+from cache import TileCache
+from metatiles import create_metatiles, fetch_metatiles
+from manifest import JobManifest, fingerprint, DONE, EMPTY, FAILED, PENDING
+from pipeline import run_pipeline
+from shards import ShardWriter, ShardReader
+from metrics import Metrics, Progress, profiled
+from pyramid import level_factor, mask_to_coverage, FineGrid, derive_tiles
+from workqueue import WorkQueue, worker_name, LEASED
 #from params import *
 
-import json
-
 import os
+import time
+import cProfile
+from io import BytesIO
+
+from functools import partial
+from itertools import groupby
 
-import pandas as pd
-import geopandas as gpd
+import numpy as np
+from PIL import Image
 
 # engine for postgis connexion:
 import psycopg2 # needed even if "unused"
 from sqlalchemy import create_engine
 
-# connexion to wms server
-from owslib.wms import WebMapService
-
 
 ### PARAMETERS
 
@@ -50,15 +61,74 @@ ENGINE = create_engine(ENGINE_PARAM)
 ### CONNEXION TO SERVER FLUX with owslib
 WMS_URL = 'https://wxs.ign.fr/essentiels/geoportail/r/wms'
 WMS_LAYER = 'GEOGRAPHICALGRIDSYSTEMS.PLANIGNV2'
+# Pre-rendered tiles of the same layer, mosaicked locally (faster and cached upstream)
+WMTS_URL = 'https://wxs.ign.fr/essentiels/geoportail/wmts'
+WMTS_LAYER = 'GEOGRAPHICALGRIDSYSTEMS.PLANIGNV2'
+IMAGERY_SOURCE = 'wms' # 'wms' (GetMap of each extent) or 'wmts' (GetTile)
 TIMEOUT = 300
+MAX_IN_FLIGHT = 8 # number of concurrent GetMap requests (or extents in wmts)
+RATE_LIMIT = 10 # max requests per second to the server (None = no limit)
+RETRIES = 3 # retries of a failed request, with exponential backoff
+BACKOFF = 1 # seconds before the first retry
+
+# Cache of the server responses, shared between projects (None = no cache)
+CACHE_PATH = 'cache/'
+CACHE_MAX_SIZE = 20 * 1024**3 # bytes, least recently used images are removed
+
+# Metatiles: request big blocks of each set and crop the tiles from them
+# (the mesh is then aligned on whole pixels, see create_mesh_extents)
+METATILES = False
+METATILE_MAX_SIZE = 2048 # max width/height accepted by the server, in pixel
 
 # Mesh parameters (tiles creation)
 TILE_SIZE = (512, 512)
 OVERLAPSE = 0.7 # between 0 and 0.99
 SAFETY = 0
+# 'sets': each set has its own mesh, from its north west corner
+# 'grid': tiles are snapped on a global grid, and shared between overlapping sets
+MESH_MODE = 'sets'
+# Coarser zoom levels derived from the images and masks of ZOOM_LEVEL (e.g. [13, 12]), 
+# each with its own mesh and output folder, without requesting their images again
+PYRAMID_LEVELS = []
+# Tiles of a level whose anchors are loaded together from db, when they are not in memory
+# (partitioned run, anchors clipped in db): only its tiles not covered by ZOOM_LEVEL need them
+PYRAMID_ANCHORS_BLOCK = 1024
 
 EMPTY_MASKS = False
 
+# Number of sets processed at a time, with only the anchors of their tiles loaded from db
+# (memory depends on the biggest partition instead of the whole database). None = every set at once
+PARTITION_SETS = None
+
+# Several machines building one project: None (one process), 'coordinator' (mesh the sets and
+# fill the work queue, then stop) or 'worker' (claim batches of tiles from the queue until it is
+# empty). Workers write in the same PROJECT_PATH (shared folder), tile indexes come from the queue
+ROLE = None
+# Queue table next to deepmapdraw.sets, or create_engine('sqlite:///queue.sqlite', connect_args={'timeout': 30}) on one host
+QUEUE_ENGINE = ENGINE
+QUEUE_BATCH_SIZE = 256 # tiles claimed at a time by a worker
+QUEUE_LEASE = 600 # seconds before the tiles of a silent worker are given to another one
+QUEUE_HEARTBEAT = 60 # seconds between two renewals of the leases of a worker
+QUEUE_MAX_ATTEMPTS = 3 # claims of a tile before it is failed
+QUEUE_POLL = 30 # seconds between two claims while other workers hold the last tiles
+
+# Clip anchors by each tile in PostGIS instead of loading every anchor in python
+CLIP_IN_DB = False
+MASK_WORKERS = None # processes creating masks (None = every core, 1 = no pool)
+# 'tiles': polygons are clipped and drawn for each tile
+# 'sets': polygons are drawn once on a canvas of each set, and masks are cropped from it 
+# (faster with a big overlapse, needs the anchors in python: CLIP_IN_DB = False)
+MASK_RENDER = 'tiles'
+# Mask encoding: 'LA' (legacy), 'L' (single channel), '1' (1 bit png) or 'npy' (bit-packed numpy array)
+MASK_MODE = 'LA'
+MASK_COMPRESS_LEVEL = None # png zlib level from 0 to 9 (None = PIL default)
+MASK_SUFFIX = '_mask.npy' if MASK_MODE == 'npy' else '_mask.png'
+QUEUE_SIZE = 64 # tiles waiting between two stages of the pipeline
+PROGRESS_INTERVAL = 5 # seconds between two progress lines
+# Profile one stage of the pipeline: None, 'masks' (with MASK_WORKERS = 1 to see 
+# the rasterization), 'images' or 'writer'. Open the file with pstats or snakeviz
+PROFILE_STAGE = None
+
 
 ### PATHS 
 
@@ -73,13 +143,132 @@ PROJECT_PATH = PROJECTS_FOLDER + 'pign_z14_s512_ol70_noempty/'
 
 # Extents
 ANCHORS_SHP_PATH = PROJECT_PATH + 'shp/anchors_' + BASEMAP + '_z' + str(ZOOM_LEVEL) + '.shp'
-SET_EXTENTS_SHP_PATH = PROJECT_PATH + 'shp/set_extents_' + BASEMAP + '_z' + str(ZOOM_LEVEL) + '.shp'
-TILE_EXTENTS_SHP_PATH = PROJECT_PATH + 'shp/tile_extents_' + BASEMAP + '_z' + str(ZOOM_LEVEL) + '.shp'
+EXPORT_ANCHORS_SHP = False # shapefile of the anchors (debug)
+# Exploded anchors polygons, shared between the projects of a zoom level and basemap,
+# reloaded as long as the anchors do not change in db (None = always load from db)
+ANCHORS_CACHE_PATH = PROJECTS_FOLDER + 'anchors_' + BASEMAP + '_z' + str(ZOOM_LEVEL) + '.parquet'
+# GIS export of the extents: 'fgb' (FlatGeobuf), 'gpkg', 'parquet' (GeoParquet) or 'shp', None = no export
+EXTENTS_FORMAT = 'fgb'
+SET_EXTENTS_GIS_PATH = PROJECT_PATH + 'shp/set_extents_' + BASEMAP + '_z' + str(ZOOM_LEVEL) + '.' + str(EXTENTS_FORMAT)
+TILE_EXTENTS_GIS_PATH = PROJECT_PATH + 'shp/tile_extents_' + BASEMAP + '_z' + str(ZOOM_LEVEL) + '.' + str(EXTENTS_FORMAT)
+TILE_EXTENTS_PATH = PROJECT_PATH + 'tile_extents_' + BASEMAP + '_z' + str(ZOOM_LEVEL) + '.npy'
+TILE_KEYS_PATH = PROJECT_PATH + 'tile_keys_' + BASEMAP + '_z' + str(ZOOM_LEVEL) + '.npy' # (zoom, col, row) in grid mode
 TILE_EXTENTS_JSON_PATH = PROJECT_PATH + 'tile_extents_' + BASEMAP + '_z' + str(ZOOM_LEVEL) + '.json'
+EXPORT_JSON = False # human-readable copy of the tile extents (debug)
+# State of each tile, to resume an interrupted run
+MANIFEST_PATH = PROJECT_PATH + 'manifest.sqlite'
 # Outputs
 OUTPUT_IMG_PATH =  PROJECT_PATH +'images'
 OUTPUT_TARGET_PATH =  PROJECT_PATH +'targets'
+# Output as tar shards of image/mask pairs instead of images and targets folders
+OUTPUT_SHARDS = False
+OUTPUT_SHARDS_PATH = PROJECT_PATH + 'shards'
+SHARD_SIZE = 4096 # samples per shard
+# Counters and latencies of the run
+METRICS_PATH = PROJECT_PATH + 'metrics.json'
+PROFILE_PATH = PROJECT_PATH + 'profile.prof'
+# Memory-mapped set canvases (MASK_RENDER = 'sets'), removed once their masks are created
+CANVAS_PATH = PROJECT_PATH + 'canvas/'
+
+
 
+def create_pyramid_level(zoom_level, set_extents, tile_extents, tile_set_ids, statuses, fetch_image, index, metrics):
+    '''
+    Create the images and masks of a coarser zoom level from the ones of 
+    ZOOM_LEVEL, in PROJECT_PATH + 'z{zoom_level}/'. Tiles that are not 
+    covered by the tiles of ZOOM_LEVEL (borders of the sets, failed images) 
+    are requested at zoom_level, and their mask rendered from index (or from
+    the anchors loaded from db around them if index is None).
+    '''
+    factor = level_factor(SRS, ZOOM_LEVEL, zoom_level)
+    level_path = PROJECT_PATH + 'z' + str(zoom_level) + '/'
+    for folder in ['images', 'targets']: os.makedirs(level_path + folder, exist_ok=True)
+    print("Create zoom level", zoom_level, "from zoom level", ZOOM_LEVEL)
+    
+    # Tiles of ZOOM_LEVEL on their grid: one grid per set, or the global grid
+    step = (max(round(TILE_SIZE[0] * (1 - OVERLAPSE)), 1), max(round(TILE_SIZE[1] * (1 - OVERLAPSE)), 1))
+    tile_ids = np.arange(1, len(tile_extents) + 1)
+    if MESH_MODE == 'grid':
+        grids = {0: FineGrid(GRID_ORIGIN, step, TILE_SIZE, ZOOM, tile_extents, tile_ids)}
+    else:
+        grids = {}
+        for set_id in np.unique(tile_set_ids).tolist():
+            origin = mesh_grid(set_extents[set_id], OVERLAPSE, SAFETY, TILE_SIZE, SRS, ZOOM_LEVEL, align=True)[0]
+            in_set = tile_set_ids == set_id
+            grids[set_id] = FineGrid(origin, step, TILE_SIZE, ZOOM, tile_extents[in_set], tile_ids[in_set])
+    
+    # Mesh of the level
+    if MESH_MODE == 'grid':
+        level_keys, level_set_ids = create_grid_meshes(set_extents, OVERLAPSE, SAFETY, TILE_SIZE, SRS, zoom_level)
+        level_extents = grid_keys_to_extents(level_keys, OVERLAPSE, TILE_SIZE, SRS)
+        groups = np.zeros(len(level_extents), dtype=np.int64)
+    else:
+        level_extents, level_set_ids = create_meshes_array(set_extents, OVERLAPSE, SAFETY, TILE_SIZE, SRS, zoom_level, align=True)
+        groups = level_set_ids
+    save_extents(level_path + 'tile_extents_' + BASEMAP + '_z' + str(zoom_level) + '.npy', level_extents, level_set_ids, 
+                 zoom_level=zoom_level, basemap=BASEMAP, tile_size=TILE_SIZE, overlapse=OVERLAPSE, safety=SAFETY, 
+                 align=True, mesh_mode=MESH_MODE, derived_from=ZOOM_LEVEL)
+    
+    # Images and masks of ZOOM_LEVEL
+    reader = ShardReader(OUTPUT_SHARDS_PATH) if OUTPUT_SHARDS else None
+    
+    def load_image(i):
+        if statuses.get(i, (PENDING, PENDING))[1] != DONE: return None
+        if reader is not None: return np.asarray(reader.load(i)[0].convert('RGB'))
+        with Image.open(OUTPUT_IMG_PATH + '/' + str(i) + '.png') as image: return np.asarray(image.convert('RGB'))
+    
+    def load_mask(i):
+        mask_status, image_status = statuses.get(i, (PENDING, PENDING))
+        if mask_status == EMPTY: return np.zeros((TILE_SIZE[1], TILE_SIZE[0]), dtype=bool)
+        if mask_status != DONE: return None
+        if reader is not None: 
+            if image_status != DONE: return None
+            return mask_to_coverage(reader.load(i)[1], TILE_SIZE[0])
+        path = OUTPUT_TARGET_PATH + '/' + str(i) + MASK_SUFFIX
+        if MASK_MODE == 'npy': return mask_to_coverage(np.load(path), TILE_SIZE[0])
+        with Image.open(path) as mask: return mask_to_coverage(mask, TILE_SIZE[0])
+    
+    # Anchors of a tile of the level: index, or the anchors of its block of tiles loaded from db
+    blocks = {}
+    def tile_index(i):
+        if index is not None: return index
+        block = (i - 1) // PYRAMID_ANCHORS_BLOCK
+        if block not in blocks:
+            blocks.clear()
+            in_block = slice(block * PYRAMID_ANCHORS_BLOCK, (block + 1) * PYRAMID_ANCHORS_BLOCK)
+            boxes = group_bounds(level_extents[in_block], level_set_ids[in_block])
+            with metrics.timer('db_load'):
+                anchors_gdf = get_anchors_gdf_in_boxes(ENGINE, boxes, ZOOM_LEVEL, BASEMAP)
+            blocks[block] = build_polygons_index(explode_polygons(anchors_gdf.geometry.to_crs(3857)))
+        return blocks[block]
+    
+    # Tiles not covered: requested at the level zoom
+    def fallback(i, extent, size):
+        coverage = mask_to_coverage(create_mask(extent, None, SRS[zoom_level], size, BytesIO(), index=tile_index(i), mode='L'), size[0])
+        if not EMPTY_MASKS and not coverage.any(): return None, coverage
+        metrics.count('pyramid_requests')
+        try: return Image.open(BytesIO(fetch_image(extent, size))), coverage
+        except Exception as error:
+            print("\nTile", i, "of zoom level", zoom_level, "failed:", error)
+            return None, None
+    
+    jobs = ((i, level_extents[i - 1], groups[i - 1]) for i in range(1, len(level_extents) + 1))
+    progress = Progress(len(level_extents), PROGRESS_INTERVAL)
+    for i, image, coverage in derive_tiles(jobs, grids, factor, TILE_SIZE, load_image, load_mask, fallback, empty=EMPTY_MASKS):
+        progress.update()
+        if coverage is None:
+            metrics.count('pyramid_failed')
+            continue
+        if image is None: 
+            metrics.count('pyramid_empty')
+            continue
+        
+        metrics.count('pyramid_tiles')
+        image.save(level_path + 'images/' + str(i) + '.png')
+        mask = encode_mask(np.where(coverage, 255, 0).astype(np.uint8), MASK_MODE)
+        save_mask(mask, level_path + 'targets/' + str(i) + MASK_SUFFIX, MASK_COMPRESS_LEVEL)
+    progress.close()
+    if reader is not None: reader.close()
 
 
 def main():
@@ -89,101 +278,379 @@ def main():
     
     
     
-    ### EXTENTS
+    if MASK_RENDER == 'sets' and CLIP_IN_DB:
+        raise ValueError("MASK_RENDER = 'sets' needs the anchors in python, set CLIP_IN_DB = False")
+    if ROLE == 'worker' and (OUTPUT_SHARDS or PYRAMID_LEVELS):
+        raise ValueError("Workers write images and masks files: set OUTPUT_SHARDS = False and PYRAMID_LEVELS = []")
     
-    print("Retrieve set extents from db")
-    set_extents = get_extents_from_sets(ENGINE, ZOOM_LEVEL, BASEMAP)
-    print(len(set_extents), "set extents loaded")
+    # Counters and latencies of every stage, saved at the end of the run
+    metrics = Metrics()
     
-    # Optional
-    print("Create set extents shapefile")
-    extents_to_shp(set_extents, SET_EXTENTS_SHP_PATH)
+    # Parameters the tiles depend on (they key the manifest, and the project in the work queue)
+    os.makedirs(PROJECT_PATH, exist_ok=True)
+    params = {'zoom_level': ZOOM_LEVEL, 'basemap': BASEMAP, 'tile_size': TILE_SIZE, 'overlapse': OVERLAPSE, 
+              'safety': SAFETY, 'empty_masks': EMPTY_MASKS, 'metatiles': METATILES, 'mask_mode': MASK_MODE, 
+              'mesh_mode': MESH_MODE, 'imagery_source': IMAGERY_SOURCE, 'output_shards': OUTPUT_SHARDS}
+    if IMAGERY_SOURCE == 'wmts': params.update({'wmts_url': WMTS_URL, 'wmts_layer': WMTS_LAYER})
+    else: params.update({'wms_url': WMS_URL, 'wms_layer': WMS_LAYER})
+    project = os.path.basename(os.path.normpath(PROJECT_PATH)) + '-' + fingerprint(params)[:16]
     
-    print("Create tile extents from set extents")
-    tile_extents = []
-    for set_extent in set_extents:
-        mesh = create_mesh_extents(set_extent, OVERLAPSE, SAFETY, TILE_SIZE, SRS, ZOOM_LEVEL, verbose=False)
-        for tile_extent in mesh: tile_extents.append(tile_extent)
-    print(len(tile_extents), "tile extents created")
+    if ROLE == 'worker':
+        # Tiles leased from the work queue, which also records their status instead of the manifest:
+        # extents and sets are copied from the queue as the tiles are claimed
+        manifest = queue = WorkQueue(QUEUE_ENGINE, project, worker_name(), QUEUE_LEASE, QUEUE_HEARTBEAT, QUEUE_MAX_ATTEMPTS)
+        nb_tiles = queue.size()
+        if not nb_tiles: raise ValueError("No tile in the work queue of project " + project + ", run a coordinator first")
+        tile_extents = np.zeros((nb_tiles, 4), dtype=np.float64)
+        tile_set_ids = np.zeros(nb_tiles, dtype=np.int64)
+        print(queue.worker, "joined project", project, queue.counts())
     
-    # Optional
-    print("Create tile extents shapefile")
-    extents_to_shp(tile_extents, TILE_EXTENTS_SHP_PATH)
+    else:
+        ### EXTENTS
     
-    # Need to do it only once
-    print("Create tile extents json in tests folder")
-    with open(TILE_EXTENTS_JSON_PATH, 'w') as f:
-        json.dump(tile_extents, f, indent=2) # indent=2 is not needed but makes the file human-readable
-        
+        print("Retrieve set extents from db")
+        with metrics.timer('db_load'):
+            set_extents = get_extents_from_sets(ENGINE, ZOOM_LEVEL, BASEMAP)
+        print(len(set_extents), "set extents loaded")
     
-    # load extents
-    print("Loading extents...")
-    with open(TILE_EXTENTS_JSON_PATH, 'r') as f:
-        tile_extents = json.load(f)
-    print(len(tile_extents), " extents loaded")
+        # Optional
+        if EXTENTS_FORMAT:
+            print("Export set extents")
+            with metrics.timer('shapefiles'):
+                extents_to_file(set_extents, SET_EXTENTS_GIS_PATH, set_id=np.arange(len(set_extents)))
+    
+        print("Create tile extents from set extents")
+        # (N, 4) array of tile extents, and set of each tile
+        # (aligned on whole pixels to crop metatiles or masks from a set canvas, or to derive the pyramid levels)
+        align = METATILES or MASK_RENDER == 'sets' or bool(PYRAMID_LEVELS)
+        header = {'zoom_level': ZOOM_LEVEL, 'basemap': BASEMAP, 'tile_size': TILE_SIZE, 'overlapse': OVERLAPSE, 
+                  'safety': SAFETY, 'mesh_mode': MESH_MODE}
+        with metrics.timer('mesh'):
+            if MESH_MODE == 'grid':
+                tile_keys, tile_set_ids = create_grid_meshes(set_extents, OVERLAPSE, SAFETY, TILE_SIZE, SRS, ZOOM_LEVEL)
+                tile_extents = grid_keys_to_extents(tile_keys, OVERLAPSE, TILE_SIZE, SRS)
+                np.save(TILE_KEYS_PATH, tile_keys)
+                # Need to do it only once
+                save_extents(TILE_EXTENTS_PATH, tile_extents, tile_set_ids, align=align, **header)
+                del tile_keys
+            else:
+                # written chunk by chunk, the tiles of all the sets are never in memory together
+                save_meshes(TILE_EXTENTS_PATH, set_extents, OVERLAPSE, SAFETY, TILE_SIZE, SRS, ZOOM_LEVEL, align, header)
+    
+        # load extents (memory-mapped)
+        print("Loading extents...")
+        tile_extents, tile_set_ids, _ = load_extents(TILE_EXTENTS_PATH)
+        print(len(tile_extents), "tile extents created")
+    
+        # Optional
+        if EXPORT_JSON:
+            print("Create tile extents json")
+            extents_to_json(tile_extents, TILE_EXTENTS_JSON_PATH)
+    
+        # The coordinator only fills the queue, the tiles are created by the workers
+        if ROLE == 'coordinator':
+            queue = WorkQueue(QUEUE_ENGINE, project)
+            queue.fill(tile_extents, tile_set_ids)
+            print("Work queue of project " + project + ":", queue.counts())
+            queue.close()
+            return print("Job is done, start the workers")
+    
+        # Tiles already done in a previous run with the same parameters are skipped
+        manifest = JobManifest(MANIFEST_PATH, params)
+        manifest.set_tiles(tile_extents)
+        print(manifest.count(image=DONE) + manifest.count(mask=EMPTY), "tiles already done")
         
     
     
     ### LOAD ANCHORS AND SIMPLIFY MULTIPOLYGONS
     
-    # Load anchors polygons (and multipolygons) from db
-    print("Load anchors from db")
-    anchors_gdf = get_anchors_gdf_from_db(ENGINE, ZOOM_LEVEL, BASEMAP)
+    # Every anchor of the zoom level and basemap
+    def load_anchors():
+        # Exploded anchors polygons from the cache, if the anchors did not change in db
+        polygons = None
+        if ANCHORS_CACHE_PATH:
+            with metrics.timer('db_load'):
+                fingerprint = get_anchors_fingerprint(ENGINE, ZOOM_LEVEL, BASEMAP)
+            with metrics.timer('anchors_cache'):
+                polygons = load_anchors_cache(ANCHORS_CACHE_PATH, zoom_level=ZOOM_LEVEL, basemap=BASEMAP, fingerprint=fingerprint)
+            if polygons is not None: 
+                print("Anchors loaded from cache")
+                return polygons
+        
+        # Load anchors polygons (and multipolygons) from db
+        print("Load anchors from db")
+        with metrics.timer('db_load'):
+            anchors_gdf = get_anchors_gdf_from_db(ENGINE, ZOOM_LEVEL, BASEMAP)
+        
+        # Multipolygons to polygons
+        polygons = explode_polygons(anchors_gdf.geometry.to_crs(3857))
+        if ANCHORS_CACHE_PATH:
+            os.makedirs(os.path.dirname(ANCHORS_CACHE_PATH) or '.', exist_ok=True)
+            save_anchors_cache(ANCHORS_CACHE_PATH, polygons, zoom_level=ZOOM_LEVEL, basemap=BASEMAP, fingerprint=fingerprint)
     
-    # Create anchors shapefile (optional)
-    print("Create anchors shapefile")
-    anchors_gdf.to_file(ANCHORS_SHP_PATH)
+        # Create anchors shapefile (optional)
+        if EXPORT_ANCHORS_SHP:
+            print("Create anchors shapefile")
+            with metrics.timer('shapefiles'):
+                anchors_gdf.to_file(ANCHORS_SHP_PATH)
+        return polygons
     
-    # Load anchors as gdf from shp (or from db)
-    print("Loading polygons from shapefile")
-    anchors_gdf = gpd.read_file(ANCHORS_SHP_PATH)
-    geometries = anchors_gdf.geometry.to_crs(3857)
+    # Anchors of the tiles of a partition only: one bounding box of the tiles per set
+    def load_partition_anchors(tile_ids):
+        boxes = group_bounds(tile_extents[tile_ids - 1], tile_set_ids[tile_ids - 1])
+        with metrics.timer('db_load'):
+            anchors_gdf = get_anchors_gdf_in_boxes(ENGINE, boxes, ZOOM_LEVEL, BASEMAP)
+        return explode_polygons(anchors_gdf.geometry.to_crs(3857))
     
-    # Multipolygons to polygons
-    polygons = []
-    for geometry in geometries:
-        if geometry.geom_type == 'Polygon': polygons.append(geometry)
-        if geometry.geom_type == 'MultiPolygon':
-            for poly in geometry.geoms: polygons.append(poly)    
-    print(len(polygons), "polygons loaded")
+    # (not needed if anchors are clipped in the database, loaded by partition if the sets are 
+    # partitioned or by batch of claimed tiles in a worker)
+    partitioned = bool(PARTITION_SETS) or ROLE == 'worker'
+    polygons = None
+    if not CLIP_IN_DB and not partitioned:
+        polygons = load_anchors()
+        print(len(polygons), "polygons loaded")
     
     
     
     ### IMAGES AND MASKS CREATION
     
      
-    # Connexion to WMS server (image creation)
-    print("Connexion to wms server...")
-    wms = WebMapService(WMS_URL, timeout=TIMEOUT)
-    if not wms: return print("Connexion failed, process aborted.")
-    else: print("Connected to " + WMS_URL) 
+    # Connexion pool to WMS/WMTS server (image creation)
+    print("Connexion to " + IMAGERY_SOURCE + " server...")
+    # in wmts, each extent needs several tiles, requested by a pool of the source
+    pool_size = MAX_IN_FLIGHT * 4 if IMAGERY_SOURCE == 'wmts' else MAX_IN_FLIGHT
+    session = create_session(pool_size=pool_size)
+    cache = TileCache(CACHE_PATH, CACHE_MAX_SIZE) if CACHE_PATH else None
+    request_params = {'timeout': TIMEOUT, 'retries': RETRIES, 'backoff': BACKOFF, 
+                      'rate_limiter': RateLimiter(RATE_LIMIT), 'cache': cache, 'metrics': metrics}
+    if IMAGERY_SOURCE == 'wmts':
+        source = WMTSSource(session, WMTS_URL, WMTS_LAYER, ZOOM_LEVEL, SRS, max_in_flight=pool_size, **request_params)
+    else:
+        source = WMSSource(session, WMS_URL, WMS_LAYER, 
+                           srs='EPSG:3857', # Pseudo Mercator
+                           format='image/png', 
+                           **request_params)
+    fetch_image = source.get
+    fetch_one = partial(fetch_image, size=TILE_SIZE)
+    
+    
+    # Pipeline: extents -> masks -> images -> files, each stage in its own thread
+    
+    # Anchors of each tile, clipped in the database (tiles without anchors get no polygons)
+    def clipped_extents():
+        clipped = get_clipped_anchors_from_db(ENGINE, ((i, tile_extents[i - 1]) for i in todo), ZOOM_LEVEL, BASEMAP)
+        next_clipped = next(clipped, None)
+        for i in todo:
+            wkbs = []
+            if next_clipped is not None and next_clipped[0] == i: 
+                wkbs = next_clipped[1]
+                next_clipped = next(clipped, None)
+            yield i, tile_extents[i - 1], wkbs
+    
+    # Group of a tile for set canvases and metatiles: its set, or in grid mode (tiles sorted by 
+    # row then column, the sets are interleaved on each row) its band of rows as high as a metatile
+    grid_step = (max(round(TILE_SIZE[0] * (1 - OVERLAPSE)), 1), max(round(TILE_SIZE[1] * (1 - OVERLAPSE)), 1))
+    band_rows = max((METATILE_MAX_SIZE - TILE_SIZE[1] + 1) // grid_step[1], 1)
+    block_cols = max((METATILE_MAX_SIZE - TILE_SIZE[0] + 1) // grid_step[0], 1)
+    def tile_group(i):
+        if MESH_MODE != 'grid': return tile_set_ids[i - 1]
+        return int(round((GRID_ORIGIN[1] - tile_extents[i - 1][3]) / (grid_step[1] * ZOOM))) // band_rows
+    
+    # Tiles with the key of their canvas. A band spans the whole project: in grid mode it is split 
+    # in blocks of columns (its tiles reordered block by block), so that a canvas covers its tiles only
+    def canvas_jobs(jobs):
+        if MESH_MODE != 'grid':
+            for i, extent in jobs: yield i, extent, tile_group(i)
+            return
+        for band, band_jobs in groupby(jobs, key=lambda job: tile_group(job[0])):
+            blocks = [(int(round((tile_extents[i - 1][0] - GRID_ORIGIN[0]) / (grid_step[0] * ZOOM))) // block_cols, i, extent) 
+                      for i, extent in band_jobs]
+            blocks.sort(key=lambda job: job[:2])
+            for block, i, extent in blocks: yield i, extent, (band, block)
+    
+    # masks waiting for their image, in shards output
+    masks = {}
+    
+    # (canvases of several workers of a host in their own folder)
+    canvas_path = CANVAS_PATH + queue.worker + '/' if ROLE == 'worker' else CANVAS_PATH
+    
+    ### Create masks (pool of processes)
+    def render_masks(jobs):
+        path_format = None if OUTPUT_SHARDS else OUTPUT_TARGET_PATH + '/{}' + MASK_SUFFIX
+        if MASK_RENDER == 'sets':
+            # one canvas per set, or per block of a band of rows in grid mode (see canvas_jobs)
+            created = create_masks_from_canvas(canvas_jobs(jobs), polygons, ZOOM, TILE_SIZE, path_format, canvas_path, empty=EMPTY_MASKS, 
+                                               workers=MASK_WORKERS, mode=MASK_MODE, compress_level=MASK_COMPRESS_LEVEL, metrics=metrics)
+        else:
+            created = create_masks_parallel(jobs, polygons, ZOOM, TILE_SIZE, path_format, empty=EMPTY_MASKS, workers=MASK_WORKERS, 
+                                            mode=MASK_MODE, compress_level=MASK_COMPRESS_LEVEL, metrics=metrics, planned=planned)
+        for i, mask in created:
+            manifest.set_mask(i, DONE if mask else EMPTY)
+            
+            # if mask is False it means it wasn't created, thus we don't create the corresponding image
+            if not mask : 
+                progress.update()
+                continue
+            
+            if OUTPUT_SHARDS: masks[i] = mask
+            
+            yield i, tile_extents[i - 1] # Enveloppe West South East North # Attention il faut respecter les proportions de size
+    
+    ### Create images (concurrent requests)
+    def fetch_images(jobs):
+        if not METATILES: return fetch_tiles(jobs, fetch_one, max_in_flight=MAX_IN_FLIGHT, return_exceptions=True)
+        
+        # Metatiles of each group of tiles (see tile_group), planned once the masks of the group are created
+        def metatile_jobs():
+            for group, group_jobs in groupby(jobs, key=lambda job: tile_group(job[0])):
+                for metatile in create_metatiles(list(group_jobs), TILE_SIZE, ZOOM, METATILE_MAX_SIZE):
+                    yield metatile
+        return fetch_metatiles(metatile_jobs(), fetch_image, max_in_flight=MAX_IN_FLIGHT, return_exceptions=True)
+    
+    ### Write images
+    shards = ShardWriter(OUTPUT_SHARDS_PATH, SHARD_SIZE, MASK_SUFFIX) if OUTPUT_SHARDS else None
+    
+    # Optional profiling of one stage
+    profile = cProfile.Profile() if PROFILE_STAGE else None
+    stages = {'masks': render_masks, 'images': fetch_images}
+    if PROFILE_STAGE in stages: stages[PROFILE_STAGE] = profiled(stages[PROFILE_STAGE], profile)
+    if PROFILE_STAGE == 'writer': profile.enable()
     
+    # Tiles claimed from the work queue by batches, until every tile is done
+    def claimed_batches():
+        while True:
+            queue.commit()
+            tile_ids, extents, set_ids = queue.claim(QUEUE_BATCH_SIZE)
+            if not len(tile_ids):
+                # tiles of other workers are claimed again if their lease expires
+                if not queue.counts().get(LEASED): return
+                time.sleep(QUEUE_POLL)
+                continue
+            tile_extents[tile_ids - 1] = extents
+            tile_set_ids[tile_ids - 1] = set_ids
+            yield tile_ids
     
-    # Loop
-    i = 0
-    for tile_extent in tile_extents:
-        i += 1
+    # Tiles of every set at once, or PARTITION_SETS sets at a time: only the anchors 
+    # of a partition are in memory, and released before the next one
+    if ROLE == 'worker': partitions = claimed_batches()
+    elif PARTITION_SETS: partitions = partition_tiles(tile_set_ids, PARTITION_SETS)
+    else: partitions = [np.arange(1, len(tile_extents) + 1)]
+    
+    # Empty masks are found before any rendering, with one query on the anchors index
+    # (the candidate polygons of each tile are then given to the mask processes)
+    plan = not EMPTY_MASKS and not CLIP_IN_DB
+    nonempty = np.zeros(len(tile_extents), dtype=bool) if plan else None
+    planned = plan and MASK_RENDER == 'tiles'
+    
+    for partition, tile_ids in enumerate(partitions):
+        if not len(tile_ids): continue
+        if partitioned:
+            set_ids = np.unique(tile_set_ids[tile_ids - 1])
+            print("Batch" if ROLE == 'worker' else "Partition", partition + 1, ": sets", int(set_ids[0]), "to", int(set_ids[-1]), "(" + str(len(tile_ids)), "tiles)")
+            metrics.count('partitions')
+            if not CLIP_IN_DB:
+                polygons = load_partition_anchors(tile_ids)
+                print(len(polygons), "polygons loaded")
         
-        print("Creation of image and mask number ", i, " out of ", len(tile_extents))
+        if plan:
+            print("Planning tiles")
+            with metrics.timer('planning'):
+                nonempty[tile_ids - 1], offsets, candidates = plan_tiles(tile_extents[tile_ids - 1], build_polygons_index(polygons))
+            print(int(nonempty[tile_ids - 1].sum()), "tiles with anchors out of", len(tile_ids))
         
-        ### Create mask
-        path = OUTPUT_TARGET_PATH + '/' + str(i) + '_mask.png'
-        mask = create_mask(tile_extent, polygons, ZOOM, TILE_SIZE, img_path=path, verbose=False, empty=EMPTY_MASKS)
+        # skip tiles done in a previous run, and empty ones
+        statuses = manifest.statuses(tile_ids)
+        todo, positions = [], []
+        for k, i in enumerate(tile_ids.tolist()):
+            mask_status, image_status = statuses.get(i, (PENDING, PENDING))
+            if mask_status == EMPTY or image_status == DONE: continue
+            if plan and not nonempty[i - 1]:
+                manifest.set_mask(i, EMPTY)
+                continue
+            todo.append(i)
+            positions.append(k)
+        manifest.commit()
+        del statuses
+        print(len(todo), "images and masks to create")
+        if CLIP_IN_DB: extents = clipped_extents()
+        elif planned: extents = ((i, tile_extents[i - 1], candidates[offsets[k]:offsets[k + 1]]) for i, k in zip(todo, positions))
+        else: extents = ((i, tile_extents[i - 1]) for i in todo)
         
-        # if mask is False it means it wasn't created, thus we don't create the corresponding image
-        if not mask : continue
+        progress = Progress(len(todo), PROGRESS_INTERVAL)
         
-        ### Create image
-        img = wms.getmap(   layers = [WMS_LAYER],
-                            srs = 'EPSG:3857', # Pseudo Mercator
-                            bbox = tile_extent, # Enveloppe West South East North # Attention il faut respecter les proportions de size
-                            size = TILE_SIZE, 
-                            format='image/png',
-                            timeout=TIMEOUT
-                            )
-        path = OUTPUT_IMG_PATH + '/' + str(i) + '.png'
-        out = open(path, 'wb')
-        out.write(img.read())
-        out.close()
+        for i, img in run_pipeline(extents, [stages['masks'], stages['images']], maxsize=QUEUE_SIZE):
+            progress.update()
+            
+            # failed images are retried on next run
+            if isinstance(img, Exception):
+                print("\nImage number ", i, " failed: ", img)
+                metrics.count('tiles_failed')
+                manifest.set_image(i, FAILED)
+                if OUTPUT_SHARDS: masks.pop(i)
+                continue
+            
+            metrics.count('tiles_done')
+            with metrics.timer('write'):
+                # samples are done once their shard is closed
+                if OUTPUT_SHARDS:
+                    mask = masks.pop(i)
+                    metrics.count('bytes_out', len(img) + len(mask))
+                    for k in shards.write(i, img, mask): manifest.set_image(k, DONE)
+                    continue
+                
+                path = OUTPUT_IMG_PATH + '/' + str(i) + '.png'
+                out = open(path, 'wb')
+                out.write(img)
+                out.close()
+                metrics.count('bytes_out', len(img))
+                manifest.set_image(i, DONE)
+        progress.close()
+        
+        # release the plan and the anchors of the partition
+        offsets = candidates = None
+        if partitioned: polygons = None
+    
+    if OUTPUT_SHARDS:
+        with metrics.timer('write'):
+            for k in shards.close(): manifest.set_image(k, DONE)
+    
+    if PROFILE_STAGE: 
+        profile.disable()
+        profile.dump_stats(PROFILE_PATH)
+        print("Profile of the " + PROFILE_STAGE + " stage saved in " + PROFILE_PATH)
+    
+    # Optional (tiles are empty if they have no anchors, when it is known)
+    if EXTENTS_FORMAT and ROLE != 'worker':
+        print("Export tile extents")
+        columns = {'tile': np.arange(1, len(tile_extents) + 1), 'set_id': tile_set_ids}
+        if plan: columns['empty'] = ~nonempty
+        with metrics.timer('shapefiles'):
+            extents_to_file(tile_extents, TILE_EXTENTS_GIS_PATH, **columns)
+    
+
+    ### PYRAMID
+    
+    if PYRAMID_LEVELS:
+        statuses = manifest.statuses()
+        # (without anchors in memory, they are loaded for the tiles not covered by ZOOM_LEVEL, see create_pyramid_level)
+        index = build_polygons_index(polygons) if polygons is not None else None
+        for zoom_level in PYRAMID_LEVELS:
+            with metrics.timer('pyramid'):
+                create_pyramid_level(zoom_level, set_extents, tile_extents, tile_set_ids, statuses, fetch_image, index, metrics)
+    
+    # folder of the canvases of this worker (empty, canvases are removed once their masks are created)
+    if ROLE == 'worker' and os.path.isdir(canvas_path): os.rmdir(canvas_path)
+    
+    failed = manifest.count(image=FAILED)
+    manifest.close()
+    source.close()
+    if failed: print(failed, "images failed, run again to retry them")
+    
+    if cache is not None: print("Cache:", cache.stats())
+    
+    # (one file per worker, workers of a project run at the same time)
+    metrics_path = os.path.splitext(METRICS_PATH)[0] + '_' + queue.worker + '.json' if ROLE == 'worker' else METRICS_PATH
+    metrics.save(metrics_path)
+    print("Metrics saved in " + metrics_path)
         
     return print("Job is done")
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import json
+import hashlib
+import sqlite3
+import threading
+
+import numpy as np
+
+
+### JOB MANIFEST
+
+# Status of a mask or an image
+PENDING = 'pending'
+DONE = 'done'
+EMPTY = 'empty' # mask not created because it is empty: no image needed
+FAILED = 'failed'
+
+
+def fingerprint(obj):
+    # Hash of any json serializable object
+    text = json.dumps(obj, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class JobManifest:
+    '''
+    Record of the state of each tile of a project (extent, mask status and
+    image status) in a sqlite file, to resume an interrupted run.
+    The whole manifest is reset if the parameters or the tile extents changed.
+    Status updates can be made from several threads.
+    '''
+
+    def __init__(self, path, params, commit_every=100):
+        # path: sqlite file, created if it does not exist
+        # params: dict of the parameters the tiles depend on
+        # commit_every: number of status updates between two commits
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS tiles ("
+            "idx INTEGER PRIMARY KEY, w REAL, s REAL, e REAL, n REAL, "
+            "mask TEXT NOT NULL DEFAULT 'pending', image TEXT NOT NULL DEFAULT 'pending')")
+        self.commit_every = commit_every
+        self._updates = 0
+        self._check('params', fingerprint(params))
+
+    def _check(self, key, value):
+        # Reset the tiles if the stored value is different
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row is not None and row[0] == value: return True
+        if row is not None: print("Manifest: " + key + " changed, previous work is discarded")
+        self.connection.execute("DELETE FROM tiles")
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+        self.connection.commit()
+        return False
+
+    def set_tiles(self, tile_extents, chunk_size=65536):
+        '''
+        Register the tile extents (tile i is the i-th extent, starting at 1).
+        Previous statuses are kept if the extents did not change.
+        '''
+        # (by chunks, tile_extents can be a memory-mapped array bigger than memory)
+        tiles_hash = hashlib.sha256()
+        for start in range(0, len(tile_extents), chunk_size):
+            tiles_hash.update(np.ascontiguousarray(tile_extents[start:start + chunk_size], dtype=np.float64).tobytes())
+        if self._check('tiles', tiles_hash.hexdigest()) and self.count(): return
+        self.connection.execute("DELETE FROM tiles")
+        for start in range(0, len(tile_extents), chunk_size):
+            chunk = np.asarray(tile_extents[start:start + chunk_size], dtype=np.float64).tolist()
+            self.connection.executemany(
+                "INSERT INTO tiles (idx, w, s, e, n) VALUES (?, ?, ?, ?, ?)",
+                ((i, w, s, e, n) for i, (w, s, e, n) in enumerate(chunk, start=start + 1)))
+        self.connection.commit()
+
+    def count(self, mask=None, image=None):
+        query = "SELECT count(*) FROM tiles WHERE (? IS NULL OR mask = ?) AND (? IS NULL OR image = ?)"
+        return self.connection.execute(query, (mask, mask, image, image)).fetchone()[0]
+
+    def status(self, i):
+        '''
+        Return (mask status, image status) of tile i
+        '''
+        row = self.connection.execute("SELECT mask, image FROM tiles WHERE idx = ?", (i,)).fetchone()
+        return tuple(row) if row else (PENDING, PENDING)
+
+    def statuses(self, tile_ids=None, chunk_size=900):
+        '''
+        Return a dict {tile index: (mask status, image status)}, 
+        of the tiles tile_ids only if they are given (queried by chunks)
+        '''
+        if tile_ids is None:
+            rows = self.connection.execute("SELECT idx, mask, image FROM tiles")
+            return {i: (mask, image) for i, mask, image in rows}
+        tile_ids = [int(i) for i in tile_ids]
+        statuses = {}
+        for start in range(0, len(tile_ids), chunk_size):
+            chunk = tile_ids[start:start + chunk_size]
+            query = "SELECT idx, mask, image FROM tiles WHERE idx IN (" + ", ".join("?" * len(chunk)) + ")"
+            statuses.update((i, (mask, image)) for i, mask, image in self.connection.execute(query, chunk))
+        return statuses
+
+    def set_mask(self, i, status):
+        self._update("UPDATE tiles SET mask = ? WHERE idx = ?", (status, i))
+
+    def set_image(self, i, status):
+        self._update("UPDATE tiles SET image = ? WHERE idx = ?", (status, i))
+
+    def _update(self, query, args):
+        with self._lock:
+            self.connection.execute(query, args)
+            self._updates += 1
+            if self._updates >= self.commit_every: self._commit()
+
+    def _commit(self):
+        self.connection.commit()
+        self._updates = 0
+
+    def commit(self):
+        with self._lock: self._commit()
+
+    def close(self):
+        self.commit()
+        self.connection.close()
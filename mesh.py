@@ -1,20 +1,49 @@
 # -*- coding: utf-8 -*-
 
+import os
+import json
+from itertools import islice
+
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 
-from shapely import box
+import shapely
+from sqlalchemy import text
 
 ### GET DATA FROM DB
-def query_to_df(query, engine):
-    return pd.read_sql(query, engine)
+def query_to_df(query, engine, params=None):
+    return pd.read_sql(text(query), engine, params=params)
     
-def query_to_gdf(query, engine, geom_col="geom"):
-    return gpd.GeoDataFrame.from_postgis(query, engine, geom_col="geom")
+def query_to_gdf(query, engine, geom_col="geom", params=None):
+    return gpd.GeoDataFrame.from_postgis(text(query), engine, geom_col="geom", params=params)
 
 
 ### CREATION OF TILES EXTENTS
 
+def extents_to_file(extents, path, **columns):
+    '''
+    Export extents as boxes (EPSG:3857) to a GIS file with a spatial index,
+    the boxes are created with one vectorized call.
+    The format comes from the extension of path: '.fgb' (FlatGeobuf), 
+    '.gpkg' (GeoPackage), '.parquet' (GeoParquet, with a bbox column) or 
+    '.shp' (shapefile, limited to 2 GB).
+
+    Parameters
+    ----------
+    extents : array of shape (N, 4)
+        (west, south, east, north)
+    path : string
+    **columns : arrays of shape (N,)
+        Attributes of each extent (tile index, set id, empty...)
+    '''
+    extents = np.asarray(extents, dtype=np.float64).reshape(-1, 4)
+    boxes = shapely.box(extents[:, 0], extents[:, 1], extents[:, 2], extents[:, 3])
+    gdf = gpd.GeoDataFrame(columns, geometry=boxes, crs="EPSG:3857")
+    if path.endswith('.parquet'): gdf.to_parquet(path, index=False, write_covering_bbox=True)
+    else: gdf.to_file(path, engine='pyogrio', use_arrow=True, SPATIAL_INDEX='YES')
+
+
 def extents_to_shp(extents, path):
     '''
     Create a shapefile from a list of extent tuples (W, S, E, N)
@@ -26,22 +55,171 @@ def extents_to_shp(extents, path):
     path : string
         path and name of the shapefile
     '''
-    # Create extent polygons
-    polygons = []
-    for extent in extents:
-        w, s, e, n = extent
-        poly = box(w, s, e, n)
-        polygons.append(poly)
-    # Add them to the geoserie
-    s = gpd.GeoSeries(polygons, crs="EPSG:3857")
-    # Save to shapefile
-    s.to_file(path)
+    extents_to_file(extents, path)
     
 
+### STORAGE OF TILES EXTENTS
+
+# one record per tile: its extent and the index of its set extent
+TILES_DTYPE = np.dtype([('extent', np.float64, (4,)), ('set_id', np.int64)])
+
+
+def _header_path(path):
+    return path + '.json'
+
+
+def save_extents(path, extents, set_ids=None, **header):
+    '''
+    Save tile extents in a binary .npy file that can be memory-mapped,
+    with a small json header next to it (path + '.json')
+
+    Parameters
+    ----------
+    path : string
+        path and name of the .npy file
+    extents : array of shape (N, 4)
+        (west, south, east, north)
+    set_ids : array of int with shape (N,), optional
+        Set of each tile. The default is None (set 0).
+    **header : 
+        Parameters of the mesh (zoom_level, basemap, tile_size, overlapse...)
+    '''
+    tiles = np.zeros(len(extents), dtype=TILES_DTYPE)
+    tiles['extent'] = extents
+    if set_ids is not None: tiles['set_id'] = set_ids
+    np.save(path, tiles)
+    
+    header['count'] = len(tiles)
+    with open(_header_path(path), 'w') as f:
+        json.dump(header, f, indent=2)
+
+
+def load_extents(path):
+    '''
+    Load tile extents saved with save_extents, without copying them in memory
+
+    Returns
+    -------
+    extents : read-only array of shape (N, 4)
+    set_ids : read-only array of int with shape (N,)
+    header : dict
+    '''
+    tiles = np.load(path, mmap_mode='r')
+    with open(_header_path(path), 'r') as f:
+        header = json.load(f)
+    if header.get('count') != len(tiles):
+        raise ValueError(path + " does not match its header")
+    return tiles['extent'], tiles['set_id'], header
+
+
+def save_meshes(path, canvas_extents, overlapse, safety, size, srs, zoom_level, align=False, header=None):
+    '''
+    Same as save_extents(path, *create_meshes_array(...), align=align, **header), 
+    but the tiles are written chunk by chunk (see iter_mesh_array) in the 
+    memory-mapped file: the mesh is never fully in memory
+
+    Returns
+    -------
+    count : int
+        Number of tiles
+    '''
+    count = 0
+    for canvas_extent in canvas_extents:
+        nb_tiles_width, nb_tiles_heigth = mesh_grid(canvas_extent, overlapse, safety, size, srs, zoom_level, align)[3]
+        count += nb_tiles_width * nb_tiles_heigth
+    
+    tiles = np.lib.format.open_memmap(path, mode='w+', dtype=TILES_DTYPE, shape=(count,))
+    start = 0
+    for extents, set_ids in iter_mesh_array(canvas_extents, overlapse, safety, size, srs, zoom_level, align):
+        tiles['extent'][start:start + len(extents)] = extents
+        tiles['set_id'][start:start + len(extents)] = set_ids
+        start += len(extents)
+    tiles.flush()
+    del tiles
+    
+    header = dict(header or {}, align=align, count=count)
+    with open(_header_path(path), 'w') as f:
+        json.dump(header, f, indent=2)
+    return count
+
+
+def extents_to_json(extents, path):
+    # human-readable export of extents, for debugging
+    with open(path, 'w') as f:
+        json.dump(np.asarray(extents).tolist(), f, indent=2)
+
+
+### ANCHORS CACHE
+
+def explode_polygons(geometries):
+    '''
+    Polygons of the anchors: multipolygons are split into their polygons
+    (vectorized), other geometry types are dropped
+
+    Returns
+    -------
+    polygons : list of polygons
+    '''
+    geometries = np.asarray(geometries, dtype=object)
+    types = shapely.get_type_id(geometries)
+    return list(shapely.get_parts(geometries[(types == 3) | (types == 6)]))
+
+
+def save_anchors_cache(path, polygons, **header):
+    '''
+    Save exploded polygons (EPSG:3857) in a GeoParquet file, with a small json
+    header next to it (path + '.json'). The file is written atomically, and
+    the header last: a cache without header is never used.
+
+    Parameters
+    ----------
+    path : string
+        path and name of the .parquet file
+    polygons : list of polygons
+    **header : 
+        Key of the cache (zoom_level, basemap, fingerprint...)
+    '''
+    if os.path.exists(_header_path(path)): os.remove(_header_path(path))
+    tmp_path = path + '.tmp'
+    gpd.GeoDataFrame(geometry=polygons, crs=3857).to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    
+    header['count'] = len(polygons)
+    with open(_header_path(path), 'w') as f:
+        json.dump(header, f, indent=2)
+
+
+def load_anchors_cache(path, **key):
+    '''
+    Load polygons saved with save_anchors_cache (the parquet file is memory-mapped)
+
+    Parameters
+    ----------
+    path : string
+    **key : 
+        Expected header values (zoom_level, basemap, fingerprint...)
+
+    Returns
+    -------
+    polygons : list of polygons, or None if there is no cache or if its key differs
+    '''
+    try:
+        with open(_header_path(path), 'r') as f:
+            header = json.load(f)
+    except FileNotFoundError:
+        return None
+    if any(header.get(name) != value for name, value in key.items()): return None
+    
+    geometries = gpd.read_parquet(path, memory_map=True).geometry.values
+    if len(geometries) != header.get('count'):
+        raise ValueError(path + " does not match its header")
+    return list(np.asarray(geometries))
+
+
 def get_extents_from_sets(engine, zoom_level, basemap):
     # Create dataframe from sets table in db (where are the maps information)
-    query = "SELECT * FROM deepmapdraw.sets WHERE zoom = {} AND basemap = '{}'".format(zoom_level, basemap)
-    sets_df = query_to_df(query, engine)
+    query = "SELECT * FROM deepmapdraw.sets WHERE zoom = :zoom AND basemap = :basemap"
+    sets_df = query_to_df(query, engine, params={'zoom': zoom_level, 'basemap': basemap})
     
     # Create an index column to iterate on retrieved sets without problem
     sets_df = sets_df.reset_index() 
@@ -57,34 +235,260 @@ def get_extents_from_sets(engine, zoom_level, basemap):
     
 def get_anchors_gdf_from_db(engine, zoom_level, basemap):
     # Create dataframe from sets table in db (where are the maps information)
-    query = "SELECT * FROM deepmapdraw.anchors WHERE zoom = {} AND basemap = '{}'".format(zoom_level, basemap)
-    return query_to_gdf(query, engine)
+    query = "SELECT * FROM deepmapdraw.anchors WHERE zoom = :zoom AND basemap = :basemap"
+    return query_to_gdf(query, engine, params={'zoom': zoom_level, 'basemap': basemap})
 
-    
 
-def create_mesh_extents(canvas_extent, overlapse, safety, size, srs, zoom_level, verbose=False):
-    # take one set extent from mapdraw and cut tiles extent inside it 
-    srs[zoom_level]
-    if verbose: print("Construction du mesh...")
-    if verbose: print("Marge de sécurité: ", safety)
-    
+# Anchors intersecting at least one of the boxes (EPSG:3857), e.g. the tiles
+# of a partition of the sets. As in CLIPPED_ANCHORS_QUERY, the boxes are
+# transformed to the anchors srid for the index filter.
+ANCHORS_IN_BOXES_QUERY = '''
+WITH boxes AS (
+    SELECT ST_Transform(ST_MakeEnvelope(b.w, b.s, b.e, b.n, 3857), Find_SRID('deepmapdraw', 'anchors', 'geom')) AS box
+    FROM unnest(CAST(:w AS float8[]), CAST(:s AS float8[]), CAST(:e AS float8[]), CAST(:n AS float8[])) AS b(w, s, e, n)
+)
+SELECT a.* FROM deepmapdraw.anchors a
+WHERE a.zoom = :zoom AND a.basemap = :basemap
+AND EXISTS (SELECT 1 FROM boxes WHERE a.geom && boxes.box)
+'''
+
+def get_anchors_gdf_in_boxes(engine, boxes, zoom_level, basemap):
+    # Same as get_anchors_gdf_from_db, only the anchors whose bounding box hits one of the boxes (west, south, east, north)
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    params = {'zoom': zoom_level, 'basemap': basemap}
+    for k, name in enumerate(['w', 's', 'e', 'n']): params[name] = boxes[:, k].tolist()
+    return query_to_gdf(ANCHORS_IN_BOXES_QUERY, engine, params=params)
+
+
+# Cheap fingerprint of the anchors of a zoom level and basemap: it changes when
+# anchors are added or removed (count) or written again (xmin, id of the last
+# transaction that wrote the row, exists in every table)
+ANCHORS_FINGERPRINT_QUERY = '''
+SELECT count(*), max(CAST(CAST(xmin AS text) AS bigint))
+FROM deepmapdraw.anchors WHERE zoom = :zoom AND basemap = :basemap
+'''
+
+def get_anchors_fingerprint(engine, zoom_level, basemap):
+    # [number of anchors, last write transaction], see load_anchors_cache
+    with engine.connect() as connection:
+        count, last_xid = connection.execute(text(ANCHORS_FINGERPRINT_QUERY), {'zoom': zoom_level, 'basemap': basemap}).one()
+    return [int(count), None if last_xid is None else int(last_xid)]
+
+
+# Anchors of each tile, clipped by the tile box in the database.
+# The tile box is transformed to the anchors srid for the index filter (a box
+# in EPSG:3857 is a box in EPSG:4326 too), anchors are clipped in EPSG:3857.
+# ST_ClipByBox2D can return invalid polygons (they make shapely fail in
+# create_mask): anchors are made valid and intersected, only polygons are kept.
+CLIPPED_ANCHORS_QUERY = '''
+WITH tiles AS (
+    SELECT t.idx, ST_MakeEnvelope(t.w, t.s, t.e, t.n, 3857) AS box
+    FROM unnest(CAST(:idx AS bigint[]), CAST(:w AS float8[]), CAST(:s AS float8[]), 
+                CAST(:e AS float8[]), CAST(:n AS float8[])) AS t(idx, w, s, e, n)
+), srid AS (
+    SELECT Find_SRID('deepmapdraw', 'anchors', 'geom') AS srid
+), clipped AS (
+    SELECT tiles.idx, ST_CollectionExtract(ST_Intersection(ST_MakeValid(ST_Transform(a.geom, 3857)), tiles.box), 3) AS geom
+    FROM tiles, srid, deepmapdraw.anchors a
+    WHERE a.zoom = :zoom AND a.basemap = :basemap
+    AND a.geom && ST_Transform(tiles.box, srid.srid)
+)
+SELECT idx, ST_AsBinary(geom) AS wkb FROM clipped 
+WHERE NOT ST_IsEmpty(geom)
+ORDER BY idx
+'''
+
+def get_clipped_anchors_from_db(engine, tile_jobs, zoom_level, basemap, batch_size=10000):
+    '''
+    Clip the anchors by every tile in the database, with one set-based query
+    per batch of tiles. Rows are streamed with a server-side cursor.
+
+    Parameters
+    ----------
+    engine : sqlalchemy engine
+    tile_jobs : iterable of (i, extent)
+        Tile index and extent (west, south, east, north) in EPSG:3857, 
+        by increasing index
+    zoom_level : int
+    basemap : string
+    batch_size : int, optional
+        Number of tiles sent in one query. The default is 10000.
+
+    Yields
+    ------
+    (i, wkbs) : (int, list of bytes)
+        Clipped anchors (WKB, EPSG:3857) of tile i, by increasing index. 
+        Tiles without anchors are not yielded.
+    '''
+    tile_jobs = iter(tile_jobs)
+    with engine.connect() as connection:
+        connection = connection.execution_options(stream_results=True)
+        while True:
+            batch = [(int(i), [float(x) for x in extent]) for i, extent in islice(tile_jobs, batch_size)]
+            if not batch: return
+            params = {'zoom': zoom_level, 'basemap': basemap, 'idx': [i for i, extent in batch]}
+            for k, name in enumerate(['w', 's', 'e', 'n']): params[name] = [extent[k] for i, extent in batch]
+            
+            result = connection.execute(text(CLIPPED_ANCHORS_QUERY), params)
+            current, wkbs = None, []
+            for idx, wkb in result:
+                if idx != current and wkbs: yield current, wkbs
+                if idx != current: current, wkbs = idx, []
+                wkbs.append(bytes(wkb))
+            if wkbs: yield current, wkbs
+
+
+def mesh_grid(canvas_extent, overlapse, safety, size, srs, zoom_level, align=False):
+    '''
+    Geometry of the mesh of one set extent
+
+    Parameters
+    ----------
+    canvas_extent : tuple (west, south, east, north)
+    overlapse : float between 0 and 0.99
+    safety : float
+        Safety margin, as a fraction of the canvas size
+    size : tuple of int (x, y)
+        Tile size in pixel
+    srs : dict
+        Resolution (m/px) of each zoom level
+    zoom_level : int
+    align : bool, optional
+        Round the step between two tiles to a whole number of pixels, so that
+        tiles can be sliced from a bigger image (see metatiles.py). The default is False.
+
+    Returns
+    -------
+    grid : tuple
+        (west, north) of the first tile, (tile width, tile heigth) and 
+        (step width, step heigth) in meters, (number of tiles in width, in heigth)
+    '''
     # west, south, east, north of the canvas
     wc, sc, ec, nc = canvas_extent
     
     # Calcul de la taille de la zone de travail en enlevant la marge de sécurité
     canvas_width = abs(ec - wc) * (1 - (safety * 2))
     canvas_heigth = abs(nc - sc) * (1 - (safety * 2))
-    if verbose: print("Largeur de la zone de travail: ", canvas_width)
-    if verbose: print("Hauteur de la zone de travail: ", canvas_heigth)
     
     # Calcule de la taille IRL d'une maille, selon le zoom désiré
     zoom = srs[zoom_level]
     tile_width = size[0] * zoom
     tile_heigth = size[1] * zoom
     
+    # Pas entre deux mailles, selon l'overlapse
+    step_width = tile_width * (1 - overlapse)
+    step_heigth = tile_heigth * (1 - overlapse)
+    if align:
+        step_width = max(round(size[0] * (1 - overlapse)), 1) * zoom
+        step_heigth = max(round(size[1] * (1 - overlapse)), 1) * zoom
+    
     # Calcul du nombre de maille qu'on peut mettre en abscisses et en ordonnées, en prenant en compte l'overlapse
-    nb_tiles_width = int((canvas_width - tile_width) / (tile_width * (1 - overlapse))) + 1
-    nb_tiles_heigth = int((canvas_heigth - tile_heigth) / (tile_heigth * (1 - overlapse))) + 1
+    nb_tiles_width = max(int((canvas_width - tile_width) / step_width) + 1, 0)
+    nb_tiles_heigth = max(int((canvas_heigth - tile_heigth) / step_heigth) + 1, 0)
+    
+    origin = (wc + (safety * canvas_width), nc - (safety * canvas_heigth))
+    return origin, (tile_width, tile_heigth), (step_width, step_heigth), (nb_tiles_width, nb_tiles_heigth)
+
+
+### GLOBAL GRID
+
+# North west corner of the EPSG:3857 world (origin of the WMTS tile matrices)
+GRID_ORIGIN = (-20037508.342789244, 20037508.342789244)
+
+
+def grid_steps(overlapse, size, srs, zoom_level):
+    # step between two tiles of the global grid, a whole number of pixels
+    zoom = srs[zoom_level]
+    return max(round(size[0] * (1 - overlapse)), 1) * zoom, max(round(size[1] * (1 - overlapse)), 1) * zoom
+
+
+def create_grid_keys(canvas_extent, overlapse, safety, size, srs, zoom_level):
+    '''
+    Tiles of the global grid that fit in one set extent. The grid is snapped
+    on GRID_ORIGIN with a step of a whole number of pixels, so that two sets 
+    covering the same place share the same tiles.
+
+    Returns
+    -------
+    keys : numpy array of int64 with shape (N, 3)
+        (zoom, col, row) of each tile, from left to right then from top to bottom
+    '''
+    wc, sc, ec, nc = canvas_extent
+    canvas_width = abs(ec - wc) * (1 - (safety * 2))
+    canvas_heigth = abs(nc - sc) * (1 - (safety * 2))
+    w = wc + (safety * canvas_width)
+    n = nc - (safety * canvas_heigth)
+    
+    zoom = srs[zoom_level]
+    step_width, step_heigth = grid_steps(overlapse, size, srs, zoom_level)
+    tolerance = 1e-6
+    
+    # first and last col/row whose tile is inside the canvas
+    col_min = int(np.ceil((w - GRID_ORIGIN[0]) / step_width - tolerance))
+    col_max = int(np.floor((w + canvas_width - size[0] * zoom - GRID_ORIGIN[0]) / step_width + tolerance))
+    row_min = int(np.ceil((GRID_ORIGIN[1] - n) / step_heigth - tolerance))
+    row_max = int(np.floor((GRID_ORIGIN[1] - (n - canvas_heigth) - size[1] * zoom) / step_heigth + tolerance))
+    
+    cols = np.arange(col_min, col_max + 1)
+    rows = np.arange(row_min, row_max + 1)
+    keys = np.empty((len(cols) * len(rows), 3), dtype=np.int64)
+    keys[:, 0] = zoom_level
+    keys[:, 1] = np.tile(cols, len(rows))
+    keys[:, 2] = np.repeat(rows, len(cols))
+    return keys
+
+
+def create_grid_meshes(canvas_extents, overlapse, safety, size, srs, zoom_level):
+    '''
+    Tiles of the global grid covered by a batch of set extents, each one only
+    once even if several sets cover it
+
+    Returns
+    -------
+    keys : numpy array of int64 with shape (N, 3)
+        (zoom, col, row) of each tile, sorted by row then col
+    set_ids : numpy array of int with shape (N,)
+        First set extent covering each tile
+    '''
+    meshes = [create_grid_keys(canvas_extent, overlapse, safety, size, srs, zoom_level) for canvas_extent in canvas_extents]
+    if not meshes: return np.empty((0, 3), dtype=np.int64), np.empty(0, dtype=np.int64)
+    keys = np.concatenate(meshes)
+    set_ids = np.repeat(np.arange(len(meshes)), [len(mesh) for mesh in meshes])
+    
+    # sort by row, col, then set, and keep the first occurrence of each key
+    order = np.lexsort((set_ids, keys[:, 1], keys[:, 2]))
+    keys, set_ids = keys[order], set_ids[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = np.any(keys[1:] != keys[:-1], axis=1)
+    return keys[first], set_ids[first]
+
+
+def grid_keys_to_extents(keys, overlapse, size, srs):
+    '''
+    Extents (west, south, east, north) of global grid tiles, as a (N, 4) array
+    '''
+    keys = np.asarray(keys).reshape(-1, 3)
+    extents = np.empty((len(keys), 4), dtype=np.float64)
+    for zoom_level in np.unique(keys[:, 0]):
+        level = keys[:, 0] == zoom_level
+        zoom = srs[int(zoom_level)]
+        step_width, step_heigth = grid_steps(overlapse, size, srs, int(zoom_level))
+        extents[level, 0] = GRID_ORIGIN[0] + keys[level, 1] * step_width
+        extents[level, 3] = GRID_ORIGIN[1] - keys[level, 2] * step_heigth
+        extents[level, 2] = extents[level, 0] + size[0] * zoom
+        extents[level, 1] = extents[level, 3] - size[1] * zoom
+    return extents
+
+
+def create_mesh_extents(canvas_extent, overlapse, safety, size, srs, zoom_level, verbose=False, align=False):
+    # take one set extent from mapdraw and cut tiles extent inside it 
+    # align: the step between two tiles is rounded to a whole number of pixels,
+    # so that tiles can be sliced from a bigger image (see metatiles.py)
+    if verbose: print("Construction du mesh...")
+    if verbose: print("Marge de sécurité: ", safety)
+    
+    grid = mesh_grid(canvas_extent, overlapse, safety, size, srs, zoom_level, align)
+    (wo, no), (tile_width, tile_heigth), (step_width, step_heigth), (nb_tiles_width, nb_tiles_heigth) = grid
     if verbose: print("Nombre de mailles en largeur: ", nb_tiles_width)
     if verbose: print("Nombre de mailles en hauteur: ", nb_tiles_heigth)
     
@@ -94,8 +498,8 @@ def create_mesh_extents(canvas_extent, overlapse, safety, size, srs, zoom_level,
     # On parcourt la map de gauche à droite puis de haut en bas
     for y in range(nb_tiles_heigth):
         for x in range(nb_tiles_width):
-            w = wc + (safety * canvas_width) + x * tile_width * (1 - overlapse)
-            n = nc - (safety * canvas_heigth) - y * tile_heigth * (1 - overlapse)
+            w = wo + x * step_width
+            n = no - y * step_heigth
             e = w + tile_width
             s = n - tile_heigth
             extent = [w, s, e, n]
@@ -117,6 +521,101 @@ def create_mesh_extents(canvas_extent, overlapse, safety, size, srs, zoom_level,
     return extents
 
 
+def _mesh_rows(grid, first_row, last_row):
+    # extents of the tiles of rows [first_row, last_row[ of a mesh grid, as a (N, 4) array
+    (wo, no), (tile_width, tile_heigth), (step_width, step_heigth), (nb_tiles_width, nb_tiles_heigth) = grid
+    w = wo + np.arange(nb_tiles_width) * step_width
+    n = no - np.arange(first_row, last_row) * step_heigth
+    
+    # same order as create_mesh_extents: from left to right, then from top to bottom
+    extents = np.empty((len(n) * nb_tiles_width, 4), dtype=np.float64)
+    extents[:, 0] = np.tile(w, len(n))
+    extents[:, 3] = np.repeat(n, nb_tiles_width)
+    extents[:, 2] = extents[:, 0] + tile_width
+    extents[:, 1] = extents[:, 3] - tile_heigth
+    return extents
+
+
+def create_mesh_array(canvas_extent, overlapse, safety, size, srs, zoom_level, align=False):
+    '''
+    Same as create_mesh_extents, but return a (N, 4) float64 array 
+    of (west, south, east, north) extents
+    '''
+    grid = mesh_grid(canvas_extent, overlapse, safety, size, srs, zoom_level, align)
+    return _mesh_rows(grid, 0, grid[3][1])
+
+
+def create_meshes_array(canvas_extents, overlapse, safety, size, srs, zoom_level, align=False):
+    '''
+    Mesh a batch of set extents
+
+    Returns
+    -------
+    extents : numpy array of float64 with shape (N, 4)
+        (west, south, east, north) of every tile, set after set
+    set_ids : numpy array of int with shape (N,)
+        Index of the set extent of each tile
+    '''
+    meshes = [create_mesh_array(canvas_extent, overlapse, safety, size, srs, zoom_level, align) for canvas_extent in canvas_extents]
+    if not meshes: return np.empty((0, 4), dtype=np.float64), np.empty(0, dtype=np.int64)
+    set_ids = np.repeat(np.arange(len(meshes)), [len(mesh) for mesh in meshes])
+    return np.concatenate(meshes), set_ids
+
+
+def iter_mesh_array(canvas_extents, overlapse, safety, size, srs, zoom_level, align=False, chunk_size=65536):
+    '''
+    Lazy version of create_meshes_array for very large canvases: yield 
+    (extents, set_ids) chunks of at most chunk_size tiles (at least one row 
+    of tiles), in the same order
+    '''
+    for set_id, canvas_extent in enumerate(canvas_extents):
+        grid = mesh_grid(canvas_extent, overlapse, safety, size, srs, zoom_level, align)
+        nb_tiles_width, nb_tiles_heigth = grid[3]
+        if nb_tiles_width == 0: continue
+        rows = max(chunk_size // nb_tiles_width, 1)
+        for first_row in range(0, nb_tiles_heigth, rows):
+            extents = _mesh_rows(grid, first_row, min(first_row + rows, nb_tiles_heigth))
+            yield extents, np.full(len(extents), set_id, dtype=np.int64)
+
+
+
+### PARTITIONS OF THE SETS
+
+def partition_tiles(set_ids, sets_per_partition):
+    '''
+    Split the tiles by groups of sets_per_partition consecutive sets
+
+    Parameters
+    ----------
+    set_ids : array of int with shape (N,)
+        Set of each tile
+    sets_per_partition : int
+
+    Yields
+    ------
+    tile_ids : numpy array of int
+        Tiles (index starting at 1, increasing) of a partition. 
+        Partitions without tiles are skipped.
+    '''
+    set_ids = np.asarray(set_ids)
+    order = np.argsort(set_ids, kind='stable')
+    sorted_set_ids = set_ids[order]
+    if not len(sorted_set_ids): return
+    for first in range(0, int(sorted_set_ids[-1]) + 1, sets_per_partition):
+        start, stop = np.searchsorted(sorted_set_ids, [first, first + sets_per_partition])
+        if stop > start: yield np.sort(order[start:stop]) + 1
+
+
+def group_bounds(extents, groups):
+    # (west, south, east, north) bounds of the extents of each group, as a (G, 4) array (groups in increasing order)
+    extents = np.asarray(extents, dtype=np.float64).reshape(-1, 4)
+    keys, inverse = np.unique(np.asarray(groups), return_inverse=True)
+    bounds = np.empty((len(keys), 4), dtype=np.float64)
+    bounds[:, :2], bounds[:, 2:] = np.inf, -np.inf
+    for k in range(2):
+        np.minimum.at(bounds[:, k], inverse, extents[:, k])
+        np.maximum.at(bounds[:, k + 2], inverse, extents[:, k + 2])
+    return bounds
 
 
 ################## TESTS ##################
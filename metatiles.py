@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+from io import BytesIO
+
+from PIL import Image
+
+from fetch import fetch_tiles
+
+
+### METATILES PLANNING
+
+def create_metatiles(tile_jobs, tile_size, zoom, max_size=2048, tolerance=1e-3):
+    '''
+    Group the tiles of one set into metatiles: big aligned blocks requested
+    once to the server, from which every tile is cropped.
+    Tiles must be a whole number of pixels apart (see create_mesh_extents
+    with align=True), otherwise the crops would not be pixel-exact.
+
+    Parameters
+    ----------
+    tile_jobs : list of (key, extent)
+        Tiles of one set mesh, extent is (west, south, east, north)
+    tile_size : tuple of int (x, y) in pixel
+    zoom : float
+        Number of real life meters per pixel
+    max_size : int, optional
+        Max width and height of a metatile in pixel (max size accepted by the
+        server). The default is 2048.
+    tolerance : float, optional
+        Max distance to a whole pixel, in pixel. The default is 1e-3.
+
+    Returns
+    -------
+    metatiles : list of (extent, size, crops)
+        extent of the metatile (west, south, east, north), its size in pixel,
+        and crops: list of (key, box) where box is the (left, upper, right, lower)
+        pixel box of the tile inside the metatile image
+
+    '''
+    if not tile_jobs: return []
+    if max_size < max(tile_size):
+        raise ValueError("max_size must be at least the tile size")
+
+    # Origin of the mesh: north west corner
+    w0 = min(extent[0] for key, extent in tile_jobs)
+    n0 = max(extent[3] for key, extent in tile_jobs)
+
+    # Pixel offset of each tile from the origin
+    offsets = []
+    for key, extent in tile_jobs:
+        x = (extent[0] - w0) / zoom
+        y = (n0 - extent[3]) / zoom
+        if abs(x - round(x)) > tolerance or abs(y - round(y)) > tolerance:
+            raise ValueError("Tiles are not aligned on whole pixels, create the mesh with align=True")
+        offsets.append((key, round(x), round(y)))
+
+    # Each tile goes to the block containing its north west corner,
+    # blocks are small enough so that their tiles fit in max_size
+    block_width = max_size - tile_size[0] + 1
+    block_heigth = max_size - tile_size[1] + 1
+    blocks = {}
+    for key, x, y in offsets:
+        blocks.setdefault((y // block_heigth, x // block_width), []).append((key, x, y))
+
+    metatiles = []
+    for block_key in sorted(blocks):
+        tiles = blocks[block_key]
+        # Window of the metatile: union of its tiles
+        left = min(x for key, x, y in tiles)
+        upper = min(y for key, x, y in tiles)
+        width = max(x for key, x, y in tiles) + tile_size[0] - left
+        heigth = max(y for key, x, y in tiles) + tile_size[1] - upper
+
+        w = w0 + left * zoom
+        n = n0 - upper * zoom
+        extent = (w, n - heigth * zoom, w + width * zoom, n)
+
+        crops = []
+        for key, x, y in tiles:
+            crops.append((key, (x - left, y - upper, x - left + tile_size[0], y - upper + tile_size[1])))
+        metatiles.append((extent, (width, heigth), crops))
+
+    return metatiles
+
+
+### METATILES FETCHING
+
+def slice_metatile(content, crops, format='PNG'):
+    '''
+    Crop every tile out of a metatile image
+
+    Parameters
+    ----------
+    content : bytes
+        Metatile image file content
+    crops : list of (key, box)
+    format : string, optional
+        Format of the tile files. The default is 'PNG'.
+
+    Returns
+    -------
+    tiles : list of (key, content)
+    '''
+    metatile = Image.open(BytesIO(content))
+    metatile.load()
+    tiles = []
+    for key, crop_box in crops:
+        out = BytesIO()
+        metatile.crop(crop_box).save(out, format=format)
+        tiles.append((key, out.getvalue()))
+    return tiles
+
+
+def fetch_metatiles(metatiles, fetch_image, max_in_flight=8, return_exceptions=False):
+    '''
+    Request metatiles concurrently and yield the tiles cropped from them
+
+    Parameters
+    ----------
+    metatiles : iterable of (extent, size, crops)
+        As returned by create_metatiles
+    fetch_image : function
+        Called with (extent, size), returns the image content
+    max_in_flight : int, optional
+        The default is 8.
+    return_exceptions : bool, optional
+        Yield the exception raised by a failed metatile as the content of 
+        each of its tiles instead of raising it. The default is False.
+
+    Yields
+    ------
+    (key, content)
+    '''
+    def fetch_one(metatile):
+        extent, size, crops = metatile
+        return slice_metatile(fetch_image(extent, size), crops)
+
+    jobs = ((metatile[2], metatile) for metatile in metatiles)
+    for crops, tiles in fetch_tiles(jobs, fetch_one, max_in_flight=max_in_flight, return_exceptions=return_exceptions):
+        if isinstance(tiles, Exception): tiles = [(key, tiles) for key, crop_box in crops]
+        for key, content in tiles: yield key, content
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+
+### METRICS
+
+# Upper bounds of the latency histogram buckets: 10 per decade from 1 µs to 1000 s
+BUCKETS = 10 ** np.arange(-6, 3.05, 0.1)
+
+
+class Histogram:
+    '''
+    Latency histogram with fixed logarithmic buckets: memory does not grow
+    with the number of values, percentiles are precise to about 25%
+    '''
+
+    def __init__(self):
+        self.counts = np.zeros(len(BUCKETS) + 1, dtype=np.int64)
+        self.count = 0
+        self.total = 0.
+        self.min = float('inf')
+        self.max = 0.
+
+    def add(self, value):
+        self.counts[np.searchsorted(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        # upper bound of the bucket of the q-th percentile (bounded by the max value)
+        if not self.count: return 0.
+        bucket = np.searchsorted(np.cumsum(self.counts), q / 100 * self.count)
+        return float(min(BUCKETS[bucket] if bucket < len(BUCKETS) else self.max, self.max))
+
+    def summary(self):
+        if not self.count: return {'count': 0}
+        return {'count': self.count, 'total': self.total, 'mean': self.total / self.count, 'min': self.min,
+                'p50': self.percentile(50), 'p95': self.percentile(95), 'p99': self.percentile(99), 'max': self.max}
+
+
+class Metrics:
+    '''
+    Counters (tiles, requests, bytes...) and latency histograms of the stages
+    of a run, updated from several threads. Metrics of other processes
+    (pickled) are added with merge.
+    '''
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'counters': self.counters, 'histograms': self.histograms, 'start': self.start}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self._lock: self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        with self._lock:
+            if name not in self.histograms: self.histograms[name] = Histogram()
+            self.histograms[name].add(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        # duration of the block, recorded even if it raises
+        start = time.perf_counter()
+        try: yield
+        finally: self.observe(name, time.perf_counter() - start)
+
+    def merge(self, other):
+        with self._lock:
+            for name, n in other.counters.items(): self.counters[name] = self.counters.get(name, 0) + n
+            for name, histogram in other.histograms.items():
+                if name not in self.histograms: self.histograms[name] = Histogram()
+                self.histograms[name].merge(histogram)
+
+    def to_dict(self):
+        with self._lock:
+            return {'duration': time.time() - self.start, 'counters': dict(self.counters),
+                    'latency': {name: histogram.summary() for name, histogram in self.histograms.items()}}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+def timer(metrics, name):
+    # metrics.timer(name), or nothing if metrics is None
+    return nullcontext() if metrics is None else metrics.timer(name)
+
+
+### PROGRESS
+
+class Progress:
+    '''
+    Progress line with rate and ETA, printed at most every interval seconds
+    (printing every tile slows long runs down). Can be updated from several threads.
+    '''
+
+    def __init__(self, total, interval=1., label='tiles', out=None):
+        # out: file written to, None = sys.stdout when the line is printed (follows redirections)
+        self.total = total
+        self.interval = interval
+        self.label = label
+        self.out = out
+        self.done = 0
+        self.start = time.perf_counter()
+        self._last = -interval
+        self._shown = None
+        self._lock = threading.Lock()
+
+    def update(self, n=1):
+        with self._lock:
+            self.done += n
+            now = time.perf_counter()
+            if now - self._last >= self.interval or self.done >= self.total:
+                self._last = now
+                self.print(now)
+
+    def print(self, now=None):
+        elapsed = (now or time.perf_counter()) - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.
+        eta = (self.total - self.done) / rate if rate > 0 else float('nan')
+        percent = 100 * self.done / self.total if self.total else 100.
+        eta_text = time.strftime('%H:%M:%S', time.gmtime(eta)) if eta == eta else '--:--:--'
+        out = self.out or sys.stdout
+        out.write('\r{} / {} {} ({:.1f}%) | {:.1f} {}/s | ETA {}'.format(
+            self.done, self.total, self.label, percent, rate, self.label, eta_text))
+        out.flush()
+        self._shown = self.done
+
+    def close(self):
+        if self._shown != self.done: self.print()
+        (self.out or sys.stdout).write('\n')
+
+
+### PROFILING
+
+def profiled(stage, profile):
+    '''
+    Wrap a pipeline stage (see run_pipeline) so that its thread runs under a
+    cProfile.Profile, except while it waits for the next stage.
+    Profile one stage at a time.
+    '''
+    def run(items):
+        profile.enable()
+        try:
+            for item in stage(items):
+                profile.disable()
+                yield item
+                profile.enable()
+        finally:
+            profile.disable()
+    return run
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import zlib
+import struct
+
+import numpy as np
+from PIL import Image
+
+
+### TILE NAMES
+
+def tile_name(row, col, suffix=''):
+    # unambiguous name of the tile at row, col (starting at 1): '{row}_{col}{suffix}'
+    return '{}_{}{}'.format(row, col, suffix)
+
+
+def parse_tile_name(name, suffix=''):
+    '''
+    Return (row, col) of a tile file name '{row}_{col}{suffix}.png', or None.
+    Legacy names '{row}{col}' are accepted if they have exactly 2 digits
+    (they are ambiguous from 10 rows or columns).
+    '''
+    match = re.fullmatch(r'(\d+)_(\d+)' + re.escape(suffix) + r'\.png', name)
+    if match: return int(match.group(1)), int(match.group(2))
+    match = re.fullmatch(r'(\d)(\d)' + re.escape(suffix) + r'\.png', name)
+    if match: return int(match.group(1)), int(match.group(2))
+    return None
+
+
+### RASTER WRITERS
+
+# PNG color type of each mode
+_PNG_COLOR_TYPES = {'L': 0, 'RGB': 2, 'LA': 4, 'RGBA': 6}
+
+
+class PngStreamWriter:
+    '''
+    Write a 8 bits png file row by row: the image is never fully in memory
+    '''
+
+    def __init__(self, path, width, height, mode, compress_level=6):
+        self.file = open(path, 'wb')
+        self.width = width
+        self.channels = len(mode)
+        self._compressor = zlib.compressobj(compress_level)
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, _PNG_COLOR_TYPES[mode], 0, 0, 0))
+
+    def _chunk(self, kind, data):
+        self.file.write(struct.pack('>I', len(data)) + kind + data)
+        self.file.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    def write(self, rows):
+        # rows: uint8 array of shape (n, width, channels), each row after the filter byte 0 (none)
+        raw = np.zeros((len(rows), 1 + self.width * self.channels), dtype=np.uint8)
+        raw[:, 1:] = rows.reshape(len(rows), -1)
+        data = self._compressor.compress(raw.tobytes())
+        if data: self._chunk(b'IDAT', data)
+
+    def close(self):
+        self._chunk(b'IDAT', self._compressor.flush())
+        self._chunk(b'IEND', b'')
+        self.file.close()
+
+
+class NpyWriter:
+    '''
+    Write a (height, width, channels) uint8 .npy file row by row, through a memory map
+    '''
+
+    def __init__(self, path, width, height, mode):
+        self.array = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(height, width, len(mode)))
+        self.row = 0
+
+    def write(self, rows):
+        self.array[self.row:self.row + len(rows)] = rows
+        self.row += len(rows)
+
+    def close(self):
+        self.array.flush()
+        del self.array
+
+
+### MOSAIC
+
+def _blend_weights(tile_size):
+    # weight of each pixel of a tile: highest in the center, decreasing to the edges,
+    # so that overlapping tiles fade into each other
+    width, heigth = tile_size
+    x = np.minimum(np.arange(width) + 1, width - np.arange(width)).astype(np.float32)
+    y = np.minimum(np.arange(heigth) + 1, heigth - np.arange(heigth)).astype(np.float32)
+    return y[:, None] * x[None, :]
+
+
+def _tile_mode(mode):
+    # modes written in the mosaic
+    if mode in _PNG_COLOR_TYPES: return mode
+    if mode in ['1', 'I', 'I;16', 'F']: return 'L'
+    return 'RGBA' if mode == 'P' else 'RGB'
+
+
+def mosaic_tiles(tiles_folder, out_path, tile_size, overlapse=0, suffix='', blend=True, compress_level=6):
+    '''
+    Rebuild a map from its tiles, named '{row}_{col}{suffix}.png' (see tile_name)
+    from left to right and top to bottom, like create_mesh_extents with align=True.
+    Tiles are read one row of tiles at a time and the map is written as soon
+    as its pixels are final, so only a band of the map is in memory.
+
+    Parameters
+    ----------
+    tiles_folder : string
+    out_path : string
+        Map file: png, or npy (array of shape (y, x, channels) that can be
+        memory-mapped with np.load(path, mmap_mode='r'))
+    tile_size : tuple of int (x, y) in pixel
+    overlapse : float, optional
+        Overlapse of the tiles, the step between two tiles is rounded to a
+        whole number of pixels. The default is 0.
+    suffix : string, optional
+        Suffix of the tiles names, e.g. '_mask' for masks. The default is ''.
+    blend : bool, optional
+        Average overlapping tiles, weighted by the distance to their edges.
+        Otherwise the last tile covers the previous ones. The default is True.
+    compress_level : int, optional
+        zlib level of the png. The default is 6.
+
+    Returns
+    -------
+    size : tuple of int (x, y)
+        Size of the map in pixel
+    '''
+    tiles = {}
+    for name in os.listdir(tiles_folder):
+        key = parse_tile_name(name, suffix)
+        if key: tiles[key] = os.path.join(tiles_folder, name)
+    if not tiles: raise ValueError("No tile found in " + tiles_folder)
+
+    nb_rows = max(row for row, col in tiles)
+    nb_cols = max(col for row, col in tiles)
+    tile_width, tile_heigth = tile_size
+    step_width = max(round(tile_width * (1 - overlapse)), 1)
+    step_heigth = max(round(tile_heigth * (1 - overlapse)), 1)
+    width = (nb_cols - 1) * step_width + tile_width
+    heigth = (nb_rows - 1) * step_heigth + tile_heigth
+
+    with Image.open(next(iter(tiles.values()))) as first:
+        mode = _tile_mode(first.mode)
+    channels = len(mode)
+    if out_path.endswith('.npy'): writer = NpyWriter(out_path, width, heigth, mode)
+    else: writer = PngStreamWriter(out_path, width, heigth, mode, compress_level)
+
+    # Band of the map covered by the current row of tiles: weighted sum of the tiles and sum of the weights
+    band = np.zeros((tile_heigth, width, channels), dtype=np.float32)
+    band_weight = np.zeros((tile_heigth, width), dtype=np.float32)
+    weights = _blend_weights(tile_size) if blend else np.ones((tile_heigth, tile_width), dtype=np.float32)
+
+    def flush(nb):
+        # write the first nb rows of the band, then shift it
+        weight = band_weight[:nb, :, None]
+        rows = np.divide(band[:nb], weight, out=np.zeros_like(band[:nb]), where=weight > 0)
+        writer.write(np.clip(np.rint(rows), 0, 255).astype(np.uint8))
+        band[:-nb] = band[nb:].copy()
+        band_weight[:-nb] = band_weight[nb:].copy()
+        band[-nb:] = 0
+        band_weight[-nb:] = 0
+
+    band_top = 0
+    try:
+        for row in range(1, nb_rows + 1):
+            # rows above this row of tiles are final
+            top = (row - 1) * step_heigth
+            if top > band_top: flush(top - band_top)
+            band_top = top
+
+            for col in range(1, nb_cols + 1):
+                if (row, col) not in tiles: continue
+                left = (col - 1) * step_width
+                with Image.open(tiles[(row, col)]) as image:
+                    tile = np.asarray(image.convert(mode), dtype=np.float32).reshape(tile_heigth, tile_width, channels)
+                if blend:
+                    band[:, left:left + tile_width] += tile * weights[..., None]
+                    band_weight[:, left:left + tile_width] += weights
+                else:
+                    band[:, left:left + tile_width] = tile
+                    band_weight[:, left:left + tile_width] = weights
+        flush(tile_heigth)
+    finally:
+        writer.close()
+
+    return width, heigth
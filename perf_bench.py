@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tracemalloc
+from contextlib import redirect_stdout
+
+import numpy as np
+import shapely
+from shapely import Polygon
+import geopandas as gpd
+
+# peak resident memory, not available on Windows
+try: import resource
+except ImportError: resource = None
+
+from mesh import create_mesh_extents, extents_to_shp
+from create_masks import create_mask, build_polygons_index
+from fake_wms import FakeWMSServer
+import main
+
+
+### PARAMETERS
+
+ZOOM_RES_3857 = {
+    0: 156543.0339280410, 1: 78271.5169640205, 2: 39135.7584820102,
+    3: 19567.8792410051, 4: 9783.9396205026, 5: 4891.9698102513,
+    6: 2445.9849051256, 7: 1222.9924525628, 8: 611.4962262814,
+    9: 305.7481131407, 10: 152.8740565704, 11: 76.4370282852,
+    12: 38.2185141426, 13: 19.1092570713, 14: 9.5546285356,
+    15: 4.7773142678, 16: 2.3886571339, 17: 1.1943285670,
+    18: 0.5971642835, 19: 0.2985821417, 20: 0.1492910709, 21: 0.0746455354
+}
+SRS = ZOOM_RES_3857
+ZOOM_LEVEL = 14
+ZOOM = SRS[ZOOM_LEVEL]
+
+# Synthetic data (EPSG:3857), same seed = same data
+SEED = 0
+DATA_EXTENT = (100000, 6000000, 160000, 6060000) # w, s, e, n in meters
+NB_POLYGONS = 2000
+NB_SETS = 4
+SET_SIZE = 20000 # width and height of a set extent in meters
+
+# Mesh parameters
+TILE_SIZE = (512, 512)
+OVERLAPSE = 0.7
+SAFETY = 0
+
+# Stand-in WMS server
+SERVER_LATENCY = 0.02 # seconds per request
+SERVER_JITTER = 0.01
+SERVER_PAYLOAD_SIZE = 200 * 1024 # bytes per image
+
+REPEAT = 5 # runs of each micro benchmark (the best and the percentiles are reported)
+
+BENCH_PATH = 'benchmark/perf/'
+RESULTS_PATH = BENCH_PATH + 'results.json'
+
+
+### SYNTHETIC DATA
+
+def synthetic_polygons(n, extent, seed=0, holes=0.3):
+    '''
+    Random star-shaped polygons (100 m to 1.5 km wide) in extent,
+    a fraction holes of them with a hole
+    '''
+    rng = np.random.default_rng(seed)
+    w, s, e, n_ = extent
+    polygons = []
+    while len(polygons) < n:
+        cx, cy = rng.uniform(w, e), rng.uniform(s, n_)
+        radius = rng.uniform(100, 1500)
+        k = rng.integers(3, 12)
+        angles = np.sort(rng.uniform(0, 2 * np.pi, k))
+        radii = radius * rng.uniform(0.5, 1, k)
+        shell = np.c_[cx + radii * np.cos(angles), cy + radii * np.sin(angles)]
+        interiors = []
+        if rng.random() < holes:
+            r = radius * 0.3
+            interiors = [np.c_[cx + r * np.cos(angles[::-1]), cy + r * np.sin(angles[::-1])]]
+        polygon = Polygon(shell, interiors)
+        if polygon.is_valid: polygons.append(polygon)
+    return polygons
+
+
+def synthetic_set_extents(n, extent, set_size, seed=0):
+    '''
+    Random set extents of set_size meters in extent (they may overlap)
+    '''
+    rng = np.random.default_rng(seed)
+    w, s, e, n_ = extent
+    set_extents = []
+    for _ in range(n):
+        x, y = rng.uniform(w, e - set_size), rng.uniform(s, n_ - set_size)
+        set_extents.append((x, y, x + set_size, y + set_size))
+    return set_extents
+
+
+### MEASURES
+
+def summarize(durations):
+    '''
+    Latency statistics (seconds) of a list of durations
+    '''
+    if not len(durations): return {'count': 0}
+    durations = np.asarray(durations, dtype=np.float64)
+    return {'count': len(durations), 'total': float(durations.sum()), 'min': float(durations.min()),
+            'mean': float(durations.mean()), 'p50': float(np.percentile(durations, 50)),
+            'p95': float(np.percentile(durations, 95)), 'max': float(durations.max())}
+
+
+def measure(function, repeat=5, warmup=1):
+    '''
+    Time repeat calls of function, then measure the peak of python memory
+    (numpy included) during one more call.
+
+    Returns
+    -------
+    result : dict
+        seconds (latency statistics) and peak_memory_mb
+    '''
+    for _ in range(warmup): function()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+
+    # traced separately: tracemalloc slows allocations down
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'seconds': summarize(durations), 'peak_memory_mb': peak / 1024**2}
+
+
+def max_rss_mb():
+    # peak resident memory of this process and of its finished children, None without resource
+    # (ru_maxrss is in kB on Linux, in bytes on macOS)
+    if resource is None: return None
+    unit = 1024**2 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {'self': own / unit, 'children': children / unit}
+
+
+### BENCHMARKS
+
+def bench_mesh(set_extents, repeat=REPEAT):
+    tile_extents = create_mesh_extents(set_extents[0], OVERLAPSE, SAFETY, TILE_SIZE, SRS, ZOOM_LEVEL)
+    result = measure(lambda: create_mesh_extents(set_extents[0], OVERLAPSE, SAFETY, TILE_SIZE, SRS, ZOOM_LEVEL), repeat)
+    result['tiles'] = len(tile_extents)
+    result['tiles_per_s'] = len(tile_extents) / result['seconds']['min']
+    return result
+
+
+def bench_mask(set_extents, polygons, repeat=REPEAT):
+    # masks of the first tiles of a set, with the polygons index (as in main)
+    tile_extents = create_mesh_extents(set_extents[0], OVERLAPSE, SAFETY, TILE_SIZE, SRS, ZOOM_LEVEL)[:200]
+    index = build_polygons_index(polygons)
+    folder = BENCH_PATH + 'masks/'
+    os.makedirs(folder, exist_ok=True)
+
+    def run():
+        for i, extent in enumerate(tile_extents):
+            create_mask(extent, polygons, ZOOM, TILE_SIZE, folder + str(i) + '.png', empty=False, index=index)
+
+    result = measure(run, repeat)
+    result['tiles'] = len(tile_extents)
+    result['tiles_per_s'] = len(tile_extents) / result['seconds']['min']
+    shutil.rmtree(folder)
+    return result
+
+
+def bench_shp(set_extents, repeat=REPEAT):
+    tile_extents = create_mesh_extents(set_extents[0], OVERLAPSE, SAFETY, TILE_SIZE, SRS, ZOOM_LEVEL)
+    path = BENCH_PATH + 'shp/tile_extents.shp'
+    os.makedirs(BENCH_PATH + 'shp', exist_ok=True)
+    result = measure(lambda: extents_to_shp(tile_extents, path), repeat)
+    result['tiles'] = len(tile_extents)
+    result['tiles_per_s'] = len(tile_extents) / result['seconds']['min']
+    shutil.rmtree(BENCH_PATH + 'shp')
+    return result
+
+
+def _timed(durations, function):
+    # function recording the duration of each of its calls in durations
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try: return function(*args, **kwargs)
+        finally: durations.append(time.perf_counter() - start)
+    return timed
+
+
+def bench_main(set_extents, polygons, server, **params):
+    '''
+    Run main.main on the synthetic sets and polygons instead of the database,
+    against the stand-in server, in a fresh project folder.
+    params override main parameters (e.g. MASK_WORKERS=1, METATILES=True).
+    '''
+    project_path = BENCH_PATH + 'project/'
+    shutil.rmtree(project_path, ignore_errors=True)
+    for folder in ['shp', 'images', 'targets']: os.makedirs(project_path + folder)
+
+    overrides = {'WMS_URL': server.url, 'IMAGERY_SOURCE': 'wms', 'RATE_LIMIT': None, 'CACHE_PATH': None,
+                 'CLIP_IN_DB': False, 'ANCHORS_CACHE_PATH': None, 'ZOOM_LEVEL': ZOOM_LEVEL, 'ZOOM': ZOOM, 'TILE_SIZE': TILE_SIZE,
+                 'OVERLAPSE': OVERLAPSE, 'SAFETY': SAFETY, 'PROJECT_PATH': project_path}
+    # paths of the project
+    for name, value in vars(main).items():
+        if name.endswith('_PATH') and isinstance(value, str) and value.startswith(main.PROJECT_PATH) and name != 'PROJECT_PATH':
+            overrides[name] = project_path + value[len(main.PROJECT_PATH):]
+    overrides.update(params)
+
+    # stages timed inside main, data from the synthetic sets instead of the database
+    stages = {name: [] for name in ['set_extents', 'anchors', 'mesh', 'shapefiles', 'planning', 'request']}
+    anchors_gdf = gpd.GeoDataFrame(geometry=polygons, crs=3857)
+    source_class = main.WMSSource
+
+    class TimedSource(source_class):
+        get = _timed(stages['request'], source_class.get)
+
+    overrides.update({
+        'get_extents_from_sets': _timed(stages['set_extents'], lambda engine, zoom_level, basemap: set_extents),
+        'get_anchors_gdf_from_db': _timed(stages['anchors'], lambda engine, zoom_level, basemap: anchors_gdf),
+        'save_meshes': _timed(stages['mesh'], main.save_meshes),
+        'create_grid_meshes': _timed(stages['mesh'], main.create_grid_meshes),
+        'extents_to_file': _timed(stages['shapefiles'], main.extents_to_file),
+        'plan_tiles': _timed(stages['planning'], main.plan_tiles),
+        'WMSSource': TimedSource,
+    })
+
+    previous = {name: getattr(main, name) for name in overrides}
+    for name, value in overrides.items(): setattr(main, name, value)
+    requests_before = server.requests
+    try:
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()): main.main()
+        seconds = time.perf_counter() - start
+    finally:
+        for name, value in previous.items(): setattr(main, name, value)
+
+    images = len(os.listdir(overrides['OUTPUT_IMG_PATH']))
+    result = {'seconds': seconds, 'tiles': images, 'tiles_per_s': images / seconds,
+              'requests': server.requests - requests_before,
+              'stages': {name: summarize(durations) for name, durations in stages.items()},
+              'max_rss_mb': max_rss_mb(), 'params': {name: value for name, value in params.items()}}
+    # instrumentation of the run (masks stages, requests, bytes...)
+    with open(overrides['METRICS_PATH']) as f: result['metrics'] = json.load(f)
+    shutil.rmtree(project_path)
+    return result
+
+
+def run_benchmarks(path=RESULTS_PATH):
+    '''
+    Run every benchmark and save the results as json (path), for regression
+    tracking between commits
+    '''
+    os.makedirs(BENCH_PATH, exist_ok=True)
+    polygons = synthetic_polygons(NB_POLYGONS, DATA_EXTENT, SEED)
+    set_extents = synthetic_set_extents(NB_SETS, DATA_EXTENT, SET_SIZE, SEED)
+
+    results = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                        'platform': platform.platform(), 'cpus': os.cpu_count(), 'numpy': np.__version__,
+                        'shapely': shapely.__version__, 'polygons': NB_POLYGONS, 'sets': NB_SETS,
+                        'tile_size': TILE_SIZE, 'overlapse': OVERLAPSE, 'zoom_level': ZOOM_LEVEL,
+                        'server': {'latency': SERVER_LATENCY, 'jitter': SERVER_JITTER, 'payload_size': SERVER_PAYLOAD_SIZE}}}
+
+    print("Benchmark create_mesh_extents")
+    results['create_mesh_extents'] = bench_mesh(set_extents)
+    print("Benchmark create_mask")
+    results['create_mask'] = bench_mask(set_extents, polygons)
+    print("Benchmark extents_to_shp")
+    results['extents_to_shp'] = bench_shp(set_extents)
+
+    with FakeWMSServer(SERVER_LATENCY, SERVER_JITTER, SERVER_PAYLOAD_SIZE, seed=SEED) as server:
+        print("Benchmark main")
+        results['main'] = bench_main(set_extents, polygons, server)
+        results['main']['bytes_received'] = server.bytes_sent
+
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+    return results
+
+
+
+if __name__ == "__main__":
+    results = run_benchmarks(sys.argv[1] if len(sys.argv) > 1 else RESULTS_PATH)
+    for name in ['create_mesh_extents', 'create_mask', 'extents_to_shp', 'main']:
+        print(name, round(results[name]['tiles_per_s'], 1), "tiles/s")
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import queue
+import threading
+
+
+### STREAMING PIPELINE
+
+_END = object()
+
+
+class _Stopped(Exception):
+    # raised in a stage when another stage failed
+    pass
+
+
+def _put(q, item, stop):
+    # blocking put (backpressure), given up if the pipeline is stopped
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+    raise _Stopped()
+
+
+def _items(q, stop):
+    # items of a queue until the end of the previous stage
+    while True:
+        try: item = q.get(timeout=0.1)
+        except queue.Empty:
+            if stop.is_set(): raise _Stopped()
+            continue
+        if item is _END: return
+        yield item
+
+
+def _run_stage(stage, items, out_queue, stop, errors):
+    try:
+        for item in stage(items) if items is not None else stage:
+            _put(out_queue, item, stop)
+        _put(out_queue, _END, stop)
+    except _Stopped:
+        pass
+    except BaseException as error:
+        errors.append(error)
+        stop.set()
+
+
+def run_pipeline(source, stages, maxsize=64):
+    '''
+    Run the source and every stage in its own thread, connected by bounded
+    queues, so that stages overlap: the run is limited by the slowest stage.
+    A stage waits when the queue to the next one is full (backpressure), so
+    memory stays bounded. If a stage fails, the whole pipeline is stopped
+    and its exception is raised by the caller loop.
+
+    Parameters
+    ----------
+    source : iterable
+        Items of the first stage (e.g. tile extents), consumed in its own thread
+    stages : list of functions
+        Each stage is called with the iterable of the previous stage outputs,
+        and returns an iterable of its own outputs
+    maxsize : int, optional
+        Size of the queues between stages. The default is 64.
+
+    Yields
+    ------
+    Outputs of the last stage, in the caller thread (e.g. to write them)
+    '''
+    stop = threading.Event()
+    errors = []
+    threads = []
+
+    items = None
+    stage = source
+    for next_stage in list(stages) + [None]:
+        out_queue = queue.Queue(maxsize=maxsize)
+        thread = threading.Thread(target=_run_stage, args=(stage, items, out_queue, stop, errors), daemon=True)
+        thread.start()
+        threads.append(thread)
+        items = _items(out_queue, stop)
+        stage = next_stage
+
+    try:
+        for item in items: yield item
+    except _Stopped:
+        pass
+    finally:
+        stop.set()
+        for thread in threads: thread.join()
+
+    if errors: raise errors[0]
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+import math
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from create_masks import unpack_mask
+
+
+### PYRAMID OF ZOOM LEVELS
+
+def level_factor(srs, fine_level, zoom_level):
+    '''
+    Number of fine pixels in one pixel of a coarser zoom level (2 per level)
+    '''
+    factor = srs[zoom_level] / srs[fine_level]
+    if factor < 1 or abs(factor - round(factor)) > 1e-6:
+        raise ValueError("Zoom level " + str(zoom_level) + " can not be derived from zoom level " + str(fine_level))
+    return round(factor)
+
+
+def mask_to_coverage(mask, width):
+    '''
+    Boolean array (True on polygons) of a mask from encode_mask: PIL image
+    (polygons in black) or bit-packed array ('npy' mode) of width pixels
+    '''
+    if isinstance(mask, np.ndarray): return unpack_mask(mask, width)
+    return np.asarray(mask.convert('L')) < 128
+
+
+class FineGrid:
+    '''
+    Tiles of the finest level of one group (a set, or the global grid), on a
+    regular grid of whole pixels from origin: tile (col, row) has its north
+    west corner at col * step[0], row * step[1] pixels from origin.
+    '''
+
+    def __init__(self, origin, step, tile_size, zoom, tile_extents, tile_ids):
+        # origin: (west, north) of the group, step: (x, y) step in pixel (see mesh_grid with align=True)
+        self.origin = origin
+        self.step = step
+        self.tile_size = tile_size
+        self.zoom = zoom
+        tile_extents = np.asarray(tile_extents, dtype=np.float64).reshape(-1, 4)
+        cols = np.rint((tile_extents[:, 0] - origin[0]) / (step[0] * zoom)).astype(np.int64)
+        rows = np.rint((origin[1] - tile_extents[:, 3]) / (step[1] * zoom)).astype(np.int64)
+        self.tiles = dict(zip(zip(cols.tolist(), rows.tolist()), np.asarray(tile_ids).tolist()))
+
+    def window(self, extent):
+        # (left, top) of an extent in pixels from the origin
+        w, s, e, n = extent
+        return round((w - self.origin[0]) / self.zoom), round((self.origin[1] - n) / self.zoom)
+
+    def tiles_in(self, left, top, width, heigth):
+        # (col, row, tile id) of the tiles intersecting a pixel window
+        (step_x, step_y), (tile_width, tile_heigth) = self.step, self.tile_size
+        cols = range(math.floor((left - tile_width) / step_x) + 1, math.ceil((left + width) / step_x))
+        rows = range(math.floor((top - tile_heigth) / step_y) + 1, math.ceil((top + heigth) / step_y))
+        for row in rows:
+            for col in cols:
+                if (col, row) in self.tiles: yield col, row, self.tiles[(col, row)]
+
+    def assemble(self, left, top, size, read, shape=(), dtype=np.uint8):
+        '''
+        Assemble the pixel window (left, top, size) from the tiles
+
+        Parameters
+        ----------
+        read : function
+            Called with a tile id, returns its pixels as an array of shape
+            (tile heigth, tile width) + shape, or None if the tile is missing
+
+        Returns
+        -------
+        window : numpy array of shape (size[1], size[0]) + shape
+        covered : numpy array of bool
+            False where no tile covers the window
+        '''
+        width, heigth = size
+        window = np.zeros((heigth, width) + tuple(shape), dtype=dtype)
+        covered = np.zeros((heigth, width), dtype=bool)
+        tiles = list(self.tiles_in(left, top, width, heigth))
+
+        # first the cell of each tile (the step after its corner, cells do not overlap),
+        # then the rest of the tiles for the pixels that are not covered yet (borders)
+        for cell in (True, False):
+            for col, row, i in tiles:
+                x0, y0 = col * self.step[0], row * self.step[1]
+                x1 = x0 + (self.step[0] if cell else self.tile_size[0])
+                y1 = y0 + (self.step[1] if cell else self.tile_size[1])
+                a0, a1 = max(x0, left), min(x1, left + width)
+                b0, b1 = max(y0, top), min(y1, top + heigth)
+                if a0 >= a1 or b0 >= b1: continue
+
+                done = covered[b0 - top:b1 - top, a0 - left:a1 - left]
+                if done.all(): continue
+                pixels = read(i)
+                if pixels is None: continue
+                crop = pixels[b0 - y0:b1 - y0, a0 - x0:a1 - x0]
+                target = window[b0 - top:b1 - top, a0 - left:a1 - left]
+                target[~done] = crop[~done]
+                done[...] = True
+            if covered.all(): break
+        return window, covered
+
+
+class _TileReader:
+    # read function of FineGrid.assemble, keeping the last decoded tiles
+    # (tiles are read by several neighbouring coarse tiles)
+
+    def __init__(self, load, maxsize=256):
+        self.load = load
+        self.maxsize = maxsize
+        self._tiles = OrderedDict()
+
+    def __call__(self, i):
+        if i in self._tiles:
+            self._tiles.move_to_end(i)
+            return self._tiles[i]
+        pixels = self.load(i)
+        self._tiles[i] = pixels
+        if len(self._tiles) > self.maxsize: self._tiles.popitem(last=False)
+        return pixels
+
+
+def derive_tiles(jobs, grids, factor, tile_size, load_image, load_mask, fallback=None, empty=True):
+    '''
+    Create the tiles of a coarser zoom level from the images and masks of
+    the finest level: the window of each coarse tile is assembled from the
+    fine tiles, then downsampled by factor (images are averaged, a coarse
+    pixel is in a polygon if at least half of its fine pixels are).
+    Masks differ from masks rendered at the coarse zoom on the polygon edges
+    only (about 0.2 to 0.3% of the pixels of a tile, see test_pyramid.py).
+
+    Parameters
+    ----------
+    jobs : iterable of (i, extent, group)
+        Coarse tiles, group is the key of their FineGrid in grids
+    grids : dict {group: FineGrid}
+    factor : int
+        See level_factor
+    tile_size : tuple of int (x, y) in pixel
+    load_image : function
+        Called with a fine tile id, returns its image as an RGB array, or
+        None if it was not created
+    load_mask : function
+        Called with a fine tile id, returns its coverage (see mask_to_coverage),
+        an array of False if the mask is empty, or None if it is unknown
+    fallback : function, optional
+        Called with (i, extent, tile_size) when the fine tiles do not cover the
+        whole window (borders, missing images), returns (image, coverage)
+        of the coarse tile, e.g. requested at the coarse zoom. Without
+        fallback, the tile is yielded with image and coverage None. The default is None.
+    empty : bool, optional
+        Create the tiles without polygons. Otherwise their image is not
+        needed and is None. The default is True.
+
+    Yields
+    ------
+    (i, image, coverage) : PIL image and numpy array of bool
+    '''
+    read_image, read_mask = _TileReader(load_image), _TileReader(load_mask)
+    size = (tile_size[0] * factor, tile_size[1] * factor)
+
+    for i, extent, group in jobs:
+        grid = grids[group]
+        left, top = grid.window(extent)
+
+        coverage, covered = grid.assemble(left, top, size, read_mask, dtype=bool)
+        if covered.all():
+            coverage = coverage.reshape(tile_size[1], factor, tile_size[0], factor).mean(axis=(1, 3)) >= 0.5
+            if not empty and not coverage.any():
+                yield i, None, coverage
+                continue
+            image, covered = grid.assemble(left, top, size, read_image, shape=(3,))
+        
+        if not covered.all():
+            if fallback is None: yield i, None, None
+            else: yield (i,) + tuple(fallback(i, extent, tile_size))
+            continue
+
+        yield i, Image.fromarray(image).reduce(factor), coverage
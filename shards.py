@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import os
+import io
+import mmap
+import tarfile
+
+import numpy as np
+from PIL import Image
+
+
+### SHARDED DATASET
+
+# Index of the samples: shard number, offset and size of the image and mask data in the shard
+INDEX_DTYPE = np.dtype([('sample', np.int64), ('shard', np.int32),
+                        ('image_offset', np.int64), ('image_size', np.int64),
+                        ('mask_offset', np.int64), ('mask_size', np.int64)])
+INDEX_NAME = 'index.npy'
+
+
+def _shard_name(shard):
+    return 'shard-{:06d}.tar'.format(shard)
+
+
+class ShardWriter:
+    '''
+    Write image/mask pairs in uncompressed tar shards of shard_size samples
+    ({i}.png and {i}_mask.png, or mask_suffix, in each shard), with an index of the data
+    offsets (index.npy) rewritten each time a shard is closed.
+    Writing in an existing folder adds new shards: a sample written again
+    replaces the previous one.
+    '''
+
+    def __init__(self, folder, shard_size=4096, mask_suffix='_mask.png'):
+        self.folder = folder
+        self.shard_size = shard_size
+        self.mask_suffix = mask_suffix
+        os.makedirs(folder, exist_ok=True)
+
+        index_path = os.path.join(folder, INDEX_NAME)
+        self.index = np.load(index_path) if os.path.exists(index_path) else np.empty(0, dtype=INDEX_DTYPE)
+        self.shard = int(self.index['shard'].max()) + 1 if len(self.index) else 0
+        self._tar = None
+        self._pending = []
+
+    def _add(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self._tar.addfile(info, io.BytesIO(data))
+        # data is written just before the padding to a 512 bytes block
+        return self._tar.offset - (len(data) + 511) // 512 * 512
+
+    def write(self, i, image, mask):
+        '''
+        Add sample i (image and mask file contents)
+
+        Returns
+        -------
+        samples : list of int
+            Samples written to disk with their index (when a shard is closed)
+        '''
+        if self._tar is None:
+            self._tar = tarfile.open(os.path.join(self.folder, _shard_name(self.shard)), 'w', format=tarfile.GNU_FORMAT)
+
+        image_offset = self._add(str(i) + '.png', image)
+        mask_offset = self._add(str(i) + self.mask_suffix, mask)
+        self._pending.append((i, self.shard, image_offset, len(image), mask_offset, len(mask)))
+
+        if len(self._pending) >= self.shard_size: return self.flush()
+        return []
+
+    def flush(self):
+        '''
+        Close the current shard and save the index
+
+        Returns
+        -------
+        samples : list of int
+            Samples of the closed shard
+        '''
+        if self._tar is None: return []
+        self._tar.close()
+        self._tar = None
+        self.shard += 1
+
+        samples = [row[0] for row in self._pending]
+        self.index = np.concatenate([self.index, np.array(self._pending, dtype=INDEX_DTYPE)])
+        self._pending = []
+
+        index_path = os.path.join(self.folder, INDEX_NAME)
+        tmp_path = index_path + '.tmp.npy'
+        np.save(tmp_path, self.index)
+        os.replace(tmp_path, index_path)
+        return samples
+
+    def close(self):
+        return self.flush()
+
+
+class ShardReader:
+    '''
+    Random access to the samples of a sharded dataset: shards are memory-mapped
+    and sample i is found in O(1) from the index.
+    '''
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.index = np.load(os.path.join(folder, INDEX_NAME))
+
+        # position of each sample in the index (the last one wins if a sample was written twice)
+        size = int(self.index['sample'].max()) + 1 if len(self.index) else 0
+        self._position = np.full(size, -1, dtype=np.int64)
+        self._position[self.index['sample']] = np.arange(len(self.index))
+        self._shards = {}
+
+    def __len__(self):
+        return int((self._position >= 0).sum())
+
+    def __contains__(self, i):
+        return 0 <= i < len(self._position) and self._position[i] >= 0
+
+    def samples(self):
+        return np.flatnonzero(self._position >= 0)
+
+    def _map(self, shard):
+        if shard not in self._shards:
+            with open(os.path.join(self.folder, _shard_name(shard)), 'rb') as f:
+                self._shards[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._shards[shard]
+
+    def __getitem__(self, i):
+        '''
+        Return (image, mask) file contents of sample i, read from the mapped shard
+        '''
+        if i not in self: raise KeyError(i)
+        row = self.index[self._position[i]]
+        data = self._map(int(row['shard']))
+        image_offset, mask_offset = int(row['image_offset']), int(row['mask_offset'])
+        image = data[image_offset:image_offset + int(row['image_size'])]
+        mask = data[mask_offset:mask_offset + int(row['mask_size'])]
+        return image, mask
+
+    def load(self, i):
+        '''
+        Return (image, mask) of sample i as PIL images 
+        (the mask is a numpy array if masks were saved in 'npy' mode)
+        '''
+        image, mask = self[i]
+        if mask[:6] == b'\x93NUMPY': return Image.open(io.BytesIO(image)), np.load(io.BytesIO(mask))
+        return Image.open(io.BytesIO(image)), Image.open(io.BytesIO(mask))
+
+    def close(self):
+        for data in self._shards.values(): data.close()
+        self._shards = {}
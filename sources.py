@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import math
+from abc import ABC, abstractmethod
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from fetch import getmap, get_image
+from mesh import GRID_ORIGIN
+
+
+### IMAGERY SOURCES
+
+class ImagerySource(ABC):
+    '''
+    Source of the tile images: get returns the image file content of an
+    extent (west, south, east, north) in EPSG:3857, at a size in pixel.
+    '''
+
+    @abstractmethod
+    def get(self, extent, size):
+        pass
+
+    def __call__(self, extent, size):
+        return self.get(extent, size)
+
+    def close(self):
+        pass
+
+
+class WMSSource(ImagerySource):
+    '''
+    One WMS GetMap request per extent, rendered by the server.
+    Parameters after layer are the ones of fetch.getmap.
+    '''
+
+    def __init__(self, session, url, layer, srs='EPSG:3857', format='image/png', **request_params):
+        self.session = session
+        self.url = url
+        self.layer = layer
+        self.srs = srs
+        self.format = format
+        self.request_params = request_params # timeout, retries, backoff, rate_limiter, cache
+
+    def get(self, extent, size):
+        return getmap(self.session, self.url, self.layer, extent, size, srs=self.srs, format=self.format, **self.request_params)
+
+
+# Tiles of the tile matrix set 'PM' of the Géoportail (EPSG:3857, origin GRID_ORIGIN,
+# same resolutions as ZOOM_RES_3857)
+WMTS_TILE_SIZE = 256
+
+
+class WMTSSource(ImagerySource):
+    '''
+    Pre-rendered WMTS tiles (GetTile, KVP encoding) covering the extent are
+    requested concurrently, mosaicked and cropped locally.
+    Tiles are cached if a cache is given in request_params, so tiles shared by
+    overlapping extents are requested once.
+    '''
+
+    def __init__(self, session, url, layer, zoom_level, srs, tile_matrix_set='PM', style='normal',
+                 format='image/png', max_in_flight=8, **request_params):
+        # srs: resolution (m/px) of each zoom level of the tile matrix set
+        # request_params: timeout, retries, backoff, rate_limiter, cache (see fetch.getmap)
+        self.session = session
+        self.url = url
+        self.layer = layer
+        self.zoom_level = zoom_level
+        self.resolution = srs[zoom_level]
+        self.tile_matrix_set = tile_matrix_set
+        self.style = style
+        self.format = format
+        self.request_params = request_params
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+    def get_tile(self, col, row):
+        params = {
+            'service': 'WMTS',
+            'request': 'GetTile',
+            'version': '1.0.0',
+            'layer': self.layer,
+            'style': self.style,
+            'tilematrixset': self.tile_matrix_set,
+            'tilematrix': str(self.zoom_level),
+            'tilecol': str(col),
+            'tilerow': str(row),
+            'format': self.format,
+        }
+        return get_image(self.session, self.url, params, **self.request_params)
+
+    def get(self, extent, size):
+        w, s, e, n = extent
+        tile_span = WMTS_TILE_SIZE * self.resolution
+
+        # Covering tiles
+        col_min = math.floor((w - GRID_ORIGIN[0]) / tile_span)
+        col_max = math.ceil((e - GRID_ORIGIN[0]) / tile_span) - 1
+        row_min = math.floor((GRID_ORIGIN[1] - n) / tile_span)
+        row_max = math.ceil((GRID_ORIGIN[1] - s) / tile_span) - 1
+        tiles = [(col, row) for row in range(row_min, row_max + 1) for col in range(col_min, col_max + 1)]
+        contents = self._executor.map(lambda tile: self.get_tile(*tile), tiles)
+
+        # Mosaic
+        mosaic = Image.new('RGB', ((col_max - col_min + 1) * WMTS_TILE_SIZE, (row_max - row_min + 1) * WMTS_TILE_SIZE), 'white')
+        for (col, row), content in zip(tiles, contents):
+            tile = Image.open(BytesIO(content)).convert('RGB')
+            mosaic.paste(tile, ((col - col_min) * WMTS_TILE_SIZE, (row - row_min) * WMTS_TILE_SIZE))
+
+        # Crop the extent, resampled only if it is not aligned on the tile pixels
+        left = (w - (GRID_ORIGIN[0] + col_min * tile_span)) / self.resolution
+        upper = ((GRID_ORIGIN[1] - row_min * tile_span) - n) / self.resolution
+        right = left + (e - w) / self.resolution
+        lower = upper + (n - s) / self.resolution
+        crop_box = (left, upper, right, lower)
+        if all(abs(x - round(x)) < 1e-3 for x in crop_box) and (round(right - left), round(lower - upper)) == tuple(size):
+            image = mosaic.crop(tuple(round(x) for x in crop_box))
+        else:
+            image = mosaic.resize(tuple(size), Image.BILINEAR, box=crop_box)
+
+        out = BytesIO()
+        image.save(out, format='PNG')
+        return out.getvalue()
+
+    def close(self):
+        self._executor.shutdown()
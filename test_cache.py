@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from cache import TileCache
+
+
+def files(folder):
+    return sorted(name for root, dirs, names in os.walk(folder) for name in names)
+
+
+def test_get_put(tmp_path):
+    cache = TileCache(str(tmp_path))
+    key = cache.key('http://wms', {'bbox': '0,0,1,1', 'width': '256'})
+    assert key == cache.key('http://wms', {'width': '256', 'bbox': '0,0,1,1'})
+    assert cache.get(key) is None
+    cache.put(key, b'png')
+    assert cache.get(key) == b'png'
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'entries': 1, 'size': 3}
+
+
+def test_lru_eviction(tmp_path):
+    cache = TileCache(str(tmp_path), max_size=30)
+    keys = [cache.key(k) for k in range(4)]
+    for key in keys[:3]: cache.put(key, b'0123456789')
+
+    # keys[0] is used again: keys[1] is the least recently used
+    assert cache.get(keys[0]) is not None
+    cache.put(keys[3], b'0123456789')
+    assert cache.get(keys[1]) is None
+    assert all(cache.get(key) is not None for key in [keys[0], keys[2], keys[3]])
+    assert cache.size == 30
+    assert files(tmp_path) == sorted([keys[0], keys[2], keys[3]])
+
+
+def test_atomic_write(tmp_path):
+    cache = TileCache(str(tmp_path))
+    key = cache.key('tile')
+    cache.put(key, b'old')
+
+    # a failed write leaves the previous content, and no temporary file
+    with pytest.raises(TypeError): cache.put(key, 'not bytes')
+    assert cache.get(key) == b'old'
+    assert files(tmp_path) == [key]
+
+
+def test_reload(tmp_path):
+    cache = TileCache(str(tmp_path), max_size=20)
+    old, new = cache.key('old'), cache.key('new')
+    cache.put(old, b'0123456789')
+    cache.put(new, b'0123456789')
+    os.utime(cache._path(old), (1, 1))
+    with open(os.path.join(os.path.dirname(cache._path(new)), 'left.tmp'), 'wb') as f: f.write(b'x' * 100)
+
+    # entries on disk are loaded by last use, temporary files are ignored
+    cache = TileCache(str(tmp_path), max_size=20)
+    assert cache.stats()['entries'] == 2 and cache.size == 20
+    cache.put(cache.key('other'), b'0123456789')
+    assert cache.get(old) is None and cache.get(new) == b'0123456789'
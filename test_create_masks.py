@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+from io import BytesIO
+
+import numpy as np
+import pytest
+import shapely
+from PIL import Image
+
+from create_masks import create_mask, create_masks_parallel, create_masks_from_canvas, build_polygons_index, plan_tiles
+from create_masks import encode_mask, unpack_mask, save_mask
+
+
+ZOOM = 0.7
+SIZE = (64, 64)
+STEP = 40 # pixels between two tiles
+
+
+def anchors(count=40, seed=0):
+    # discs of various sizes, a third of them with a hole
+    rng = np.random.default_rng(seed)
+    centers, radii = rng.uniform(0, 400, (count, 2)), rng.uniform(10, 60, count)
+    polygons = [shapely.Point(x, y).buffer(r, 8) for (x, y), r in zip(centers, radii)]
+    return [polygon.difference(polygon.centroid.buffer(polygon.area ** .5 / 5, 4)) if k % 3 == 0 else polygon
+            for k, polygon in enumerate(polygons)]
+
+
+def tile_jobs(rows=12, cols=12, north=400.):
+    # aligned overlapping tiles: a whole number of pixels apart
+    jobs = []
+    for y in range(rows):
+        for x in range(cols):
+            w, n = x * STEP * ZOOM, north - y * STEP * ZOOM
+            jobs.append((len(jobs) + 1, (w, n - SIZE[1] * ZOOM, w + SIZE[0] * ZOOM, n)))
+    return jobs
+
+
+def coverage(content):
+    return np.asarray(Image.open(BytesIO(content))) == 0
+
+
+def test_canvas_masks_differ_only_on_edges(tmp_path):
+    polygons, jobs = anchors(), tile_jobs()
+    tiles = dict(create_masks_parallel(jobs, polygons, ZOOM, SIZE, None, workers=1, mode='L'))
+    canvas = dict(create_masks_from_canvas(((i, extent, 0) for i, extent in jobs), polygons, ZOOM, SIZE, None,
+                                           str(tmp_path), workers=1, mode='L'))
+    assert sorted(canvas) == sorted(tiles)
+    assert not list(tmp_path.iterdir())
+
+    # pixels drawn differently from the clipped polygons of a tile are on the polygon edges
+    edges = shapely.union_all([polygon.boundary for polygon in polygons])
+    different = 0
+    for i, extent in jobs:
+        rows, cols = np.nonzero(coverage(tiles[i]) != coverage(canvas[i]))
+        different += len(rows)
+        centers = shapely.points(extent[0] + (cols + .5) * ZOOM, extent[3] - (rows + .5) * ZOOM)
+        assert np.all(shapely.distance(centers, edges) <= ZOOM)
+    assert different <= 0.005 * len(jobs) * SIZE[0] * SIZE[1]
+
+
+def test_plan_tiles():
+    polygons, jobs = anchors(), tile_jobs(north=600.)
+    index = build_polygons_index(polygons)
+    extents = np.array([extent for i, extent in jobs])
+    nonempty, offsets, candidates = plan_tiles(extents, index)
+
+    # candidates of each tile: the polygons intersecting it
+    assert offsets[0] == 0 and offsets[-1] == len(candidates)
+    for k, extent in enumerate(extents):
+        expected = np.sort(index.query(shapely.box(*extent), predicate='intersects'))
+        np.testing.assert_array_equal(candidates[offsets[k]:offsets[k + 1]], expected)
+        assert nonempty[k] == bool(len(expected))
+    assert nonempty.any() and not nonempty.all()
+
+
+def test_planned_masks():
+    polygons, jobs = anchors(), tile_jobs(north=600.)
+    nonempty, offsets, candidates = plan_tiles(np.array([extent for i, extent in jobs]), build_polygons_index(polygons))
+    planned_jobs = [(i, extent, candidates[offsets[k]:offsets[k + 1]]) for k, (i, extent) in enumerate(jobs)]
+
+    masks = create_masks_parallel(jobs, polygons, ZOOM, SIZE, None, empty=False, workers=1, mode='L')
+    planned = create_masks_parallel(planned_jobs, polygons, ZOOM, SIZE, None, empty=False, workers=1, mode='L', planned=True)
+    masks, planned = list(masks), list(planned)
+    assert planned == masks
+    assert [mask is not False for i, mask in masks] == nonempty.tolist()
+
+
+def test_index_same_as_loop():
+    polygons, jobs = anchors(), tile_jobs(rows=4, cols=4, north=500.)
+    index = build_polygons_index(polygons)
+    for i, extent in jobs:
+        loop, indexed = BytesIO(), BytesIO()
+        created = create_mask(extent, polygons, ZOOM, SIZE, loop, empty=False, mode='L')
+        assert (create_mask(extent, None, ZOOM, SIZE, indexed, empty=False, index=index, mode='L') is False) == (created is False)
+        assert indexed.getvalue() == loop.getvalue()
+
+
+def test_pool_same_as_one_process(tmp_path):
+    polygons, jobs = anchors(), tile_jobs(rows=6, cols=6, north=500.)
+    masks = list(create_masks_parallel(jobs, polygons, ZOOM, SIZE, None, empty=False, workers=1, mode='L'))
+    pooled = list(create_masks_parallel(iter(jobs), polygons, ZOOM, SIZE, None, empty=False, workers=2, chunksize=5, mode='L'))
+    assert pooled == masks
+
+    # saved masks, only the non-empty ones
+    path_format = str(tmp_path / '{}_mask.png')
+    created = dict(create_masks_parallel(jobs, polygons, ZOOM, SIZE, path_format, empty=False, workers=2, chunksize=5, mode='L'))
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted('{}_mask.png'.format(i) for i, mask in masks if mask is not False)
+    for i, mask in masks:
+        assert created[i] == (mask is not False)
+        if created[i]:
+            with open(path_format.format(i), 'rb') as f: assert coverage(f.read()).tolist() == coverage(mask).tolist()
+
+
+@pytest.mark.parametrize('mode', ['LA', 'L', '1', 'npy'])
+def test_mask_modes(mode):
+    # odd width: the last byte of the packed rows is padded
+    drawn = np.random.default_rng(0).random((20, 37)) < 0.3
+    mask = encode_mask(np.where(drawn, 255, 0).astype(np.uint8), mode=mode)
+    content = BytesIO()
+    save_mask(mask, content)
+    content.seek(0)
+    if mode == 'npy':
+        assert mask.shape == (20, 5)
+        decoded = unpack_mask(np.load(content), 37)
+    else:
+        image = Image.open(content)
+        assert image.mode == mode and image.size == (37, 20)
+        decoded = np.asarray(image.convert('L')) == 0
+    np.testing.assert_array_equal(decoded, drawn)
+
+
+def test_tile_mask_modes():
+    polygons, jobs = anchors(), tile_jobs(rows=3, cols=3, north=300.)
+    drawn_pixels = 0
+    for i, extent in jobs:
+        masks = {mode: create_mask(extent, polygons, ZOOM, SIZE, BytesIO(), mode=mode) for mode in ['L', '1', 'npy']}
+        drawn = np.asarray(masks['L']) == 0
+        drawn_pixels += drawn.sum()
+        np.testing.assert_array_equal(np.asarray(masks['1'].convert('L')) == 0, drawn)
+        np.testing.assert_array_equal(unpack_mask(masks['npy'], SIZE[0]), drawn)
+    assert drawn_pixels > 0
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from fetch import create_session, getmap, fetch_tiles
+from fake_wms import FakeWMSServer
+from metrics import Metrics
+
+
+def test_fetch_tiles_in_flight():
+    in_flight, peak = [0], [0]
+    lock = threading.Lock()
+    def fetch_one(k):
+        with lock:
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+        time.sleep(0.01 * (k % 3))
+        with lock: in_flight[0] -= 1
+        return k * 10
+
+    results = list(fetch_tiles(((k, k) for k in range(20)), fetch_one, max_in_flight=4))
+    assert sorted(results) == [(k, k * 10) for k in range(20)]
+    assert 1 < peak[0] <= 4
+
+
+def test_fetch_tiles_ordered():
+    results = fetch_tiles(((k, k) for k in range(10)), lambda k: time.sleep(0.01 * (k % 3)) or k, max_in_flight=4, ordered=True)
+    assert list(results) == [(k, k) for k in range(10)]
+
+
+def test_fetch_tiles_exceptions():
+    def fetch_one(k):
+        if k == 3: raise ValueError(k)
+        return k
+
+    results = dict(fetch_tiles(((k, k) for k in range(5)), fetch_one, return_exceptions=True))
+    assert isinstance(results.pop(3), ValueError)
+    assert results == {0: 0, 1: 1, 2: 2, 4: 4}
+    with pytest.raises(ValueError):
+        list(fetch_tiles(((k, k) for k in range(5)), fetch_one))
+
+
+def test_getmap_retries():
+    metrics = Metrics()
+    with FakeWMSServer(error_rate=0.3) as server:
+        session = create_session()
+        for k in range(10):
+            content = getmap(session, server.url, 'layer', (0, 0, 100 + k, 100), (64, 32), retries=10, backoff=0.001, metrics=metrics)
+            assert Image.open(BytesIO(content)).size == (64, 32)
+        assert server.errors > 0
+    assert metrics.counters['retries'] == server.errors
+    assert metrics.counters['requests'] == server.requests
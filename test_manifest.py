@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from manifest import JobManifest, PENDING, DONE, EMPTY, FAILED
+
+
+PARAMS = {'zoom_level': 14, 'tile_size': (512, 512)}
+EXTENTS = np.arange(40, dtype=np.float64).reshape(10, 4)
+
+
+def run(path, params=PARAMS, extents=EXTENTS):
+    manifest = JobManifest(str(path), params, commit_every=3)
+    manifest.set_tiles(extents)
+    return manifest
+
+
+def test_resume(tmp_path):
+    manifest = run(tmp_path / 'manifest.sqlite')
+    assert manifest.count() == 10 and manifest.count(mask=PENDING) == 10
+    manifest.set_mask(1, DONE)
+    manifest.set_image(1, DONE)
+    manifest.set_mask(2, EMPTY)
+    manifest.set_mask(3, DONE)
+    manifest.set_image(3, FAILED)
+    manifest.close()
+
+    # statuses are kept with the same parameters and tiles
+    manifest = run(tmp_path / 'manifest.sqlite')
+    assert manifest.status(1) == (DONE, DONE)
+    assert manifest.statuses([1, 2, 3, 4]) == {1: (DONE, DONE), 2: (EMPTY, PENDING), 3: (DONE, FAILED), 4: (PENDING, PENDING)}
+    assert len(manifest.statuses()) == 10
+    assert manifest.count(image=FAILED) == 1 and manifest.count(mask=EMPTY) == 1
+    manifest.close()
+
+
+def test_reset_params(tmp_path):
+    manifest = run(tmp_path / 'manifest.sqlite')
+    manifest.set_image(1, DONE)
+    manifest.close()
+
+    manifest = run(tmp_path / 'manifest.sqlite', dict(PARAMS, zoom_level=15))
+    assert manifest.count(image=DONE) == 0 and manifest.count() == 10
+    manifest.close()
+
+
+def test_reset_tiles(tmp_path):
+    manifest = run(tmp_path / 'manifest.sqlite')
+    manifest.set_image(1, DONE)
+    manifest.close()
+
+    extents = EXTENTS.copy()
+    extents[5] += 1
+    manifest = run(tmp_path / 'manifest.sqlite', extents=extents[:8])
+    assert manifest.count() == 8 and manifest.count(image=DONE) == 0
+    manifest.close()
+
+
+def test_statuses_by_chunks(tmp_path):
+    manifest = run(tmp_path / 'manifest.sqlite', extents=np.zeros((2500, 4)))
+    manifest.set_image(2400, DONE)
+    statuses = manifest.statuses(np.arange(1, 2501, 2), chunk_size=100)
+    assert len(statuses) == 1250 and statuses[2399] == (PENDING, PENDING)
+    assert manifest.statuses([2400, 3000]) == {2400: (PENDING, DONE)}
+    manifest.close()
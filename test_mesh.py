@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+from shapely.geometry import box, LineString, MultiPolygon, Point
+
+from mesh import mesh_grid, create_mesh_extents, create_mesh_array, create_meshes_array, iter_mesh_array
+from mesh import save_extents, load_extents, save_meshes
+from mesh import GRID_ORIGIN, create_grid_keys, create_grid_meshes, grid_keys_to_extents
+from mesh import explode_polygons, save_anchors_cache, load_anchors_cache
+from mesh import extents_to_file, partition_tiles, group_bounds
+
+
+SRS = {13: 19.1092570713, 14: 9.5546285356, 15: 4.7773142678}
+SIZE = (512, 512)
+SETS = [(100000., 6000000., 130000., 6030000.), (125000., 6010000., 160000., 6020000.), (0., 0., 1000., 1000.)]
+
+
+@pytest.mark.parametrize('align', [False, True])
+def test_mesh_array_same_as_extents(align):
+    for canvas_extent in SETS:
+        expected = np.array(create_mesh_extents(canvas_extent, 0.3, 0.01, SIZE, SRS, 14, align=align)).reshape(-1, 4)
+        np.testing.assert_allclose(create_mesh_array(canvas_extent, 0.3, 0.01, SIZE, SRS, 14, align=align), expected)
+
+
+def test_meshes_array():
+    extents, set_ids = create_meshes_array(SETS, 0.7, 0.01, SIZE, SRS, 14)
+    meshes = [create_mesh_array(canvas_extent, 0.7, 0.01, SIZE, SRS, 14) for canvas_extent in SETS]
+    np.testing.assert_array_equal(extents, np.concatenate(meshes))
+    assert set_ids.tolist() == sum([[k] * len(mesh) for k, mesh in enumerate(meshes)], [])
+    assert len(meshes[2]) == 0
+
+    # chunks of whole rows, in the same order
+    chunks = list(iter_mesh_array(SETS, 0.7, 0.01, SIZE, SRS, 14, chunk_size=100))
+    assert max(len(chunk) for chunk, chunk_set_ids in chunks) <= 100
+    np.testing.assert_array_equal(np.concatenate([chunk for chunk, chunk_set_ids in chunks]), extents)
+    np.testing.assert_array_equal(np.concatenate([chunk_set_ids for chunk, chunk_set_ids in chunks]), set_ids)
+
+
+def test_mesh_grid_align():
+    zoom = SRS[14]
+    origin, tile, step, count = mesh_grid(SETS[0], 0.7, 0.01, SIZE, SRS, 14)
+    assert step == pytest.approx((512 * 0.3 * zoom, 512 * 0.3 * zoom))
+
+    # aligned: the step is a whole number of pixels, tiles stay inside the canvas
+    origin, tile, step, count = mesh_grid(SETS[0], 0.7, 0.01, SIZE, SRS, 14, align=True)
+    assert step == pytest.approx((154 * zoom, 154 * zoom))
+    assert tile == pytest.approx((512 * zoom, 512 * zoom))
+    extents = create_mesh_array(SETS[0], 0.7, 0.01, SIZE, SRS, 14, align=True)
+    assert len(extents) == count[0] * count[1]
+    offsets = (extents[:, [0, 3]] - extents[0, [0, 3]]) / zoom
+    np.testing.assert_allclose(offsets, np.rint(offsets), atol=1e-6)
+    assert extents[:, 2].max() <= SETS[0][2] and extents[:, 1].min() >= SETS[0][1]
+
+
+def test_save_load_extents(tmp_path):
+    path = str(tmp_path / 'extents.npy')
+    extents, set_ids = create_meshes_array(SETS, 0.7, 0.01, SIZE, SRS, 14)
+    save_extents(path, extents, set_ids, zoom_level=14, tile_size=list(SIZE))
+    loaded, loaded_set_ids, header = load_extents(path)
+    np.testing.assert_array_equal(loaded, extents)
+    np.testing.assert_array_equal(loaded_set_ids, set_ids)
+    assert header == {'zoom_level': 14, 'tile_size': [512, 512], 'count': len(extents)}
+    assert not loaded.flags.writeable
+
+    # the same file written chunk by chunk
+    chunked_path = str(tmp_path / 'chunked.npy')
+    assert save_meshes(chunked_path, SETS, 0.7, 0.01, SIZE, SRS, 14, header={'zoom_level': 14}) == len(extents)
+    loaded, loaded_set_ids, header = load_extents(chunked_path)
+    np.testing.assert_array_equal(loaded, extents)
+    np.testing.assert_array_equal(loaded_set_ids, set_ids)
+    assert header == {'zoom_level': 14, 'align': False, 'count': len(extents)}
+
+    with open(path + '.json', 'w') as f: json.dump({'count': len(extents) + 1}, f)
+    with pytest.raises(ValueError): load_extents(path)
+
+
+def test_grid_meshes():
+    zoom = SRS[14]
+    sets = [SETS[0], (115000., 6010000., 160000., 6020000.)]
+    keys = [create_grid_keys(canvas_extent, 0.7, 0.01, SIZE, SRS, 14) for canvas_extent in sets]
+    for canvas_extent, set_keys in zip(sets, keys):
+        extents = grid_keys_to_extents(set_keys, 0.7, SIZE, SRS)
+        assert (extents[:, 0] >= canvas_extent[0]).all() and (extents[:, 2] <= canvas_extent[2]).all()
+        assert (extents[:, 1] >= canvas_extent[1]).all() and (extents[:, 3] <= canvas_extent[3]).all()
+        # snapped on the global grid, with a whole number of pixels
+        offsets = (extents[:, [0, 3]] - GRID_ORIGIN) / zoom
+        np.testing.assert_allclose(offsets, np.rint(offsets), atol=1e-4)
+        np.testing.assert_allclose(extents[:, 2] - extents[:, 0], 512 * zoom)
+
+    # the tiles of the overlap are shared, and kept once with the first set
+    grid_keys, set_ids = create_grid_meshes(sets, 0.7, 0.01, SIZE, SRS, 14)
+    shared = set(map(tuple, keys[0])) & set(map(tuple, keys[1]))
+    assert shared
+    assert len(grid_keys) == len(keys[0]) + len(keys[1]) - len(shared)
+    assert len(set(map(tuple, grid_keys))) == len(grid_keys)
+    assert all(set_id == 0 for key, set_id in zip(map(tuple, grid_keys), set_ids) if key in shared)
+    assert list(map(tuple, grid_keys[:, [2, 1]])) == sorted(map(tuple, grid_keys[:, [2, 1]]))
+    assert (grid_keys[:, 0] == 14).all()
+
+
+def test_anchors_cache(tmp_path):
+    geometries = [box(0, 0, 1, 1), MultiPolygon([box(2, 2, 3, 3), box(4, 4, 5, 5)]), LineString([(0, 0), (1, 1)]), Point(0, 0)]
+    polygons = explode_polygons(geometries)
+    assert [polygon.bounds for polygon in polygons] == [(0, 0, 1, 1), (2, 2, 3, 3), (4, 4, 5, 5)]
+
+    path = str(tmp_path / 'anchors.parquet')
+    assert load_anchors_cache(path, zoom_level=14) is None
+    save_anchors_cache(path, polygons, zoom_level=14, fingerprint='abc')
+    loaded = load_anchors_cache(path, zoom_level=14, fingerprint='abc')
+    assert len(loaded) == 3 and all(shapely.equals(a, b) for a, b in zip(loaded, polygons))
+
+    # another key, or a file left without its header, is not used
+    assert load_anchors_cache(path, zoom_level=14, fingerprint='def') is None
+    assert load_anchors_cache(path, zoom_level=15) is None
+    save_anchors_cache(path, polygons[:1], zoom_level=15)
+    assert len(load_anchors_cache(path, zoom_level=15)) == 1
+    (tmp_path / 'anchors.parquet.json').unlink()
+    assert load_anchors_cache(path) is None
+
+
+@pytest.mark.parametrize('extension', ['.fgb', '.gpkg', '.parquet'])
+def test_extents_to_file(tmp_path, extension):
+    extents, set_ids = create_meshes_array(SETS, 0.7, 0.01, SIZE, SRS, 14)
+    path = str(tmp_path / ('tiles' + extension))
+    extents_to_file(extents, path, tile_id=np.arange(1, len(extents) + 1), set_id=set_ids)
+    gdf = gpd.read_parquet(path) if extension == '.parquet' else gpd.read_file(path)
+    assert gdf.crs.to_epsg() == 3857
+    # FlatGeobuf sorts the features along its spatial index
+    gdf = gdf.sort_values('tile_id')
+    assert gdf['tile_id'].tolist() == list(range(1, len(extents) + 1))
+    assert gdf['set_id'].tolist() == set_ids.tolist()
+    np.testing.assert_allclose(gdf.geometry.bounds.values, extents)
+
+
+def test_partition_tiles():
+    set_ids = np.array([3, 0, 1, 3, 0, 7, 1])
+    partitions = [tile_ids.tolist() for tile_ids in partition_tiles(set_ids, 2)]
+    # sets 0-1, 2-3, (4-5 has no tile), 6-7
+    assert partitions == [[2, 3, 5, 7], [1, 4], [6]]
+    assert [tile_ids.tolist() for tile_ids in partition_tiles(set_ids, 10)] == [list(range(1, 8))]
+    assert list(partition_tiles(np.empty(0, dtype=int), 2)) == []
+
+
+def test_group_bounds():
+    extents = np.array([[0, 0, 1, 1], [5, 5, 6, 6], [-1, 2, 0, 3], [10, 10, 11, 12]], dtype=np.float64)
+    bounds = group_bounds(extents, [4, 2, 4, 2])
+    np.testing.assert_array_equal(bounds, [[5, 5, 11, 12], [-1, 0, 1, 3]])
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from metatiles import create_metatiles, fetch_metatiles
+
+
+ZOOM = 2.
+SIZE = (64, 48)
+
+
+def render(extent, size):
+    # png of a pattern that depends on the absolute pixel position only
+    x = np.rint(extent[0] / ZOOM).astype(int) + np.arange(size[0])
+    y = np.rint(-extent[3] / ZOOM).astype(int) + np.arange(size[1])
+    pixels = np.stack(np.broadcast_arrays(x[None, :] % 256, y[:, None] % 256, (x[None, :] * y[:, None]) % 251), axis=-1)
+    out = BytesIO()
+    Image.fromarray(pixels.astype(np.uint8)).save(out, format='PNG')
+    return out.getvalue()
+
+
+def tile_jobs(rows, cols, step=(40, 30), origin=(1000., 5000.)):
+    jobs = []
+    for row in range(rows):
+        for col in range(cols):
+            w, n = origin[0] + col * step[0] * ZOOM, origin[1] - row * step[1] * ZOOM
+            jobs.append(((row, col), (w, n - SIZE[1] * ZOOM, w + SIZE[0] * ZOOM, n)))
+    return jobs
+
+
+def test_metatiles_cover_every_tile():
+    jobs = tile_jobs(7, 9)
+    metatiles = create_metatiles(jobs, SIZE, ZOOM, max_size=256)
+    assert len(metatiles) > 1
+    keys = [key for extent, size, crops in metatiles for key, crop_box in crops]
+    assert sorted(keys) == sorted(key for key, extent in jobs)
+    for extent, size, crops in metatiles:
+        assert max(size) <= 256
+        assert np.allclose([extent[2] - extent[0], extent[3] - extent[1]], np.array(size) * ZOOM)
+
+
+def test_cropped_tiles_same_as_tiles():
+    jobs = tile_jobs(5, 6)
+    tiles = dict(fetch_metatiles(create_metatiles(jobs, SIZE, ZOOM, max_size=200), render, max_in_flight=2))
+    assert len(tiles) == len(jobs)
+    for key, extent in jobs:
+        cropped = np.asarray(Image.open(BytesIO(tiles[key])))
+        np.testing.assert_array_equal(cropped, np.asarray(Image.open(BytesIO(render(extent, SIZE)))))
+
+
+def test_not_aligned():
+    jobs = tile_jobs(2, 2)
+    jobs[1] = (jobs[1][0], tuple(value + 0.3 * ZOOM for value in jobs[1][1]))
+    with pytest.raises(ValueError): create_metatiles(jobs, SIZE, ZOOM)
+
+
+def test_failed_metatile():
+    def fail(extent, size): raise IOError("server down")
+    jobs = tile_jobs(2, 3)
+    tiles = dict(fetch_metatiles(create_metatiles(jobs, SIZE, ZOOM), fail, return_exceptions=True))
+    assert sorted(tiles) == sorted(key for key, extent in jobs)
+    assert all(isinstance(content, IOError) for content in tiles.values())
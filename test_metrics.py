@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import pickle
+import cProfile
+
+import pytest
+
+from metrics import Histogram, Metrics, Progress, timer, profiled
+
+
+def test_histogram_percentiles():
+    histogram = Histogram()
+    for k in range(1, 1001): histogram.add(k / 1000)
+    # bucket upper bounds: within 26% above the exact percentile
+    for q in [50, 95, 99]:
+        assert q / 100 <= histogram.percentile(q) <= 1.26 * q / 100
+    assert histogram.percentile(100) == 1.
+    summary = histogram.summary()
+    assert summary['count'] == 1000 and summary['min'] == 0.001 and summary['max'] == 1.
+    assert summary['mean'] == pytest.approx(0.5005)
+    assert Histogram().summary() == {'count': 0}
+
+
+def test_metrics_merge(tmp_path):
+    worker = Metrics()
+    worker.count('tiles', 3)
+    worker.observe('mask', 0.01)
+    with pytest.raises(ValueError):
+        with timer(worker, 'mask'): raise ValueError()
+    with timer(None, 'mask'): pass
+
+    # metrics of a process are pickled to the main one
+    metrics = Metrics()
+    metrics.count('tiles')
+    metrics.observe('mask', 0.02)
+    metrics.merge(pickle.loads(pickle.dumps(worker)))
+    metrics.merge(pickle.loads(pickle.dumps(worker)))
+    assert metrics.counters == {'tiles': 7}
+    assert metrics.histograms['mask'].count == 5 and metrics.histograms['mask'].max == 0.02
+
+    metrics.save(str(tmp_path / 'metrics.json'))
+    with open(str(tmp_path / 'metrics.json')) as f: saved = json.load(f)
+    assert saved['counters'] == {'tiles': 7} and saved['latency']['mask']['count'] == 5
+
+
+def test_progress():
+    out = io.StringIO()
+    progress = Progress(10, interval=3600, out=out)
+    for k in range(9): progress.update()
+    # the first update only, then the last one
+    lines = out.getvalue().split('\r')[1:]
+    assert len(lines) == 1 and lines[0].startswith('1 / 10 tiles (10.0%)')
+    progress.update()
+    progress.close()
+    lines = out.getvalue().split('\r')[1:]
+    assert len(lines) == 2 and lines[1].startswith('10 / 10 tiles (100.0%)') and lines[1].endswith('\n')
+
+
+def test_profiled():
+    profile = cProfile.Profile()
+    assert list(profiled(lambda items: (item * 2 for item in items), profile)(range(3))) == [0, 2, 4]
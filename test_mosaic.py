@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from mosaic import tile_name, parse_tile_name, mosaic_tiles
+
+
+TILE_SIZE = (40, 30)
+
+
+def save_tiles(folder, image, overlapse, rows, cols, suffix=''):
+    # tiles cut from image, a whole number of pixels apart
+    step_width, step_heigth = round(TILE_SIZE[0] * (1 - overlapse)), round(TILE_SIZE[1] * (1 - overlapse))
+    for row in range(1, rows + 1):
+        for col in range(1, cols + 1):
+            left, top = (col - 1) * step_width, (row - 1) * step_heigth
+            tile = image[top:top + TILE_SIZE[1], left:left + TILE_SIZE[0]]
+            Image.fromarray(tile).save(str(folder / (tile_name(row, col, suffix) + '.png')))
+
+
+def test_tile_names():
+    assert parse_tile_name(tile_name(12, 3, '_mask') + '.png', '_mask') == (12, 3)
+    assert parse_tile_name('12_3.png', '_mask') is None
+    assert parse_tile_name('23.png') == (2, 3)
+    assert parse_tile_name('123.png') is None
+
+
+@pytest.mark.parametrize('extension', ['.png', '.npy'])
+@pytest.mark.parametrize('blend', [True, False])
+def test_mosaic_same_as_map(tmp_path, extension, blend):
+    # 4 rows and 5 columns of tiles, 16 and 12 pixels apart
+    image = np.random.default_rng(0).integers(0, 256, (3 * 12 + 30, 4 * 16 + 40, 3), dtype=np.uint8)
+    save_tiles(tmp_path, image, 0.6, 4, 5)
+    out_path = str(tmp_path / ('map' + extension))
+    assert mosaic_tiles(str(tmp_path), out_path, TILE_SIZE, overlapse=0.6, blend=blend) == (104, 66)
+    mosaic = np.load(out_path) if extension == '.npy' else np.asarray(Image.open(out_path))
+    np.testing.assert_array_equal(mosaic, image)
+
+
+def test_mosaic_masks(tmp_path):
+    image = np.where(np.random.default_rng(1).random((2 * 30, 3 * 40)) < 0.5, 0, 255).astype(np.uint8)
+    save_tiles(tmp_path, image, 0, 2, 3, suffix='_mask')
+    (tmp_path / tile_name(2, 2, '_mask')).with_suffix('.png').unlink()
+    Image.new('RGB', TILE_SIZE).save(str(tmp_path / '1_1.png'))
+
+    # only the masks, a missing tile is left black
+    out_path = str(tmp_path / 'map_mask.png')
+    assert mosaic_tiles(str(tmp_path), out_path, TILE_SIZE, suffix='_mask') == (120, 60)
+    expected = image.copy()
+    expected[30:, 40:80] = 0
+    np.testing.assert_array_equal(np.asarray(Image.open(out_path)), expected)
+    with pytest.raises(ValueError): mosaic_tiles(str(tmp_path), out_path, TILE_SIZE, suffix='_other')
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+from io import BytesIO
+
+import pytest
+import shapely
+from PIL import Image
+
+from fetch import create_session, getmap
+from fake_wms import FakeWMSServer, make_png
+from perf_bench import synthetic_polygons, synthetic_set_extents, summarize, measure
+
+
+EXTENT = (100000, 6000000, 160000, 6060000)
+
+
+def test_synthetic_data():
+    polygons = synthetic_polygons(50, EXTENT, seed=1)
+    assert len(polygons) == 50 and all(polygon.is_valid for polygon in polygons)
+    assert any(polygon.interiors for polygon in polygons)
+    assert all(shapely.equals(a, b) for a, b in zip(polygons, synthetic_polygons(50, EXTENT, seed=1)))
+
+    set_extents = synthetic_set_extents(4, EXTENT, 20000, seed=1)
+    for w, s, e, n in set_extents:
+        assert (e - w, n - s) == (20000, 20000)
+        assert EXTENT[0] <= w and e <= EXTENT[2] and EXTENT[1] <= s and n <= EXTENT[3]
+
+
+def test_measures():
+    assert summarize([3, 1, 2]) == pytest.approx({'count': 3, 'total': 6., 'min': 1., 'mean': 2., 'p50': 2., 'p95': 2.9, 'max': 3.})
+    assert summarize([]) == {'count': 0}
+    calls = []
+    result = measure(lambda: calls.append(bytearray(1024**2)), repeat=3)
+    assert len(calls) == 5 and result['seconds']['count'] == 3
+    assert result['peak_memory_mb'] >= 1
+
+
+def test_fake_server():
+    assert 50000 <= len(make_png((256, 256), payload_size=60000)) <= 70000
+    with FakeWMSServer(payload_size=20000) as server:
+        content = getmap(create_session(), server.url, 'layer', (0, 0, 100, 50), (128, 64))
+        assert Image.open(BytesIO(content)).size == (128, 64)
+        assert server.requests == 1 and server.bytes_sent == len(content) > 20000
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+import pytest
+
+from pipeline import run_pipeline
+
+
+def double(items):
+    for item in items: yield item * 2
+
+
+def test_stages_in_order():
+    assert list(run_pipeline(range(100), [double, double], maxsize=4)) == [k * 4 for k in range(100)]
+    assert list(run_pipeline(range(10), [])) == list(range(10))
+
+
+def test_backpressure():
+    produced = []
+    def source():
+        for k in range(100):
+            produced.append(k)
+            yield k
+
+    outputs = run_pipeline(source(), [double], maxsize=2)
+    assert next(outputs) == 0
+    # the source stays a few queues ahead of the caller
+    threading.Event().wait(0.3)
+    assert len(produced) <= 8
+    assert list(outputs) == [k * 2 for k in range(1, 100)]
+
+
+def test_stage_error():
+    def fail(items):
+        for item in items:
+            if item == 50: raise ValueError(item)
+            yield item
+
+    threads = threading.active_count()
+    with pytest.raises(ValueError):
+        list(run_pipeline(range(1000), [double, fail, double], maxsize=4))
+    with pytest.raises(ZeroDivisionError):
+        list(run_pipeline((1 / (5 - k) for k in range(10)), [double]))
+    assert threading.active_count() == threads
+
+
+def test_caller_stops():
+    threads = threading.active_count()
+    outputs = run_pipeline(iter(int, 1), [double], maxsize=4)
+    assert next(outputs) == 0
+    outputs.close()
+    assert threading.active_count() == threads
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+from io import BytesIO
+
+import numpy as np
+import pytest
+import shapely
+
+from create_masks import create_mask
+from pyramid import FineGrid, derive_tiles, level_factor, mask_to_coverage
+
+
+SIZE = (64, 64)
+STEP = (40, 40) # pixels between two fine tiles
+FINE_ZOOM = 0.5
+ORIGIN = (0., 400.)
+
+
+def anchors(count=60, seed=1):
+    # discs of various sizes, a third of them with a hole
+    rng = np.random.default_rng(seed)
+    centers, radii = rng.uniform(0, 400, (count, 2)), rng.uniform(10, 60, count)
+    polygons = [shapely.Point(x, y).buffer(r, 8) for (x, y), r in zip(centers, radii)]
+    return [polygon.difference(polygon.centroid.buffer(polygon.area ** .5 / 5, 4)) if k % 3 == 0 else polygon
+            for k, polygon in enumerate(polygons)]
+
+
+def grid_extents(zoom, count):
+    # extents of count x count tiles, STEP pixels apart from ORIGIN
+    extents = []
+    for row in range(count):
+        for col in range(count):
+            w, n = ORIGIN[0] + col * STEP[0] * zoom, ORIGIN[1] - row * STEP[1] * zoom
+            extents.append((w, n - SIZE[1] * zoom, w + SIZE[0] * zoom, n))
+    return extents
+
+
+def render(extent, polygons, zoom):
+    return mask_to_coverage(create_mask(extent, polygons, zoom, SIZE, BytesIO(), mode='L'), SIZE[0])
+
+
+def test_level_factor():
+    srs = {13: 19.1092570713, 14: 9.5546285356, 15: 4.7773142678}
+    assert level_factor(srs, 15, 13) == 4
+    with pytest.raises(ValueError): level_factor(srs, 14, 15)
+
+
+def test_derived_masks_close_to_direct_rendering():
+    polygons, factor = anchors(), 2
+    fine_extents = grid_extents(FINE_ZOOM, 22)
+    fine_ids = list(range(1, len(fine_extents) + 1))
+    grid = FineGrid(ORIGIN, STEP, SIZE, FINE_ZOOM, fine_extents, fine_ids)
+    masks = {i: render(extent, polygons, FINE_ZOOM) for i, extent in zip(fine_ids, fine_extents)}
+    image = np.zeros((SIZE[1], SIZE[0], 3), dtype=np.uint8)
+
+    # coarse tiles inside the fine tiles: derived without fallback
+    zoom = FINE_ZOOM * factor
+    jobs = [(i, extent, 0) for i, extent in enumerate(grid_extents(zoom, 5), start=1)]
+    derived = list(derive_tiles(jobs, {0: grid}, factor, SIZE, lambda i: image, masks.get))
+    assert [i for i, image, coverage in derived] == [i for i, extent, group in jobs]
+
+    # majority downsampling differs from direct rendering on the polygon edges only
+    edges = shapely.union_all([polygon.boundary for polygon in polygons])
+    different = 0
+    for (i, extent, group), (_, image, coverage) in zip(jobs, derived):
+        assert image.size == SIZE
+        rows, cols = np.nonzero(render(extent, polygons, zoom) != coverage)
+        different += len(rows)
+        centers = shapely.points(extent[0] + (cols + .5) * zoom, extent[3] - (rows + .5) * zoom)
+        assert np.all(shapely.distance(centers, edges) <= zoom)
+    assert different <= 0.01 * len(jobs) * SIZE[0] * SIZE[1]
+
+
+def test_fallback_outside_fine_tiles():
+    extents = grid_extents(FINE_ZOOM, 3)
+    grid = FineGrid(ORIGIN, STEP, SIZE, FINE_ZOOM, extents, range(1, 10))
+    blank = np.zeros((SIZE[1], SIZE[0]), dtype=bool)
+    calls = []
+    def fallback(i, extent, size):
+        calls.append(i)
+        return None, blank
+
+    # second tile is not covered by the fine tiles
+    jobs = [(1, grid_extents(FINE_ZOOM * 2, 1)[0], 0), (2, (500., 300., 564., 364.), 0)]
+    derived = list(derive_tiles(jobs, {0: grid}, 2, SIZE, lambda i: None, lambda i: blank, fallback, empty=False))
+    assert calls == [2]
+    assert derived[0][1] is None and not derived[0][2].any()
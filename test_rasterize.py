@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+from shapely import Polygon, box, affinity
+from PIL import Image, ImageDraw
+
+from create_masks import rasterize_polygons
+
+
+EXTENT = (1000., 2000., 1256., 2256.)
+ZOOM = 1.
+SIZE = (256, 256)
+
+
+def composite(polygons, extent, zoom, img_size):
+    # Drawing of the masks before rasterize_polygons: one image per polygon
+    # (holes transparent) pasted on the mask, True where a polygon is drawn
+    w, s = extent[0], extent[1]
+    mask = Image.new(mode='LA', size=img_size, color='white')
+    for polygon in polygons:
+        img = Image.new(mode='LA', size=img_size, color=(0, 0))
+        draw = ImageDraw.Draw(img)
+        polygon = affinity.scale(affinity.translate(polygon, xoff=-w, yoff=-s), xfact=1/zoom, yfact=1/zoom, origin=(0, 0))
+        draw.polygon(polygon.exterior.coords, fill="black")
+        for ring in polygon.interiors:
+            draw.polygon(ring.coords, fill=(0, 0))
+        mask.paste(img, mask=img)
+    return np.asarray(mask)[..., 0] == 0
+
+
+def holed(bounds, hole):
+    return Polygon(box(*bounds).exterior.coords, [box(*hole).exterior.coords])
+
+
+CASES = {
+    'disjoint': [box(1010, 2010, 1050, 2050), box(1100.5, 2100.2, 1180.7, 2190.3)],
+    'overlapping holes': [holed((1020, 2020, 1150, 2150), (1050, 2050, 1120, 2120)),
+                          holed((1080, 2080, 1230, 2230), (1100, 2100, 1200, 2200))],
+    'polygon in a hole': [holed((1020, 2020, 1200, 2200), (1060, 2060, 1160, 2160)),
+                          box(1080.3, 2080.6, 1130.2, 2140.9)],
+    'hole over a polygon': [box(1080, 2080, 1130, 2140),
+                            holed((1020, 2020, 1200, 2200), (1060, 2060, 1160, 2160))],
+    'crossing the extent': [holed((950, 1950, 1300, 2300), (1100, 2100, 1150, 2150)),
+                            Polygon([(1120, 2120), (1300, 2130), (1140, 2300)])],
+    'several holes': [Polygon(box(1010, 2010, 1240, 2240).exterior.coords,
+                              [box(1030, 2030, 1070, 2070).exterior.coords, box(1150, 2150, 1200, 2220).exterior.coords]),
+                      holed((1040, 2040, 1170, 2170), (1090, 2090, 1110, 2110))],
+}
+
+
+@pytest.mark.parametrize('name', sorted(CASES))
+def test_same_as_composite(name):
+    polygons = CASES[name]
+    coverage = rasterize_polygons(polygons, EXTENT, ZOOM, SIZE)
+    assert coverage.dtype == np.uint8
+    assert set(np.unique(coverage).tolist()) <= {0, 255}
+    np.testing.assert_array_equal(coverage == 255, composite(polygons, EXTENT, ZOOM, SIZE))
+
+
+def test_buffer_is_reset():
+    out = np.full((SIZE[1], SIZE[0]), 255, dtype=np.uint8)
+    polygons = CASES['overlapping holes']
+    coverage = rasterize_polygons(polygons, EXTENT, ZOOM, SIZE, out=out)
+    assert coverage is out
+    np.testing.assert_array_equal(coverage == 255, composite(polygons, EXTENT, ZOOM, SIZE))
+
+
+def test_no_polygon():
+    assert not rasterize_polygons([], EXTENT, ZOOM, SIZE).any()
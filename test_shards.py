@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tarfile
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from shards import ShardWriter, ShardReader
+
+
+def sample(i):
+    # image and mask file contents of various sizes, not multiples of a tar block
+    return bytes([i % 256]) * (100 + 37 * i), b'mask' * (i + 1)
+
+
+def test_index_round_trip(tmp_path):
+    writer = ShardWriter(str(tmp_path), shard_size=4)
+    written = []
+    for i in range(10): written += writer.write(i, *sample(i))
+    assert written == list(range(8))
+    assert writer.close() == [8, 9]
+    assert sorted(os.listdir(tmp_path)) == ['index.npy', 'shard-000000.tar', 'shard-000001.tar', 'shard-000002.tar']
+
+    reader = ShardReader(str(tmp_path))
+    assert len(reader) == 10 and 9 in reader and 10 not in reader
+    for i in range(10): assert reader[i] == sample(i)
+    with pytest.raises(KeyError): reader[10]
+    reader.close()
+
+    # the shards are valid tar files
+    with tarfile.open(str(tmp_path / 'shard-000001.tar')) as tar:
+        assert tar.getnames() == ['4.png', '4_mask.png', '5.png', '5_mask.png', '6.png', '6_mask.png', '7.png', '7_mask.png']
+        assert tar.extractfile('5.png').read() == sample(5)[0]
+
+
+def test_rewrite(tmp_path):
+    writer = ShardWriter(str(tmp_path), shard_size=4)
+    for i in range(3): writer.write(i, *sample(i))
+    writer.close()
+
+    # new shards are added, a sample written again replaces the previous one
+    writer = ShardWriter(str(tmp_path), shard_size=4)
+    writer.write(1, b'new', b'new mask')
+    writer.write(5, *sample(5))
+    writer.close()
+    reader = ShardReader(str(tmp_path))
+    assert reader.samples().tolist() == [0, 1, 2, 5]
+    assert reader[1] == (b'new', b'new mask') and reader[2] == sample(2)
+    reader.close()
+
+
+def test_load(tmp_path):
+    image, mask = BytesIO(), BytesIO()
+    Image.new('RGB', (8, 4), (1, 2, 3)).save(image, format='PNG')
+    np.save(mask, np.packbits(np.eye(4, 8, dtype=bool), axis=1))
+    writer = ShardWriter(str(tmp_path), mask_suffix='_mask.npy')
+    writer.write(0, image.getvalue(), mask.getvalue())
+    writer.close()
+
+    reader = ShardReader(str(tmp_path))
+    image, mask = reader.load(0)
+    assert image.size == (8, 4) and image.getpixel((0, 0)) == (1, 2, 3)
+    np.testing.assert_array_equal(mask, np.packbits(np.eye(4, 8, dtype=bool), axis=1))
+    reader.close()
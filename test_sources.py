@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from fetch import create_session
+from fake_wms import FakeWMSServer
+from mesh import GRID_ORIGIN
+from sources import WMTSSource, WMTS_TILE_SIZE
+
+
+SRS = {5: 1000.}
+
+
+def pixels(x, y):
+    # colour of the global pixels (x, y) of the tile matrix
+    return np.stack(np.broadcast_arrays(x[None, :] % 256, y[:, None] % 256, (x[None, :] + 3 * y[:, None]) % 251), axis=-1).astype(np.uint8)
+
+
+class PatternSource(WMTSSource):
+    # tiles drawn locally, requests are only counted
+    def get_tile(self, col, row):
+        self.tiles.append((col, row))
+        x, y = col * WMTS_TILE_SIZE + np.arange(WMTS_TILE_SIZE), row * WMTS_TILE_SIZE + np.arange(WMTS_TILE_SIZE)
+        out = BytesIO()
+        Image.fromarray(pixels(x, y)).save(out, format='PNG')
+        return out.getvalue()
+
+
+def extent_of(x, y, size, resolution=SRS[5]):
+    # extent of size pixels from the global pixel (x, y)
+    w, n = GRID_ORIGIN[0] + x * resolution, GRID_ORIGIN[1] - y * resolution
+    return (w, n - size[1] * resolution, w + size[0] * resolution, n)
+
+
+def test_mosaic_aligned():
+    source = PatternSource(None, 'http://wmts', 'layer', 5, SRS)
+    source.tiles = []
+    # across 3 x 2 tiles
+    x, y, size = 200, 200, (400, 150)
+    image = np.asarray(Image.open(BytesIO(source(extent_of(x, y, size), size))))
+    np.testing.assert_array_equal(image, pixels(x + np.arange(size[0]), y + np.arange(size[1])))
+    assert sorted(source.tiles) == [(col, row) for col in range(3) for row in range(2)]
+    source.close()
+
+
+def test_mosaic_resampled():
+    source = PatternSource(None, 'http://wmts', 'layer', 5, SRS)
+    source.tiles = []
+    # half a pixel off the tile pixels
+    extent = extent_of(100.5, 20, (64, 32))
+    image = Image.open(BytesIO(source(extent, (64, 32))))
+    assert image.size == (64, 32)
+    assert sorted(source.tiles) == [(0, 0)]
+    source.close()
+
+
+def test_get_tile_requests():
+    with FakeWMSServer() as server:
+        source = WMTSSource(create_session(), server.url, 'layer', 5, SRS, max_in_flight=4)
+        image = Image.open(BytesIO(source(extent_of(250, 10, (300, 300)), (300, 300))))
+        assert image.size == (300, 300)
+        # 3 x 2 covering tiles
+        assert server.requests == 6
+        source.close()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import numpy as np
+import pytest
+from sqlalchemy import create_engine
+
+from manifest import PENDING, DONE, EMPTY, FAILED
+from workqueue import WorkQueue, LEASED
+
+
+EXTENTS = np.array([(i, 2 * i, i + 1, 2 * i + 1) for i in range(10)], dtype=np.float64)
+SET_IDS = np.repeat([0, 1], 5)
+
+
+@pytest.fixture
+def engine(tmp_path):
+    return create_engine('sqlite:///' + str(tmp_path / 'queue.sqlite'))
+
+
+def queue(engine, worker, **kwargs):
+    # without heartbeat: leases are only renewed by the tests
+    return WorkQueue(engine, 'project', worker, heartbeat=0, commit_every=1, **kwargs)
+
+
+def test_claim(engine):
+    coordinator = queue(engine, 'coordinator')
+    coordinator.fill(EXTENTS, SET_IDS)
+    assert coordinator.size() == 10
+
+    tile_ids, extents, set_ids = queue(engine, 'a').claim(4)
+    assert tile_ids.tolist() == [1, 2, 3, 4]
+    np.testing.assert_array_equal(extents, EXTENTS[:4])
+    assert set_ids.tolist() == [0, 0, 0, 0]
+
+    tile_ids, extents, set_ids = queue(engine, 'b').claim(4)
+    assert tile_ids.tolist() == [5, 6, 7, 8]
+    assert set_ids.tolist() == [0, 1, 1, 1]
+    assert coordinator.counts() == {LEASED: 8, PENDING: 2}
+
+
+def test_fill_keeps_statuses(engine):
+    a = queue(engine, 'a')
+    a.fill(EXTENTS, SET_IDS)
+    a.claim(2)
+    a.report(1, DONE)
+
+    # tile 2 moved: pending again, tile 1 is still done
+    extents = EXTENTS.copy()
+    extents[1] += 1
+    a.fill(extents, SET_IDS)
+    assert a.statuses([1, 2]) == {1: (DONE, DONE), 2: (PENDING, PENDING)}
+    assert a.counts() == {DONE: 1, PENDING: 9}
+
+
+def test_lease_expiry_reclaim(engine):
+    a, b = queue(engine, 'a', lease=0.5), queue(engine, 'b')
+    a.fill(EXTENTS, SET_IDS)
+    assert a.claim(3)[0].tolist() == [1, 2, 3]
+
+    # leased tiles are not claimed again before their lease expires
+    assert b.claim(5)[0].tolist() == [4, 5, 6, 7, 8]
+    time.sleep(0.6)
+    assert b.claim(5)[0].tolist() == [1, 2, 3, 9, 10]
+    assert b.claim(5)[0].tolist() == []
+
+
+def test_renew(engine):
+    a, b = queue(engine, 'a', lease=0.5), queue(engine, 'b')
+    a.fill(EXTENTS, SET_IDS)
+    a.claim(3)
+    time.sleep(0.3)
+    a.renew()
+    time.sleep(0.3)
+    assert 1 not in b.claim(10)[0].tolist()
+
+
+def test_report_after_reassign(engine):
+    a, b = queue(engine, 'a', lease=0.2), queue(engine, 'b')
+    a.fill(EXTENTS, SET_IDS)
+    a.claim(2)
+    time.sleep(0.3)
+    assert b.claim(2)[0].tolist() == [1, 2]
+
+    # a lost its leases: its reports are ignored
+    a.report(1, DONE)
+    a.report(2, FAILED)
+    assert b.counts() == {LEASED: 2, PENDING: 8}
+
+    b.report(1, DONE)
+    b.set_mask(2, EMPTY)
+    assert b.statuses([1, 2, 3]) == {1: (DONE, DONE), 2: (EMPTY, PENDING), 3: (PENDING, PENDING)}
+    assert b.count(image=DONE) == 1 and b.count(mask=EMPTY) == 1
+
+
+def test_failed_retried(engine):
+    a = queue(engine, 'a', max_attempts=2)
+    a.fill(EXTENTS[:1], SET_IDS[:1])
+
+    # pending again after a failure, failed after max_attempts claims
+    a.claim(1)
+    a.report(1, FAILED)
+    assert a.counts() == {PENDING: 1}
+    assert a.claim(1)[0].tolist() == [1]
+    a.report(1, FAILED)
+    assert a.counts() == {FAILED: 1}
+    assert a.statuses() == {1: (DONE, FAILED)}
+    assert a.claim(1)[0].tolist() == []
+
+
+def test_expired_tiles_failed(engine):
+    a, b = queue(engine, 'a', lease=0.2, max_attempts=2), queue(engine, 'b', lease=0.2, max_attempts=2)
+    a.fill(EXTENTS[:2], SET_IDS[:2])
+
+    # tile 1 stops every worker that claims it: no report, its lease expires
+    assert a.claim(1)[0].tolist() == [1]
+    time.sleep(0.3)
+    assert b.claim(1)[0].tolist() == [1]
+    time.sleep(0.3)
+
+    # claimed max_attempts times: failed instead of leased again
+    assert a.claim(2)[0].tolist() == [2]
+    assert a.counts() == {FAILED: 1, LEASED: 1}
+    assert a.statuses([1]) == {1: (DONE, FAILED)}
+    b.report(1, DONE)
+    assert a.count(image=FAILED) == 1
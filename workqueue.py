@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+import os
+import socket
+import threading
+
+import numpy as np
+from sqlalchemy import text, bindparam
+
+from manifest import PENDING, DONE, EMPTY, FAILED
+
+
+### DISTRIBUTED WORK QUEUE
+
+# Status of a tile in the queue (besides PENDING, DONE, EMPTY and FAILED)
+LEASED = 'leased'
+
+# Time in seconds (epoch), taken from the database clock so that workers
+# on several machines agree on the lease expirations
+_NOW = {
+    'postgresql': "EXTRACT(EPOCH FROM clock_timestamp())",
+    'sqlite': "((julianday('now') - 2440587.5) * 86400.0)",
+}
+
+CREATE_QUERY = '''
+CREATE TABLE IF NOT EXISTS {table} (
+    project TEXT NOT NULL, idx BIGINT NOT NULL, set_id BIGINT NOT NULL,
+    w DOUBLE PRECISION NOT NULL, s DOUBLE PRECISION NOT NULL, e DOUBLE PRECISION NOT NULL, n DOUBLE PRECISION NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending', worker TEXT, lease_until DOUBLE PRECISION,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (project, idx)
+)
+'''
+
+INDEX_QUERY = "CREATE INDEX IF NOT EXISTS {name}_status ON {table} (project, status, idx)"
+
+# New tiles are pending, tiles whose extent or set changed are reset
+FILL_QUERY = '''
+INSERT INTO {table} AS q (project, idx, set_id, w, s, e, n)
+VALUES (:project, :idx, :set_id, :w, :s, :e, :n)
+ON CONFLICT (project, idx) DO UPDATE SET
+    set_id = excluded.set_id, w = excluded.w, s = excluded.s, e = excluded.e, n = excluded.n,
+    status = 'pending', worker = NULL, lease_until = NULL, attempts = 0
+WHERE q.set_id <> excluded.set_id OR q.w <> excluded.w OR q.s <> excluded.s OR q.e <> excluded.e OR q.n <> excluded.n
+'''
+
+# Tiles whose lease expired after max_attempts claims are failed: their worker
+# stopped without reporting them (a tile that crashes or hangs every worker)
+EXPIRE_QUERY = '''
+UPDATE {table} SET status = 'failed', lease_until = NULL
+WHERE project = :project AND status = 'leased' AND lease_until < {now} AND attempts >= :max_attempts
+'''
+
+# Pending tiles and tiles whose lease expired, by increasing index (tiles of a
+# set are consecutive). In PostgreSQL, rows claimed by another worker are skipped.
+CLAIM_QUERY = '''
+UPDATE {table} SET status = 'leased', worker = :worker, lease_until = {now} + :lease, attempts = attempts + 1
+WHERE project = :project AND idx IN (
+    SELECT idx FROM {table}
+    WHERE project = :project AND (status = 'pending' OR (status = 'leased' AND lease_until < {now} AND attempts < :max_attempts))
+    ORDER BY idx LIMIT :n {lock}
+)
+RETURNING idx, set_id, w, s, e, n
+'''
+
+RENEW_QUERY = '''
+UPDATE {table} SET lease_until = {now} + :lease
+WHERE project = :project AND worker = :worker AND status = 'leased'
+'''
+
+# Only the worker holding the lease reports a tile. Failed tiles are pending
+# again until they have been tried max_attempts times.
+REPORT_QUERY = '''
+UPDATE {table} SET
+    status = CASE WHEN :status = 'failed' AND attempts < :max_attempts THEN 'pending' ELSE :status END,
+    lease_until = NULL
+WHERE project = :project AND idx = :idx AND worker = :worker AND status = 'leased'
+'''
+
+
+def worker_name():
+    # unique name of this process on the cluster
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+class WorkQueue:
+    '''
+    Queue of the tiles of a project in a database table, shared by a
+    coordinator (fill) and workers on several machines (claim). Claimed
+    tiles are leased to their worker, which renews its leases from a
+    background thread: tiles of a worker that stopped are given to another
+    one once their lease expires.
+    Works with PostgreSQL (table next to deepmapdraw.sets) or SQLite (one
+    host, for tests). A worker can use it instead of a JobManifest.
+    '''
+
+    def __init__(self, engine, project, worker=None, lease=600, heartbeat=60, max_attempts=3, table=None, commit_every=100):
+        # engine: sqlalchemy engine of the database
+        # project: key of the tiles of a project in the table (several projects can share it)
+        # worker: name of this worker (None = worker_name())
+        # lease: seconds before the tiles of a silent worker can be claimed again
+        # heartbeat: seconds between two renewals of the leases
+        # max_attempts: claims of a tile before it is failed
+        # table: None = deepmapdraw.tile_queue (postgresql) or tile_queue (sqlite)
+        # commit_every: number of reports sent together
+        self.engine = engine
+        self.project = project
+        self.worker = worker or worker_name()
+        self.lease = lease
+        self.heartbeat = heartbeat
+        self.max_attempts = max_attempts
+        self.commit_every = commit_every
+        dialect = engine.dialect.name
+        if dialect not in _NOW: raise ValueError("Work queue not supported on " + dialect)
+        self.table = table or ('deepmapdraw.tile_queue' if dialect == 'postgresql' else 'tile_queue')
+        self._format = {'table': self.table, 'now': _NOW[dialect],
+                        'lock': 'FOR UPDATE SKIP LOCKED' if dialect == 'postgresql' else ''}
+        self._reports = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        with engine.begin() as connection:
+            if dialect == 'sqlite': connection.execute(text("PRAGMA journal_mode=WAL"))
+            connection.execute(text(CREATE_QUERY.format(**self._format)))
+            connection.execute(text(INDEX_QUERY.format(name=self.table.split('.')[-1], table=self.table)))
+
+    def _query(self, query):
+        return text(query.format(**self._format))
+
+    def fill(self, tile_extents, set_ids, chunk_size=65536):
+        '''
+        Add the tiles of the project (tile i is the i-th extent, starting at 1).
+        Statuses of the tiles already in the queue are kept if their extent
+        and set did not change.
+        '''
+        with self.engine.begin() as connection:
+            for start in range(0, len(tile_extents), chunk_size):
+                extents = np.asarray(tile_extents[start:start + chunk_size], dtype=np.float64).tolist()
+                chunk_set_ids = np.asarray(set_ids[start:start + chunk_size]).tolist()
+                connection.execute(self._query(FILL_QUERY), [
+                    {'project': self.project, 'idx': i, 'set_id': set_id, 'w': w, 's': s, 'e': e, 'n': n}
+                    for i, (set_id, (w, s, e, n)) in enumerate(zip(chunk_set_ids, extents), start=start + 1)])
+            connection.execute(self._query("DELETE FROM {table} WHERE project = :project AND idx > :count"),
+                               {'project': self.project, 'count': len(tile_extents)})
+
+    def size(self):
+        # number of tiles of the project
+        with self.engine.connect() as connection:
+            return connection.execute(self._query("SELECT count(*) FROM {table} WHERE project = :project"),
+                                      {'project': self.project}).scalar()
+
+    def counts(self):
+        # number of tiles of the project by status
+        with self.engine.connect() as connection:
+            rows = connection.execute(self._query("SELECT status, count(*) FROM {table} WHERE project = :project GROUP BY status"),
+                                      {'project': self.project})
+            return {status: count for status, count in rows}
+
+    def claim(self, n):
+        '''
+        Lease up to n tiles to this worker (expired tiles claimed max_attempts 
+        times are failed first)
+
+        Returns
+        -------
+        tile_ids : numpy array of int, increasing
+        extents : numpy array of float64 with shape (len(tile_ids), 4)
+        set_ids : numpy array of int
+        '''
+        with self.engine.begin() as connection:
+            connection.execute(self._query(EXPIRE_QUERY), {'project': self.project, 'max_attempts': self.max_attempts})
+            rows = connection.execute(self._query(CLAIM_QUERY), {'project': self.project, 'worker': self.worker, 'lease': self.lease, 
+                                                                 'n': n, 'max_attempts': self.max_attempts}).fetchall()
+        rows.sort(key=lambda row: row[0])
+        if self._thread is None and self.heartbeat:
+            self._thread = threading.Thread(target=self._renew_leases, daemon=True)
+            self._thread.start()
+        tile_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        extents = np.array([row[2:] for row in rows], dtype=np.float64).reshape(-1, 4)
+        return tile_ids, extents, np.array([row[1] for row in rows], dtype=np.int64)
+
+    def renew(self):
+        # extend the leases of every tile of this worker
+        with self.engine.begin() as connection:
+            connection.execute(self._query(RENEW_QUERY), {'project': self.project, 'worker': self.worker, 'lease': self.lease})
+
+    def _renew_leases(self):
+        while not self._stop.wait(self.heartbeat):
+            try: self.renew()
+            except Exception as error: print("\nLeases not renewed:", error)
+
+    def report(self, i, status):
+        '''
+        Report a leased tile as DONE, EMPTY or FAILED (sent every commit_every reports)
+        '''
+        with self._lock:
+            self._reports.append({'project': self.project, 'worker': self.worker, 'idx': int(i),
+                                  'status': status, 'max_attempts': self.max_attempts})
+            if len(self._reports) >= self.commit_every: self._commit()
+
+    def _commit(self):
+        if not self._reports: return
+        with self.engine.begin() as connection:
+            connection.execute(self._query(REPORT_QUERY), self._reports)
+        self._reports = []
+
+    def commit(self):
+        with self._lock: self._commit()
+
+    # Same interface as JobManifest, for the tiles claimed by this worker
+
+    def set_mask(self, i, status):
+        # the tile is done with its image, unless its mask is empty
+        if status == EMPTY: self.report(i, EMPTY)
+
+    def set_image(self, i, status):
+        self.report(i, status)
+
+    def statuses(self, tile_ids=None, chunk_size=900):
+        '''
+        Return a dict {tile index: (mask status, image status)} like
+        JobManifest.statuses (tiles that are not done are pending)
+        '''
+        query = "SELECT idx, status FROM {table} WHERE project = :project"
+        as_manifest = {DONE: (DONE, DONE), EMPTY: (EMPTY, PENDING), FAILED: (DONE, FAILED)}
+        with self.engine.connect() as connection:
+            if tile_ids is None: 
+                rows = connection.execute(self._query(query), {'project': self.project})
+                return {i: as_manifest.get(status, (PENDING, PENDING)) for i, status in rows}
+            tile_ids = [int(i) for i in tile_ids]
+            in_ids = self._query(query + " AND idx IN :ids").bindparams(bindparam('ids', expanding=True))
+            statuses = {}
+            for start in range(0, len(tile_ids), chunk_size):
+                rows = connection.execute(in_ids, {'project': self.project, 'ids': tile_ids[start:start + chunk_size]})
+                statuses.update((i, as_manifest.get(status, (PENDING, PENDING))) for i, status in rows)
+            return statuses
+
+    def count(self, mask=None, image=None):
+        # like JobManifest.count, for image=DONE, mask=EMPTY or image=FAILED
+        counts = self.counts()
+        if mask is None and image is None: return sum(counts.values())
+        return counts.get(image or mask, 0)
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None: self._thread.join()
+        self.commit()